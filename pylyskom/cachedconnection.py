@@ -6,13 +6,21 @@
 
 from __future__ import absolute_import
 from __future__ import print_function
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
 import logging
+import sys
+import threading
+import time
 
+import six
 from six.moves import range
 
 from . import requests
 from .async import AsyncMessages, async_dict
-from .errors import NotMember, NoSuchLocalText, UnimplementedAsync
+from .datatypes import MICommentIn, Membership11, ReadRangeSet
+from .errors import NotMember, NoSuchLocalText, ServerError, UnimplementedAsync
 from .stats import stats
 
 
@@ -20,10 +28,32 @@ logger = logging.getLogger(__name__)
 
 
 class Client(object):
+    """Sends requests and reads responses on a connection. A client
+    can be shared between threads, and requests from different
+    threads are multiplexed on the connection: a thread can send a
+    request while another one waits for a response.
+
+    Responses are read by one thread at a time (the reader), which is
+    elected among the threads that wait for responses. The reader
+    puts responses for other threads in the queues and wakes them up,
+    and gives up the role when its own response has arrived. Async
+    handlers and background callbacks are called by the reader, in
+    the order the messages were read, before any later response is
+    delivered.
+    """
     def __init__(self, conn):
         self._conn = conn
+        # Protects the queues, the callbacks and the reader election.
+        # Never held while sending or reading on the connection.
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        # Thread ident of the reader, or None
+        self._reader = None
         self._ok_queue = {}
         self._error_queue = {}
+        self._callbacks = {}
+        # Background requests whose callbacks are being called
+        self._running_callbacks = set()
         self._async_handler_func = None
 
     def close(self):
@@ -39,6 +69,68 @@ class Client(object):
         logger.debug("returning response for ref_no: %s" % (ref_no, ))
         return resp
 
+    def request_many(self, reqs, return_exceptions=False):
+        """Send several requests and return a list of the responses,
+        in the same order as the requests. All requests are sent
+        before waiting for any response (pipelining), so the total
+        wait is about one round trip instead of one per request.
+
+        @param return_exceptions If True, server errors are returned
+        in the list instead of being raised. If False, the first
+        server error is raised after all responses have been read.
+        """
+        logger.debug("sending %d requests" % (len(reqs),))
+        ref_nos = [ self._conn.send_request(req) for req in reqs ]
+        responses = []
+        for ref_no in ref_nos:
+            try:
+                responses.append(self._wait_and_dequeue(ref_no))
+            except ServerError as error:
+                responses.append(error)
+        if not return_exceptions:
+            for resp in responses:
+                if isinstance(resp, ServerError):
+                    raise resp
+        return responses
+
+    def request_in_background(self, request, callback):
+        """Send a request without waiting for the response. The
+        callback will be called with the response and None, or None
+        and the error, when the response has been read. That happens
+        while some thread waits for the response to a later request,
+        or in wait_for_background().
+
+        @return The ref_no of the request.
+        """
+        logger.debug("sending background request: %s" % (request,))
+        ref_no = self._conn.send_request(request)
+        with self._lock:
+            # Another thread may have read the response already
+            if ref_no in self._ok_queue:
+                resp, error = self._ok_queue.pop(ref_no), None
+            elif ref_no in self._error_queue:
+                resp, error = None, self._error_queue.pop(ref_no)
+            else:
+                self._callbacks[ref_no] = callback
+                return ref_no
+        callback(resp, error)
+        return ref_no
+
+    def wait_for_background(self, ref_no):
+        """Wait until the callback of a background request has been
+        called (or the request has been cancelled).
+        """
+        self._wait_until(lambda: ref_no not in self._callbacks and
+                         ref_no not in self._running_callbacks)
+
+    def cancel_background(self, ref_no):
+        """Don't call the callback of a background request. The
+        response is read and thrown away when it arrives.
+        """
+        with self._lock:
+            if ref_no in self._callbacks:
+                self._callbacks[ref_no] = _ignore_response
+
     def set_async_handler(self, handler_func):
         """Set the async handler function.
         
@@ -54,29 +146,56 @@ class Client(object):
         error.
         """
         logger.debug("waiting for  response ref_no: %s" % (ref_no,))
-        while ref_no not in self._ok_queue and \
-              ref_no not in self._error_queue:
-            self._read_response()
-
-        if ref_no in self._ok_queue:
-            resp = self._ok_queue[ref_no]
-            logger.debug("got response %s ref_no: %s" % (resp, ref_no))
-            del self._ok_queue[ref_no]
-            return resp
-        elif ref_no in self._error_queue:
-            error = self._error_queue[ref_no]
-            logger.debug("got error %s ref_no: %s" % (error, ref_no))
-            del self._error_queue[ref_no]
-            raise error
-        else:
-            raise RuntimeError("Got unknown ref-no: %r" % (ref_no,))
+        self._wait_until(lambda: ref_no in self._ok_queue or ref_no in self._error_queue)
+        with self._lock:
+            if ref_no in self._ok_queue:
+                resp = self._ok_queue.pop(ref_no)
+                logger.debug("got response %s ref_no: %s" % (resp, ref_no))
+                return resp
+            error = self._error_queue.pop(ref_no)
+        logger.debug("got error %s ref_no: %s" % (error, ref_no))
+        raise error
+
+    def _wait_until(self, done):
+        """Wait until done() (called with the lock held) returns True,
+        reading responses if we are (or become) the reader.
+        """
+        me = threading.current_thread().ident
+        with self._lock:
+            while not done():
+                if self._reader is None or self._reader == me:
+                    # The reader may already be us, if a callback or
+                    # an async handler sends a request.
+                    previous_reader = self._reader
+                    self._reader = me
+                    try:
+                        self._read_response()
+                    finally:
+                        self._reader = previous_reader
+                        self._changed.notify_all()
+                else:
+                    self._changed.wait()
 
     def _read_response(self):
-        ref_no, resp, error = self._conn.read_response()
+        # Called by the reader, with the lock held. The lock is
+        # released while reading and while calling handlers.
+        self._lock.release()
+        try:
+            ref_no, resp, error = self._conn.read_response()
+        finally:
+            self._lock.acquire()
         logger.debug("read response for ref_no: %s" % (ref_no,))
         if ref_no is None:
             # async message
-            self._handle_async_message(resp)
+            self._call_unlocked(self._handle_async_message, resp)
+        elif ref_no in self._callbacks:
+            # background request
+            callback = self._callbacks.pop(ref_no)
+            self._running_callbacks.add(ref_no)
+            try:
+                self._call_unlocked(callback, resp, error)
+            finally:
+                self._running_callbacks.discard(ref_no)
         elif error is not None:
             # error reply
             self._error_queue[ref_no] = error
@@ -84,11 +203,22 @@ class Client(object):
             # ok reply - resp can be None
             self._ok_queue[ref_no] = resp
 
+    def _call_unlocked(self, func, *args):
+        self._lock.release()
+        try:
+            func(*args)
+        finally:
+            self._lock.acquire()
+
     def _handle_async_message(self, msg):
         if self._async_handler_func is not None:
             self._async_handler_func(msg)
 
 
+def _ignore_response(resp, error):
+    pass
+
+
 
 #
 # CLASS for a connection with...
@@ -97,7 +227,7 @@ class Client(object):
 #   - Conference
 #   - Person
 #   - TextStat 
-#   - Subjects
+#   - Text bodies (bounded by size in bytes)
 #   No negative caching. No time-outs.
 #   Some automatic invalidation (if accept-async called appropriately).
 #
@@ -106,8 +236,24 @@ class Client(object):
 #   numbers of all unread text in a conference for a person
 
 class CachingClient(object):
-    def __init__(self, client):
+    # Max number of case insensitive regexps to remember
+    CASE_INSENSITIVE_REGEXPS_SIZE = 64
+
+    def __init__(self, client, text_body_cache_bytes=16*1024*1024,
+                 stale_while_revalidate=False, pipeline_local_to_global=True):
+        """
+        @param stale_while_revalidate If True, invalidated
+        uconferences and conferences are returned as they were
+        (stale) while a refreshed version is fetched in the
+        background. Use get_fresh() on the caches to always get a
+        fresh value.
+
+        @param pipeline_local_to_global If True, all chunks of the
+        local to global mapping that are needed for the unread texts
+        are requested at once, instead of one chunk at a time.
+        """
         self._client = client
+        self._pipeline_local_to_global = pipeline_local_to_global
 
         # Caches
         #
@@ -121,10 +267,37 @@ class CachingClient(object):
         # could be dangerous. Sometime it is okay with cached
         # responses, and sometimes it is not. How can we make it
         # possible to force no cached?
-        self.uconferences = Cache(self._fetch_uconference, "UConference")
-        self.conferences = Cache(self._fetch_conference, "Conference")
+        if stale_while_revalidate:
+            uconference_refresher = self._refresher(requests.ReqGetUconfStat)
+            conference_refresher = self._refresher(requests.ReqGetConfStat)
+        else:
+            uconference_refresher = None
+            conference_refresher = None
+        self.uconferences = Cache(self._fetch_uconference, "UConference",
+                                  refresher=uconference_refresher)
+        self.conferences = Cache(self._fetch_conference, "Conference",
+                                 refresher=conference_refresher)
+        # The user area and the created texts of cached persons are
+        # kept up to date, but statistics like last_login and
+        # read_texts are not.
         self.persons = Cache(self._fetch_person, "Person")
         self.textstats = Cache(self._fetch_textstat, "TextStat")
+        # Texts are never modified, so the bodies only have to be
+        # invalidated when a text is deleted. They can be large, so
+        # the cache is limited by size instead of number of entries.
+        self.textbodies = SizeBoundedCache(self._fetch_textbody, "TextBody",
+                                           max_bytes=text_body_cache_bytes)
+
+        # Known parts of the local to global mapping, per conference
+        self._local_to_global_maps = {}
+        self._local_to_global_account = _SizeAccount()
+
+        # Char to equivalent chars, built from the collate table
+        self._equivalent_chars = None
+        # Recently used case insensitive regexps (LRU)
+        self._case_insensitive_regexps = OrderedDict()
+        self._case_insensitive_regexps_lock = threading.Lock()
+        self._case_insensitive_regexps_bytes = 0
 
         self._async_handlers = {}
         self._client.set_async_handler(self._handle_async_message)
@@ -138,15 +311,153 @@ class CachingClient(object):
         self._add_async_handler(AsyncMessages.NEW_RECIPIENT, self._cah_new_recipient)
         self._add_async_handler(AsyncMessages.SUB_RECIPIENT, self._cah_sub_recipient)
         self._add_async_handler(AsyncMessages.NEW_MEMBERSHIP, self._cah_new_membership)
+        self._add_async_handler(AsyncMessages.NEW_USER_AREA, self._cah_new_user_area)
+        self._add_async_handler(AsyncMessages.NEW_PRESENTATION, self._cah_new_presentation)
         self.request(requests.ReqAcceptAsync(list(self._async_handlers.keys())))
 
 
     def close(self):
         self._client.close()
+        # Remove our entries from the cache size stats
+        self.clear_caches()
 
     def request(self, request):
         return self._client.request(request)
 
+    def request_many(self, reqs, return_exceptions=False):
+        return self._client.request_many(reqs, return_exceptions)
+
+    def set_user_area(self, pers_no, text_no):
+        self.request(requests.ReqSetUserArea(pers_no, text_no))
+        def set_user_area(person):
+            person.user_area = text_no
+        self.persons.update(pers_no, set_user_area)
+
+    def _prefetch(self, cache, nos, make_request):
+        """Fetch the entries in nos that are not already in cache with
+        one pipelined burst of requests. Errors are ignored, they will
+        be raised when the entry is read from the cache.
+
+        @param make_request Function that creates the request for
+        fetching the entry for a key.
+        """
+        missing = []
+        for no in nos:
+            if no not in cache and no not in missing:
+                missing.append(no)
+        if len(missing) == 0:
+            return
+        generation = cache.generation
+        responses = self.request_many([ make_request(no) for no in missing ],
+                                      return_exceptions=True)
+        for no, resp in zip(missing, responses):
+            if not isinstance(resp, ServerError):
+                cache.store(no, resp, generation)
+
+    def _get_many(self, wanted, return_exceptions=False):
+        """Get entries from several caches, fetching all missing
+        entries with one pipelined burst of requests.
+
+        @param wanted List of (cache, key, make_request) tuples. If
+        cache is None, the entry is always fetched.
+        @param return_exceptions If True, errors are returned in
+        place of the values that could not be fetched.
+        @return List of the values, in the same order as wanted. If
+        any request failed, the first error is raised (after all
+        responses have been read), unless return_exceptions is True.
+        """
+        values = [ None ] * len(wanted)
+        # (cache, key) to indexes in wanted. Uncached entries are
+        # never shared.
+        missing = OrderedDict()
+        for i, (cache, no, make_request) in enumerate(wanted):
+            if cache is None:
+                missing[(None, i)] = [ i ]
+            elif no in cache:
+                # May still fetch, if invalidated just now
+                values[i] = cache[no]
+            else:
+                missing.setdefault((cache, no), []).append(i)
+        if len(missing) == 0:
+            return values
+
+        generations = dict((cache, cache.generation) for cache, _ in missing
+                           if cache is not None)
+        reqs = [ wanted[indexes[0]][2](wanted[indexes[0]][1])
+                 for indexes in missing.values() ]
+        responses = self.request_many(reqs, return_exceptions=True)
+        error = None
+        for ((cache, _), indexes), resp in zip(missing.items(), responses):
+            if isinstance(resp, ServerError):
+                if return_exceptions:
+                    for i in indexes:
+                        values[i] = resp
+                elif error is None or indexes[0] < error[0]:
+                    error = (indexes[0], resp)
+                continue
+            if cache is not None:
+                cache.store(wanted[indexes[0]][1], resp, generations[cache])
+            for i in indexes:
+                values[i] = resp
+        if error is not None:
+            raise error[1]
+        return values
+
+    def get_texts(self, text_nos):
+        """Get the text stats and bodies of texts. The ones that are
+        not cached are fetched in one pipelined burst, so the stat and
+        body of a text don't take one round trip each.
+
+        @return List of (text_stat, text) tuples, in the same order
+        as text_nos.
+        """
+        wanted = []
+        for text_no in text_nos:
+            wanted.append((self.textstats, text_no, requests.ReqGetTextStat))
+            wanted.append((self.textbodies, text_no, requests.ReqGetText))
+        values = self._get_many(wanted)
+        return list(zip(values[0::2], values[1::2]))
+
+    def prefetch_text(self, text_no):
+        """Start fetching the stat and body of a text in the
+        background, unless they are cached. Errors are ignored; they
+        are raised when the text is read from the caches.
+
+        @return A list of references to pass to wait_for_prefetch()
+        or cancel_prefetch().
+        """
+        refs = []
+        for cache, make_request in ((self.textstats, requests.ReqGetTextStat),
+                                    (self.textbodies, requests.ReqGetText)):
+            if text_no not in cache:
+                refs.append(self._client.request_in_background(
+                    make_request(text_no), self._prefetched_callback(cache, text_no)))
+        return refs
+
+    def _prefetched_callback(self, cache, no):
+        generation = cache.generation
+        def prefetched(val, error):
+            if error is None:
+                cache.store(no, val, generation)
+        return prefetched
+
+    def wait_for_prefetch(self, refs):
+        for ref in refs:
+            self._client.wait_for_background(ref)
+
+    def cancel_prefetch(self, refs):
+        for ref in refs:
+            self._client.cancel_background(ref)
+
+    def get_text_stats(self, text_nos, return_exceptions=False):
+        """Get the text stats of texts, fetching the ones that are not
+        cached in one pipelined burst. Errors are handled like in
+        request_many().
+        """
+        return self._get_many([ (self.textstats, text_no, requests.ReqGetTextStat)
+                                for text_no in text_nos ],
+                              return_exceptions)
+
 
     # Async handling
 
@@ -187,54 +498,136 @@ class CachingClient(object):
             self.request(requests.ReqAcceptAsync(list(self._async_handlers.keys())))
 
 
-    # Handlers for asynchronous messages (internal use) FIXME: Most of
-    # these handlers could do more clever things than just
-    # invalidating.
+    # Handlers for asynchronous messages (internal use). Cached
+    # objects are updated in place when the message contains enough
+    # information to do that correctly, otherwise they are
+    # invalidated. In place updates are done with Cache.update(), so
+    # that fetches in progress (which may have missed the change)
+    # don't overwrite them.
 
     def _cah_new_name(self, msg):
-        # A new name makes uconferences[].name invalid
-        self.uconferences.invalidate(msg.conf_no)
-        # A new name makes conferences[].name invalid
-        self.conferences.invalidate(msg.conf_no)
+        def set_name(conf):
+            conf.name = msg.new_name
+        self.uconferences.update(msg.conf_no, set_name)
+        self.conferences.update(msg.conf_no, set_name)
 
     def _cah_leave_conf(self, msg):
-        # Leaving a conference makes conferences[].no_of_members invalid
-        self.conferences.invalidate(msg.conf_no)
+        # The current person left the conference
+        def remove_member(conf):
+            conf.no_of_members -= 1
+        self.conferences.update(msg.conf_no, remove_member)
 
     def _cah_deleted_text(self, msg):
         # Deletion of a text makes conferences[].no_of_texts invalid
+        # if it was the first text in the conference, and we don't
+        # know if it was.
         ts = msg.text_stat
         for rcpt in ts.misc_info.recipient_list:
             self.conferences.invalidate(rcpt.recpt)
+            # The maps may be cleared at any time, so look them up once
+            l2g_map = self._local_to_global_maps.get(rcpt.recpt)
+            if l2g_map is not None and rcpt.loc_no is not None:
+                l2g_map.remove(rcpt.loc_no)
+        # The commented texts are no longer commented by this text
+        def remove_comment_in(commented_ts):
+            commented_ts.misc_info.comment_in_list = [
+                ci for ci in commented_ts.misc_info.comment_in_list
+                if ci.text_no != msg.text_no ]
+        for ct in ts.misc_info.comment_to_list:
+            self.textstats.update(ct.text_no, remove_comment_in)
+        # The comments are no longer comments to this text
+        def remove_comment_to(comment_ts):
+            comment_ts.misc_info.comment_to_list = [
+                ct for ct in comment_ts.misc_info.comment_to_list
+                if ct.text_no != msg.text_no ]
+        for ci in ts.misc_info.comment_in_list:
+            self.textstats.update(ci.text_no, remove_comment_to)
+        # The text itself is gone
+        self.textstats.invalidate(msg.text_no)
+        self.textbodies.invalidate(msg.text_no)
             
     def _cah_new_text(self, msg):
         # A new text. conferences[].no_of_texts and
-        # uconferences[].highest_local_no is invalid. Also invalidates
-        # the textstats for the commented texts.
-        for rcpt in msg.text_stat.misc_info.recipient_list:
-            self.conferences.invalidate(rcpt.recpt)
-            self.uconferences.invalidate(rcpt.recpt)
-        for ct in msg.text_stat.misc_info.comment_to_list:
-            self.textstats.invalidate(ct.text_no)
-        # FIXME: A new text makes persons[author].no_of_created_texts invalid
+        # uconferences[].highest_local_no is updated from the local
+        # number the text got in each recipient.
+        ts = msg.text_stat
+        for rcpt in ts.misc_info.recipient_list:
+            if rcpt.loc_no is None:
+                self.conferences.invalidate(rcpt.recpt)
+                self.uconferences.invalidate(rcpt.recpt)
+                continue
+            # update() also makes sure that a fetch in progress,
+            # which may have missed the new text, isn't cached
+            def update_uconf(uconf, loc_no=rcpt.loc_no):
+                uconf.highest_local_no = max(uconf.highest_local_no, loc_no)
+            self.uconferences.update(rcpt.recpt, update_uconf)
+            def update_conf(conf, loc_no=rcpt.loc_no):
+                conf.no_of_texts = max(conf.no_of_texts,
+                                       loc_no - conf.first_local_no + 1)
+                conf.last_written = ts.creation_time
+            self.conferences.update(rcpt.recpt, update_conf)
+            l2g_map = self._local_to_global_maps.get(rcpt.recpt)
+            if l2g_map is not None:
+                l2g_map.add(rcpt.loc_no, msg.text_no)
+        # The commented texts get a new comment
+        for ct in ts.misc_info.comment_to_list:
+            def add_comment_in(commented_ts, comment_type=ct.type):
+                comment_in_list = commented_ts.misc_info.comment_in_list
+                if not any(ci.text_no == msg.text_no for ci in comment_in_list):
+                    comment_in_list.append(MICommentIn(comment_type, msg.text_no))
+            self.textstats.update(ct.text_no, add_comment_in)
+        # We got the complete text stat for the new text
+        self.textstats[msg.text_no] = ts
+        # The author has created one more text
+        def add_created_text(author):
+            author.no_of_created_texts += 1
+            author.created_lines += ts.no_of_lines
+            author.created_bytes += ts.no_of_chars
+        self.persons.update(ts.author, add_created_text)
 
     def _cah_new_recipient(self, msg):
         # Just like a new text; conferences[].no_of_texts and
-        # uconferences[].highest_local_no gets invalid. 
+        # uconferences[].highest_local_no gets invalid. We don't get
+        # the local number, so we can't update them.
         self.conferences.invalidate(msg.conf_no)
         self.uconferences.invalidate(msg.conf_no)
         # textstats.misc_info_recipient_list gets invalid as well.
         self.textstats.invalidate(msg.text_no)
+        # The local to global map doesn't need to be updated: The new
+        # local number is higher than the highest local number when
+        # the map was fetched, so it will be fetched when
+        # uconferences[].highest_local_no says it exists.
 
     def _cah_sub_recipient(self, msg):
-        # Invalid conferences[].no_of_texts
+        # Invalid conferences[].no_of_texts (if it was the first text)
         self.conferences.invalidate(msg.conf_no)
-        # textstats.misc_info_recipient_list gets invalid as well.
-        self.textstats.invalidate(msg.text_no)
+        l2g_map = self._local_to_global_maps.get(msg.conf_no)
+        if l2g_map is not None:
+            l2g_map.remove_text(msg.text_no)
+        # Remove the recipient from the text stat
+        def remove_recipient(ts):
+            ts.misc_info.recipient_list = [
+                rcpt for rcpt in ts.misc_info.recipient_list
+                if rcpt.recpt != msg.conf_no ]
+        self.textstats.update(msg.text_no, remove_recipient)
 
     def _cah_new_membership(self, msg):
-        # Joining a conference makes conferences[].no_of_members invalid
-        self.conferences.invalidate(msg.conf_no)
+        # Joining a conference increases conferences[].no_of_members
+        def add_member(conf):
+            conf.no_of_members += 1
+        self.conferences.update(msg.conf_no, add_member)
+
+    def _cah_new_user_area(self, msg):
+        def set_user_area(person):
+            person.user_area = msg.new_user_area
+        self.persons.update(msg.person_no, set_user_area)
+
+    def _cah_new_presentation(self, msg):
+        # The presentation is part of the conference stat (also for
+        # persons)
+        def set_presentation(conf):
+            conf.presentation = msg.new_presentation
+        self.conferences.update(msg.conf_no, set_presentation)
 
 
     # Fetching functions (internal use)
@@ -250,13 +643,56 @@ class CachingClient(object):
     def _fetch_textstat(self, no):
         return self.request(requests.ReqGetTextStat(no))
 
+    def _fetch_textbody(self, no):
+        return self.request(requests.ReqGetText(no))
+
+    def _refresher(self, make_request):
+        def refresh(no, callback):
+            self._client.request_in_background(make_request(no), callback)
+        return refresh
+
+
+    def _caches(self):
+        return [ self.uconferences, self.conferences, self.persons,
+                 self.textstats, self.textbodies ]
 
     # Report cache usage
     def report_cache_usage(self):
-        self.uconferences.report()
-        self.conferences.report()
-        self.persons.report()
-        self.textstats.report()
+        for cache in self._caches():
+            cache.report()
+
+    def cache_info(self):
+        """Return the usage of each cache, as a dict from cache name
+        to the dict returned by Cache.info(). The other cached
+        structures (like the local to global maps) are included too,
+        but only with the number of entries and bytes.
+        """
+        info = dict((cache.name, cache.info()) for cache in self._caches())
+        info.update(self._other_caches_info())
+        return info
+
+    def _other_caches_info(self):
+        # The sizes are kept up to date when the structures change, so
+        # nothing is measured here.
+        with self._case_insensitive_regexps_lock:
+            regexps_info = dict(entries=len(self._case_insensitive_regexps),
+                                bytes=self._case_insensitive_regexps_bytes)
+        return { 'LocalToGlobal': self._local_to_global_account.info(),
+                 'CaseInsensitiveRegexp': regexps_info }
+
+    def clear_caches(self):
+        """Remove all entries from the caches, to free their memory.
+        The entries are fetched again when needed.
+        """
+        for cache in self._caches():
+            cache.clear()
+        # Fetches in progress add to the old maps, which are then just
+        # thrown away (and so is their account).
+        self._local_to_global_account = _SizeAccount()
+        self._local_to_global_maps = {}
+        with self._case_insensitive_regexps_lock:
+            self._case_insensitive_regexps = OrderedDict()
+            self._case_insensitive_regexps_bytes = 0
 
     # Common operation: get name of conference (via uconference)
     def conf_name(self, conf_no, default = "", include_no = 0):
@@ -315,9 +751,15 @@ class CachingClient(object):
 
     def _case_insensitive_regexp(self, regexp):
         """Make regular expression case insensitive"""
-        result = ""
-        # FIXME: Cache collate_table
-        collate_table = self.request(requests.ReqGetCollateTable())
+        with self._case_insensitive_regexps_lock:
+            if regexp in self._case_insensitive_regexps:
+                # Move to most recently used position
+                result = self._case_insensitive_regexps.pop(regexp)
+                self._case_insensitive_regexps[regexp] = result
+                return result
+
+        equivalent_chars = self._get_equivalent_chars_table()
+        result = []
         inside_brackets = 0
         for c in regexp:
             if c == "[":
@@ -326,35 +768,58 @@ class CachingClient(object):
             if inside_brackets:
                 eqv_chars = c
             else:
-                eqv_chars = self._equivalent_chars(c, collate_table)
+                eqv_chars = equivalent_chars.get(c, c)
                 
             if len(eqv_chars) > 1:
-                result += "[%s]" % eqv_chars
+                result.append("[%s]" % eqv_chars)
             else:
-                result += eqv_chars
+                result.append(eqv_chars)
 
             if c == "]":
                 inside_brackets = 0
 
+        result = "".join(result)
+        with self._case_insensitive_regexps_lock:
+            regexps = self._case_insensitive_regexps
+            if regexp in regexps:
+                # Made by another thread meanwhile
+                self._case_insensitive_regexps_bytes -= (
+                    sys.getsizeof(regexp) + sys.getsizeof(regexps.pop(regexp)))
+            regexps[regexp] = result
+            self._case_insensitive_regexps_bytes += sys.getsizeof(regexp) + sys.getsizeof(result)
+            if len(regexps) > self.CASE_INSENSITIVE_REGEXPS_SIZE:
+                # Remove the least recently used
+                oldest = next(iter(regexps))
+                self._case_insensitive_regexps_bytes -= (
+                    sys.getsizeof(oldest) + sys.getsizeof(regexps.pop(oldest)))
         return result
 
-    def _equivalent_chars(self, c, collate_table):
-        """Find all chars equivalent to c in collate table"""
-        c_ord = ord(c)
-        if c_ord >= len(collate_table):
-            return c
-
-        result = ""
-        norm_char = collate_table[c_ord]
-        next_index = 0
-        while 1:
-            next_index = collate_table.find(norm_char, next_index)
-            if next_index == -1:
-                break
-            result += chr(next_index)
-            next_index += 1
-
-        return result
+    def _get_equivalent_chars_table(self):
+        """Return a dictionary from each char in the collate table to
+        all chars that are equivalent to it. The collate table never
+        changes for a server, so it is only fetched once per
+        connection.
+        """
+        if self._equivalent_chars is None:
+            collate_table = self.request(requests.ReqGetCollateTable())
+            self._equivalent_chars = self._build_equivalent_chars_table(collate_table)
+        return self._equivalent_chars
+
+    @staticmethod
+    def _build_equivalent_chars_table(collate_table):
+        """Group all chars in the collate table by the char they are
+        normalized to.
+        """
+        classes = {}
+        for i in range(len(collate_table)):
+            norm_char = collate_table[i:i+1]
+            classes.setdefault(norm_char, []).append(chr(i))
+        table = {}
+        for chars in classes.values():
+            eqv_chars = "".join(chars)
+            for c in chars:
+                table[c] = eqv_chars
+        return table
 
     def read_ranges_to_gaps_and_last(self, read_ranges):
         """Return all texts excluded from read_ranges.
@@ -366,54 +831,248 @@ class CachingClient(object):
         each gap in the read ranges, where each tuple is the first
         unread text in the gap and the length of the gap.
         """
-        gaps = []
-        last = 1
-        for read_range in read_ranges:
-            gap = read_range.first_read - last
-            if gap > 0:
-                gaps.append((last, gap))
-            last = read_range.last_read + 1
-        return gaps, last
+        if not isinstance(read_ranges, ReadRangeSet):
+            read_ranges = ReadRangeSet(read_ranges)
+        return read_ranges.gaps(), read_ranges.last_read() + 1
 
     def get_unread_texts_from_membership(self, membership):
-        unread = []
-        
-        more_to_fetch = 1
-        gaps, last = self.read_ranges_to_gaps_and_last(membership.read_ranges)
+        """Return the global text numbers of all unread texts in the
+        membership (which must include read ranges).
+
+        The local to global mapping is cached per conference and kept
+        up to date by async messages, so only the parts of the
+        mapping that we haven't seen before are fetched from the
+        server.
+        """
+        return [ text_no for _, text_no in self._get_unread_local_texts(membership) ]
+
+    def _get_unread_local_texts(self, membership):
+        """Like get_unread_texts_from_membership, but returns a list
+        of (local number, global text number) tuples.
+        """
+        conf_no = membership.conference
+        gaps = self._fetch_unread_local_to_global(
+            { conf_no: self._get_unread_gaps(membership) })[conf_no]
+        return self._local_texts_in_gaps(self._get_local_to_global_map(conf_no), gaps)
+
+    def _fetch_unread_local_to_global(self, gaps_by_conf):
+        """Fetch the unknown parts of the local to global mappings
+        for the gaps (unread texts) in several conferences.
+
+        The gaps are computed from the highest local number in the
+        cached uconference, which is only an estimate of the end of
+        the conference. If the last chunk says that there are texts
+        after it, the rest is fetched sequentially and the last gap is
+        extended.
+
+        @param gaps_by_conf Dict from conference number to a tuple of
+        a list of (first, length) gaps and the highest local number
+        that they were computed with (see _get_unread_gaps).
+        @return Dict from conference number to the list of gaps,
+        extended where needed.
+        """
+        conf_ranges = []
+        for conf_no, (gaps, _) in gaps_by_conf.items():
+            l2g_map = self._get_local_to_global_map(conf_no)
+            for begin, end in self._unknown_in_gaps(l2g_map, gaps):
+                conf_ranges.append((conf_no, begin, end))
+        result = dict((conf_no, gaps) for conf_no, (gaps, _) in gaps_by_conf.items())
+        if self._pipeline_local_to_global:
+            later_texts_after = self._fetch_local_to_global_many(conf_ranges)
+        else:
+            later_texts_after = {}
+            for conf_no, begin, end in conf_ranges:
+                after = self._fetch_local_to_global(
+                    conf_no, begin, end, self._get_local_to_global_map(conf_no))
+                if after is not None:
+                    later_texts_after[conf_no] = max(
+                        later_texts_after.get(conf_no, 0), after)
+
+        for conf_no, after in later_texts_after.items():
+            gaps, highest_local_no = gaps_by_conf[conf_no]
+            first, gap_len = gaps[-1]
+            if first + gap_len != highest_local_no + 1 or after <= highest_local_no:
+                # Not the tail of the conference, or nothing after it
+                continue
+            # The uconference is outdated
+            self.uconferences.invalidate(conf_no)
+            end = self._fetch_local_to_global_tail(
+                conf_no, after, self._get_local_to_global_map(conf_no))
+            result[conf_no] = gaps[:-1] + [ (first, end - first) ]
+        return result
+
+    def _get_unread_gaps(self, membership):
+        """Return the (first, length) gaps in the read ranges of
+        membership, up to the highest local number in the conference,
+        and that highest local number.
+        """
+        read_ranges = membership.read_ranges
+        if not isinstance(read_ranges, ReadRangeSet):
+            read_ranges = ReadRangeSet(read_ranges)
+        # The unread texts are remembered, so a stale uconference
+        # (which may not know about texts added without a local
+        # number) would hide them for good.
+        uconf = self.uconferences.get_fresh(membership.conference)
+        highest_local_no = max(uconf.highest_local_no, read_ranges.last_read())
+        return read_ranges.gaps(last=highest_local_no), highest_local_no
+
+    def _unknown_in_gaps(self, l2g_map, gaps):
+        unknown = []
+        for first, gap_len in gaps:
+            unknown.extend(l2g_map.unknown(first, first + gap_len))
+        return unknown
+
+    def _local_texts_in_gaps(self, l2g_map, gaps):
+        local_texts = []
         for first, gap_len in gaps:
-            first_local = first
-            while gap_len > 0:
-                if gap_len > 255:
-                    n = 255
+            local_texts.extend(l2g_map.items(first, first + gap_len))
+        return local_texts
+
+    def _get_local_to_global_map(self, conf_no):
+        l2g_map = self._local_to_global_maps.get(conf_no)
+        if l2g_map is None:
+            # setdefault is atomic, so all threads get the same map
+            l2g_map = self._local_to_global_maps.setdefault(
+                conf_no, LocalToGlobalMap(self._local_to_global_account))
+        return l2g_map
+
+    def get_last_local_to_global(self, conf_no, local_no_ceiling, no_of_texts):
+        """Get the mapping for the last no_of_texts existing texts in
+        conf_no with local numbers below local_no_ceiling (0 means
+        from the last text). The mapping is added to the local to
+        global map of the conference as well.
+
+        @return Tuple of a list of (local number, global text number)
+        pairs in ascending order, and the local number to use as
+        ceiling to get the texts before them (None if there are no
+        earlier texts).
+        """
+        l2g_map = self._get_local_to_global_map(conf_no)
+        generation = l2g_map.generation
+        mapping = self.request(
+            requests.ReqLocalToGlobalReverse(conf_no, local_no_ceiling, no_of_texts))
+        items = [ (local_no, text_no) for local_no, text_no in mapping.list
+                  if text_no != 0 ]
+        l2g_map.add_fetched(items, mapping.range_begin, mapping.range_end, generation)
+        # For the reverse request, "later" texts are the ones before
+        # the range.
+        if mapping.later_texts_exists:
+            next_ceiling = mapping.range_begin
+        else:
+            next_ceiling = None
+        return items, next_ceiling
+
+    def _fetch_local_to_global_many(self, conf_ranges):
+        """Fetch the mapping for several ranges, in one pipelined
+        burst. Each range is split into chunks of at most 255 local
+        numbers, which is the max that the server returns. A chunk is
+        only short of its end if the conference has no more texts, so
+        all chunks can be requested at once. Parts that are still
+        unknown afterwards (because texts were removed while we
+        fetched) are fetched one chunk at a time.
+
+        @param conf_ranges List of (conf_no, begin, end) tuples, with
+        begin inclusive and end exclusive.
+        @return Dict from conference number to the highest local
+        number that the server said has existing texts after it
+        (for conferences where any chunk said so).
+        """
+        later_texts_after = {}
+        chunks = []
+        for conf_no, begin, end in conf_ranges:
+            l2g_map = self._get_local_to_global_map(conf_no)
+            for first_local in range(begin, end, 255):
+                chunks.append((l2g_map, first_local, min(first_local + 255, end),
+                               requests.ReqLocalToGlobal(
+                                   conf_no, first_local, min(end - first_local, 255))))
+        if len(chunks) == 0:
+            return later_texts_after
+        generations = [ chunk[0].generation for chunk in chunks ]
+        responses = self.request_many([ req for _, _, _, req in chunks ],
+                                      return_exceptions=True)
+        for (l2g_map, first_local, chunk_end, req), generation, resp in zip(
+                chunks, generations, responses):
+            if isinstance(resp, NoSuchLocalText):
+                # No texts from first_local and onwards
+                l2g_map.add_fetched([], first_local, chunk_end, generation)
+            elif not isinstance(resp, ServerError):
+                items = [ (local_no, text_no) for local_no, text_no in resp.list
+                          if text_no != 0 ]
+                if resp.later_texts_exists:
+                    known_end = resp.range_end
+                    later_texts_after[req.conf_no] = max(
+                        later_texts_after.get(req.conf_no, 0), resp.range_end)
                 else:
-                    n = gap_len
-                gap_len -= n
-                try:
-                    mapping = self.request(
-                        requests.ReqLocalToGlobal(membership.conference, first_local, n))
-                    unread.extend([e[1] for e in mapping.list if e[1] != 0])
-                    first_local = mapping.range_end
-                    more_to_fetch = mapping.later_texts_exists
-                except NoSuchLocalText:
-                    more_to_fetch = 0
-        
-        # If there are more than 255 after the last read range, we
-        # need to continue mapping (the last, if any, previous call
-        # will have set later_texts_exists to 1 if so).
-        first_local = last
-        while more_to_fetch:
+                    known_end = max(chunk_end, resp.range_end)
+                l2g_map.add_fetched(items, first_local, known_end, generation)
+
+        for conf_no, begin, end in conf_ranges:
+            l2g_map = self._get_local_to_global_map(conf_no)
+            for unknown_begin, unknown_end in l2g_map.unknown(begin, end):
+                after = self._fetch_local_to_global(
+                    conf_no, unknown_begin, unknown_end, l2g_map)
+                if after is not None:
+                    later_texts_after[conf_no] = max(
+                        later_texts_after.get(conf_no, 0), after)
+        return later_texts_after
+
+    def _fetch_local_to_global_tail(self, conf_no, begin, l2g_map):
+        """Fetch the mapping from begin until there are no more
+        texts, one chunk at a time.
+
+        @return The local number after the last fetched range.
+        """
+        first_local = begin
+        while True:
+            generation = l2g_map.generation
             try:
                 mapping = self.request(
-                    requests.ReqLocalToGlobal(membership.conference, first_local, 255))
-                unread.extend([e[1] for e in mapping.list if e[1] != 0])
-                first_local = mapping.range_end
-                more_to_fetch = mapping.later_texts_exists
+                    requests.ReqLocalToGlobal(conf_no, first_local, 255))
             except NoSuchLocalText:
-                # No unread texts
-                more_to_fetch = 0
-        
-        # Remove text that don't exist anymore (text_no == 0)
-        return [ text_no for text_no in unread if text_no != 0]
+                return first_local
+            items = [ (local_no, text_no) for local_no, text_no in mapping.list
+                      if text_no != 0 ]
+            if not l2g_map.add_fetched(items, first_local, mapping.range_end, generation):
+                # Texts were removed while we fetched, fetch it again
+                continue
+            if not mapping.later_texts_exists or mapping.range_end <= first_local:
+                return mapping.range_end
+            first_local = mapping.range_end
+
+    def _fetch_local_to_global(self, conf_no, begin, end, l2g_map):
+        """Fetch the mapping for the local numbers begin (inclusive)
+        to end (exclusive) into l2g_map.
+
+        @return The local number after the last fetched range if the
+        server said that there are existing texts after it (which
+        then are at or after end), otherwise None.
+        """
+        first_local = begin
+        while first_local < end:
+            n = min(end - first_local, 255)
+            generation = l2g_map.generation
+            try:
+                mapping = self.request(
+                    requests.ReqLocalToGlobal(conf_no, first_local, n))
+            except NoSuchLocalText:
+                # No texts from first_local and onwards
+                if not l2g_map.add_fetched([], first_local, end, generation):
+                    continue
+                return None
+            items = [ (local_no, text_no) for local_no, text_no in mapping.list
+                      if text_no != 0 ]
+            last_chunk = not mapping.later_texts_exists or mapping.range_end <= first_local
+            if last_chunk:
+                known_end = max(end, mapping.range_end)
+            else:
+                known_end = mapping.range_end
+            if not l2g_map.add_fetched(items, first_local, known_end, generation):
+                # Texts were removed while we fetched, fetch it again
+                continue
+            if last_chunk:
+                return None
+            first_local = mapping.range_end
+        return first_local
 
     def mark_text(self, text_no, mark_type):
         self.request(requests.ReqMarkText(text_no, mark_type))
@@ -427,8 +1086,11 @@ class CachingClient(object):
 
 
 class CachingPersonClient(CachingClient):
-    def __init__(self, connection):
-        CachingClient.__init__(self, connection)
+    # Max number of memberships to fetch when warming up the caches
+    WARMUP_MEMBERSHIPS = 1000
+
+    def __init__(self, connection, **kwargs):
+        CachingClient.__init__(self, connection, **kwargs)
 
 #    def connect(self, host, port = 4894, user = "", localbind=None):
 #        CachingClient.connect(self, host, port, user, localbind)
@@ -441,6 +1103,12 @@ class CachingPersonClient(CachingClient):
         
         # Caches
         self._memberships = Cache(self._fetch_membership, "Membership")
+        # Memberships with read ranges for the current person. Our own
+        # mark-as-read and mark-as-unread calls are applied to the
+        # cached read ranges, everything else that may change them
+        # invalidates the membership.
+        self._memberships_with_read_ranges = Cache(
+            self._fetch_membership_with_read_ranges, "MembershipWithReadRanges")
         
         # Specific membership cache where the keys are the positions
         # in the membership list for the membership, and the values
@@ -448,25 +1116,101 @@ class CachingPersonClient(CachingClient):
         # - you can modify positions and we currently have no way of
         # detecting that (no async messages).
         self._memberships_by_position = dict()
+        # Reverse index for _memberships_by_position: conf_no to
+        # position. Also includes stale positions.
+        self._membership_positions = dict()
+        # Positions where we know the conference, but the membership
+        # itself is invalid (position to conf_no).
+        self._stale_membership_positions = dict()
+        # Conferences that we have added ourselves, and therefore
+        # will handle the new-membership async message for.
+        self._own_new_memberships = set()
+        # Protects the three position dicts above. The generation is
+        # increased on every change, so a membership list that was
+        # fetched before a change isn't stored.
+        self._memberships_lock = threading.RLock()
+        self._membership_positions_generation = 0
+        # Estimated size of each membership in
+        # _memberships_by_position (by conf_no), and the total
+        self._membership_sizes = dict()
+        self._membership_bytes = 0
+        # Number of our own add-member requests in progress. Positions
+        # fetched meanwhile may already include the change, which is
+        # then applied locally once more, so they aren't stored.
+        self._add_members_in_progress = 0
+
+        # Unread texts per conference for the current person
+        self._unread_tracker = UnreadTracker()
+
+        # The conferences that (may) have unread texts for the current
+        # person (from get-unread-confs), or None if not cached. It
+        # may contain conferences without unread texts, just like the
+        # response from the server.
+        self._unread_conf_nos = None
+        self._unread_conf_nos_lock = threading.RLock()
+        self._unread_conf_nos_generation = 0
 
         # Setup up async handlers for invalidating cache entries. Skip
         # sending accept-async until the last call.
         self._add_async_handler(AsyncMessages.LEAVE_CONF, self._cpah_leave_conf)
         self._add_async_handler(AsyncMessages.NEW_MEMBERSHIP, self._cpah_new_membership)
+        self._add_async_handler(AsyncMessages.NEW_TEXT, self._cpah_new_text)
+        self._add_async_handler(AsyncMessages.NEW_RECIPIENT, self._cpah_new_recipient)
+        self._add_async_handler(AsyncMessages.SUB_RECIPIENT, self._cpah_sub_recipient)
+        self._add_async_handler(AsyncMessages.DELETED_TEXT, self._cpah_deleted_text)
         self.request(requests.ReqAcceptAsync(list(self._async_handlers.keys())))
 
-    def login(self, pers_no, password):
+    def login(self, pers_no, password, warmup=False):
+        """Log in.
+
+        @param warmup If True, prefetch the memberships, the
+        uconferences for all memberships and the unread conferences
+        for the person, so that they can be served from the caches
+        directly after login.
+        """
         self.request(requests.ReqLogin(pers_no, password, invisible=0))
         # We need to know the current person to be able to have and
         # invalidate caches.
         self._pers_no = pers_no
+        # We may have missed new-user-area messages for the person
+        # before we were logged in as it.
+        self.persons.invalidate(pers_no)
+        if warmup:
+            self._warmup()
+
+    def _warmup(self):
+        start = time.time()
+        positions_generation = self._membership_positions_generation
+        memberships_generation = self._memberships.generation
+        unread_conf_nos_generation = self._unread_conf_nos_generation
+        # The uconference requests depend on the memberships, so this
+        # takes two pipelined bursts.
+        memberships, unread_conf_nos = self.request_many([
+            requests.ReqGetMembership11(self._pers_no, 0, self.WARMUP_MEMBERSHIPS, 0, 0),
+            requests.ReqGetUnreadConfs(self._pers_no) ])
+        self._update_cached_memberships_by_position(memberships, positions_generation)
+        for m in memberships:
+            self._memberships.store(m.conference, m, memberships_generation)
+        self._set_unread_conf_nos(unread_conf_nos, unread_conf_nos_generation)
+        self._prefetch(self.uconferences, [ m.conference for m in memberships ],
+                       requests.ReqGetUconfStat)
+        # Read ranges for the unread conferences, so the unread
+        # tracker doesn't need to fetch them one at a time.
+        self._prefetch(self._memberships_with_read_ranges, unread_conf_nos,
+                       lambda conf_no: requests.ReqQueryReadTexts11(
+                           self._pers_no, conf_no, 1, 0))
+        stats.set('clients.warmups.last', 1, agg='sum')
+        stats.set('clients.warmups.time.last', time.time() - start, agg='last')
 
     def logout(self):
         self.request(requests.ReqLogout())
         # Invalidate caches that are/were for the current person
         self._pers_no = 0
-        self._memberships_by_position = dict()
+        self._clear_membership_positions()
         self._memberships.invalidate_all()
+        self._memberships_with_read_ranges.invalidate_all()
+        self._unread_tracker.forget_all()
+        self._invalidate_unread_conf_nos()
 
     def get_person_no(self):
         return self._pers_no
@@ -485,53 +1229,446 @@ class CachingPersonClient(CachingClient):
         self._current_conference_no = conf_no
         if prev_conf_no != 0:
             self._invalidate_membership(prev_conf_no)
+            self._memberships_with_read_ranges.invalidate(prev_conf_no)
 
     def mark_as_read_local(self, conf_no, local_text_no):
-        try:
-            self.request(requests.ReqMarkAsRead(conf_no, [local_text_no]))
-        except NotMember:
-            pass
+        self.mark_as_read_locals({ conf_no: [ local_text_no ] })
+
+    def mark_as_read_locals(self, local_text_nos):
+        """Mark texts as read, with one request per conference. The
+        requests are sent in one pipelined burst. Conferences that we
+        are not members of are skipped; other errors are raised after
+        all responses have been read.
+
+        @param local_text_nos Dict from conference number to a list
+        of local text numbers in that conference.
+        """
+        conf_nos = list(local_text_nos.keys())
+        local_nos_per_conf = [ sorted(set(local_text_nos[conf_no])) for conf_no in conf_nos ]
+        responses = self.request_many(
+            [ requests.ReqMarkAsRead(conf_no, local_nos)
+              for conf_no, local_nos in zip(conf_nos, local_nos_per_conf) ],
+            return_exceptions=True)
+        error = None
+        for conf_no, local_nos, resp in zip(conf_nos, local_nos_per_conf, responses):
+            if isinstance(resp, ServerError):
+                # We don't know what was marked
+                self._memberships_with_read_ranges.invalidate(conf_no)
+                self._unread_tracker.forget(conf_no)
+                if error is None and not isinstance(resp, NotMember):
+                    error = resp
+                continue
+            def mark_read(read_ranges, local_nos=local_nos):
+                for local_no in local_nos:
+                    read_ranges.mark_read(local_no)
+            self._update_cached_read_ranges(conf_no, mark_read)
+            for local_no in local_nos:
+                self._unread_tracker.remove(conf_no, local_no)
+            self._remove_unread_conf_if_all_read(conf_no)
+        if error is not None:
+            raise error
 
     def mark_as_unread_local(self, conf_no, local_text_no):
         try:
             self.request(requests.ReqMarkAsUnread(conf_no, local_text_no))
         except NotMember:
+            self._memberships_with_read_ranges.invalidate(conf_no)
+        else:
+            self._update_cached_read_ranges(
+                conf_no, lambda read_ranges: read_ranges.mark_unread(local_text_no))
+            if conf_no in self._unread_tracker:
+                text_no = self._get_local_to_global_map(conf_no).get(local_text_no)
+                if text_no is None:
+                    self._unread_tracker.forget(conf_no)
+                else:
+                    self._unread_tracker.add(conf_no, local_text_no, text_no)
+            self._add_unread_conf(conf_no)
+
+    def set_unread(self, conf_no, no_of_unread):
+        self.request(requests.ReqSetUnread(conf_no, no_of_unread))
+        self._memberships_with_read_ranges.invalidate(conf_no)
+        self._unread_tracker.forget(conf_no)
+        self._invalidate_unread_conf_nos()
+
+    def set_read_ranges(self, conf_no, read_ranges):
+        """Replace the read ranges for a conference with one request.
+
+        @param read_ranges A ReadRangeSet (or anything ReadRangeSet
+        accepts), for example one that has been updated locally.
+        """
+        read_ranges = ReadRangeSet(read_ranges)
+        try:
+            self.request(requests.ReqSetReadRanges(conf_no, read_ranges))
+        except ServerError:
+            self._memberships_with_read_ranges.invalidate(conf_no)
+            raise
+        def set_read_ranges(membership):
+            membership.read_ranges = read_ranges
+        self._memberships_with_read_ranges.update(conf_no, set_read_ranges)
+        self._unread_tracker.forget(conf_no)
+        self._invalidate_unread_conf_nos()
+
+    def _update_cached_read_ranges(self, conf_no, update):
+        """Update the read ranges of the cached membership for
+        conf_no, if any, with update(read_ranges).
+        """
+        def update_membership(membership):
+            # Copy on write, so other threads never see a half
+            # updated set
+            read_ranges = ReadRangeSet(membership.read_ranges)
+            update(read_ranges)
+            membership.read_ranges = read_ranges
+        self._memberships_with_read_ranges.update(conf_no, update_membership)
+
+    def get_unread_texts(self, pers_no, conf_no):
+        """Get the global numbers of the unread texts in a conference
+        for a person.
+
+        For the current person, the unread texts are computed once and
+        then kept up to date locally, so this is normally served from
+        memory.
+        """
+        if pers_no != self._pers_no:
+            membership = self.request(requests.ReqQueryReadTexts(pers_no, conf_no, 1, 0))
+            return self.get_unread_texts_from_membership(membership)
+        try:
+            return self._unread_tracker.unread_texts(conf_no)
+        except KeyError:
             pass
+        generation = self._unread_tracker.generation
+        membership = self._memberships_with_read_ranges[conf_no]
+        local_texts = self._get_unread_local_texts(membership)
+        if self._unread_tracker.set_unread_texts(conf_no, local_texts, generation):
+            return self._unread_tracker.unread_texts(conf_no)
+        # Something changed while we computed, so we don't know if
+        # the result is current. Good enough for this call though.
+        return [ text_no for _, text_no in local_texts ]
+
+    def get_unread_texts_many(self, pers_no, conf_nos):
+        """Like get_unread_texts, but for several conferences. The
+        memberships and uconferences that are not cached are fetched
+        in one pipelined burst, and the missing parts of the local to
+        global mappings in a second one. Conferences whose membership
+        can't be fetched (for example because the person is no longer
+        a member) are left out.
+
+        @return Dict from conference number to the list of global
+        numbers of its unread texts.
+        """
+        unread = {}
+        is_current_person = pers_no == self._pers_no
+        if is_current_person:
+            generation = self._unread_tracker.generation
+            missing = []
+            for conf_no in conf_nos:
+                try:
+                    unread[conf_no] = self._unread_tracker.unread_texts(conf_no)
+                except KeyError:
+                    missing.append(conf_no)
+            memberships_cache = self._memberships_with_read_ranges
+            make_membership_request = lambda conf_no: requests.ReqQueryReadTexts11(
+                self._pers_no, conf_no, 1, 0)
+        else:
+            missing = list(conf_nos)
+            memberships_cache = None
+            make_membership_request = lambda conf_no: requests.ReqQueryReadTexts(
+                pers_no, conf_no, 1, 0)
+        if len(missing) == 0:
+            return unread
+
+        wanted = []
+        for conf_no in missing:
+            wanted.append((memberships_cache, conf_no, make_membership_request))
+            wanted.append((self.uconferences, conf_no, requests.ReqGetUconfStat))
+        values = self._get_many(wanted, return_exceptions=True)
+
+        gaps = {}
+        for conf_no, membership, uconf in zip(missing, values[0::2], values[1::2]):
+            if isinstance(membership, ServerError) or isinstance(uconf, ServerError):
+                continue
+            gaps[conf_no] = self._get_unread_gaps(membership)
+
+        gaps = self._fetch_unread_local_to_global(gaps)
+        for conf_no, conf_gaps in gaps.items():
+            local_texts = self._local_texts_in_gaps(
+                self._get_local_to_global_map(conf_no), conf_gaps)
+            if is_current_person and self._unread_tracker.set_unread_texts(
+                    conf_no, local_texts, generation):
+                unread[conf_no] = self._unread_tracker.unread_texts(conf_no)
+            else:
+                unread[conf_no] = [ text_no for _, text_no in local_texts ]
+        return unread
+
+    def get_memberships_in_confs(self, pers_no, conf_nos):
+        """Get the memberships (without read ranges) of a person in
+        several conferences. The ones that are not cached are fetched
+        in one pipelined burst. The first error is raised after all
+        responses have been read.
+        """
+        if pers_no == self._pers_no:
+            return self._get_many([ (self._memberships, conf_no,
+                                     lambda conf_no: requests.ReqQueryReadTexts11(
+                                         self._pers_no, conf_no, 0, 0))
+                                    for conf_no in conf_nos ])
+        return self.request_many([ requests.ReqQueryReadTexts(pers_no, conf_no, 0, 0)
+                                   for conf_no in conf_nos ])
+
+    def get_unread_conf_nos(self, pers_no):
+        """Get the conferences that may have unread texts for a
+        person.
+        """
+        if pers_no != self._pers_no:
+            return self.request(requests.ReqGetUnreadConfs(pers_no))
+        with self._unread_conf_nos_lock:
+            if self._unread_conf_nos is not None:
+                return list(self._unread_conf_nos)
+            generation = self._unread_conf_nos_generation
+        unread_conf_nos = self.request(requests.ReqGetUnreadConfs(pers_no))
+        self._set_unread_conf_nos(unread_conf_nos, generation)
+        return list(unread_conf_nos)
+
+    def _set_unread_conf_nos(self, unread_conf_nos, generation):
+        with self._unread_conf_nos_lock:
+            if generation == self._unread_conf_nos_generation:
+                self._unread_conf_nos = list(unread_conf_nos)
+
+    def _invalidate_unread_conf_nos(self):
+        with self._unread_conf_nos_lock:
+            self._unread_conf_nos_generation += 1
+            self._unread_conf_nos = None
+
+    def _add_unread_conf(self, conf_no):
+        with self._unread_conf_nos_lock:
+            self._unread_conf_nos_generation += 1
+            if self._unread_conf_nos is not None and conf_no not in self._unread_conf_nos:
+                self._unread_conf_nos.append(conf_no)
+
+    def _remove_unread_conf_if_all_read(self, conf_no):
+        # The cached unread conferences may contain conferences
+        # without unread texts, so conferences that we don't track
+        # the unread texts for are kept. The lock is held while
+        # checking, so a new text that the async handler adds to the
+        # tracker meanwhile (before it adds the conference) makes it
+        # add the conference back after we removed it.
+        with self._unread_conf_nos_lock:
+            if self._unread_tracker.no_of_unread(conf_no) == 0:
+                self._remove_unread_conf(conf_no)
+
+    def _remove_unread_conf(self, conf_no):
+        with self._unread_conf_nos_lock:
+            self._unread_conf_nos_generation += 1
+            if self._unread_conf_nos is not None and conf_no in self._unread_conf_nos:
+                self._unread_conf_nos.remove(conf_no)
+
+    def add_membership(self, pers_no, conf_no, priority, where, membership_type):
+        """Add a membership, or change the priority and position of an
+        existing one.
+        """
+        if pers_no != self._pers_no:
+            self.request(requests.ReqAddMember(conf_no, pers_no, priority, where,
+                                               membership_type))
+            return
+
+        with self._memberships_lock:
+            # Positions fetched from now on may include the change
+            self._new_membership_positions_generation()
+            self._add_members_in_progress += 1
+            self._own_new_memberships.add(conf_no)
+        try:
+            self.request(requests.ReqAddMember(conf_no, pers_no, priority, where,
+                                               membership_type))
+        except Exception:
+            with self._memberships_lock:
+                self._add_members_in_progress -= 1
+                self._own_new_memberships.discard(conf_no)
+            raise
+        with self._memberships_lock:
+            self._add_members_in_progress -= 1
+            # The server sends the new-membership message before the
+            # reply, and doesn't send it at all when an existing
+            # membership is only moved, so stop waiting for it.
+            self._own_new_memberships.discard(conf_no)
+            moved = self._memberships.peek(conf_no) is not None
+            self._memberships.invalidate(conf_no)
+            if conf_no in self._membership_positions:
+                # Existing membership that is moved
+                self._remove_membership_position(conf_no)
+            elif moved:
+                # Moved, but we don't know from where
+                self._clear_membership_positions()
+                return
+            # The server puts memberships with a too large position
+            # last, in which case shifting doesn't change anything.
+            self._shift_membership_positions(where, 1)
 
     def _get_cached_memberships_by_position(self, first, no_of_confs):
         # Return a list of the cached memberships if we have all of
         # them, otherwise return None. We only return memberships if
-        # we had all of them.
-        memberships = []
-        for pos in range(first, first + no_of_confs):
-            if pos not in self._memberships_by_position:
+        # we had all of them. Stale memberships are refetched (with
+        # one pipelined burst) if we know their conferences.
+        with self._memberships_lock:
+            stale_conf_nos = []
+            for pos in range(first, first + no_of_confs):
+                if pos not in self._memberships_by_position:
+                    if pos not in self._stale_membership_positions:
+                        return None
+                    stale_conf_nos.append(self._stale_membership_positions[pos])
+            if len(stale_conf_nos) == 0:
+                return [ self._memberships_by_position[pos]
+                         for pos in range(first, first + no_of_confs) ]
+            generation = self._membership_positions_generation
+
+        # Never send requests while holding the lock
+        self._prefetch(self._memberships, stale_conf_nos,
+                       lambda conf_no: requests.ReqQueryReadTexts11(
+                           self._pers_no, conf_no, 0, 0))
+
+        with self._memberships_lock:
+            if generation != self._membership_positions_generation:
+                # Changed while we fetched
                 return None
-            memberships.append(self._memberships_by_position[pos])
-        return memberships
+            for conf_no in stale_conf_nos:
+                expected_pos = self._membership_positions[conf_no]
+                m = self._memberships.peek(conf_no)
+                if m is None or m.position != expected_pos:
+                    # Positions have changed without us knowing
+                    self._clear_membership_positions()
+                    return None
+                self._set_membership_position(m)
+            return [ self._memberships_by_position[pos]
+                     for pos in range(first, first + no_of_confs) ]
+
+    def _update_cached_memberships_by_position(self, memberships, generation):
+        """Cache the positions of memberships, unless the positions
+        have changed after generation was taken (before they were
+        fetched).
+        """
+        with self._memberships_lock:
+            if (generation != self._membership_positions_generation or
+                    self._add_members_in_progress > 0):
+                return
+            for m in memberships:
+                self._set_membership_position(m)
+
+    def _new_membership_positions_generation(self):
+        # Must be called with the memberships lock held
+        self._membership_positions_generation += 1
+
+    def _set_membership_position(self, m):
+        # Must be called with the memberships lock held
+        old_pos = self._membership_positions.get(m.conference)
+        if old_pos is not None and old_pos != m.position:
+            self._memberships_by_position.pop(old_pos, None)
+            self._stale_membership_positions.pop(old_pos, None)
+        old_m = self._memberships_by_position.get(m.position)
+        if old_m is not None and old_m.conference != m.conference:
+            del self._membership_positions[old_m.conference]
+            self._set_membership_size(old_m.conference, None)
+        old_conf_no = self._stale_membership_positions.pop(m.position, None)
+        if old_conf_no is not None and old_conf_no != m.conference:
+            del self._membership_positions[old_conf_no]
+        self._memberships_by_position[m.position] = m
+        self._membership_positions[m.conference] = m.position
+        self._set_membership_size(m.conference, m)
+
+    def _set_membership_size(self, conf_no, m):
+        # Must be called with the memberships lock held. Measures the
+        # membership (or with None, forgets it) for cache_info().
+        size = 0 if m is None else estimate_size(m)
+        self._membership_bytes += size - self._membership_sizes.pop(conf_no, 0)
+        if m is not None:
+            self._membership_sizes[conf_no] = size
 
-    def _update_cached_memberships_by_position(self, memberships):
-        for m in memberships:
-            self._memberships_by_position[m.position] = m
-    
     def _invalidate_membership(self, conf_no):
         self._memberships.invalidate(conf_no)
         # Since we only return anything from memberships_by_position
         # if all memberships are found, it means that we can make
-        # partial invalidations.
-        found_at = None
-        for pos in self._memberships_by_position:
-            if self._memberships_by_position[pos].conference == conf_no:
-                found_at = pos
-                break
-        if found_at is not None:
-            del self._memberships_by_position[found_at]
+        # partial invalidations. We keep the position, so the
+        # membership can be refetched on its own.
+        with self._memberships_lock:
+            self._new_membership_positions_generation()
+            pos = self._membership_positions.get(conf_no)
+            if pos is not None and pos in self._memberships_by_position:
+                del self._memberships_by_position[pos]
+                self._stale_membership_positions[pos] = conf_no
+                self._set_membership_size(conf_no, None)
+
+    def _remove_membership_position(self, conf_no):
+        """Remove a membership and move the memberships after it one
+        position up.
+        """
+        with self._memberships_lock:
+            self._new_membership_positions_generation()
+            pos = self._membership_positions.pop(conf_no, None)
+            if pos is None:
+                # We don't know which positions that changed
+                self._clear_membership_positions()
+                return
+            self._memberships_by_position.pop(pos, None)
+            self._stale_membership_positions.pop(pos, None)
+            self._set_membership_size(conf_no, None)
+            self._shift_membership_positions(pos + 1, -1)
+
+    def _shift_membership_positions(self, first, delta):
+        """Add delta to all membership positions from first and
+        onwards.
+        """
+        with self._memberships_lock:
+            self._new_membership_positions_generation()
+            by_position = dict()
+            stale = dict()
+            for pos, m in self._memberships_by_position.items():
+                if pos >= first:
+                    pos += delta
+                    m.position = pos
+                    def set_position(cached_m, pos=pos):
+                        cached_m.position = pos
+                    self._memberships.update(m.conference, set_position)
+                    self._memberships_with_read_ranges.update(m.conference, set_position)
+                    self._membership_positions[m.conference] = pos
+                by_position[pos] = m
+            for pos, conf_no in self._stale_membership_positions.items():
+                if pos >= first:
+                    pos += delta
+                    self._membership_positions[conf_no] = pos
+                stale[pos] = conf_no
+            self._memberships_by_position = by_position
+            self._stale_membership_positions = stale
+
+    def _clear_membership_positions(self):
+        with self._memberships_lock:
+            self._new_membership_positions_generation()
+            self._memberships_by_position = dict()
+            self._membership_positions = dict()
+            self._stale_membership_positions = dict()
+            self._membership_sizes = dict()
+            self._membership_bytes = 0
     
     def get_memberships(self, pers_no, first, no_of_confs, want_read_ranges=False):
         """Get memberships for a person.
+
+        For the current person, memberships with read ranges are
+        served from the cached positions and read ranges when all of
+        them are known. Otherwise they are fetched with one request,
+        and their read ranges are cached.
         """
         if want_read_ranges:
+            if pers_no == self._pers_no:
+                memberships = self._get_cached_memberships_with_read_ranges(
+                    first, no_of_confs)
+                if memberships is None:
+                    generation = self._memberships_with_read_ranges.generation
+                    positions_generation = self._membership_positions_generation
+                    memberships = self.request(
+                        requests.ReqGetMembership11(pers_no, first, no_of_confs, 1, 0))
+                    for m in memberships:
+                        self._memberships_with_read_ranges.store(m.conference, m, generation)
+                    self._update_cached_memberships_by_position(
+                        [ _without_read_ranges(m) for m in memberships ],
+                        positions_generation)
+                return memberships
             return self.request(
-                requests.ReqGetMembership11(pers_no, 0, no_of_confs, 1, 0))
+                requests.ReqGetMembership11(pers_no, first, no_of_confs, 1, 0))
         else:
             if pers_no == self._pers_no:
                 # We cache the result for the current person and without
@@ -539,19 +1676,50 @@ class CachingPersonClient(CachingClient):
                 # correctly.
                 memberships = self._get_cached_memberships_by_position(first, no_of_confs)
                 if memberships is None:
+                    generation = self._membership_positions_generation
                     memberships = self.request(
                         requests.ReqGetMembership11(
                             self._pers_no, first, no_of_confs, 0, 0))
-                    self._update_cached_memberships_by_position(memberships)
+                    self._update_cached_memberships_by_position(memberships, generation)
                 return memberships
             else:
                 return self.request(
-                    requests.ReqGetMembership11(pers_no, 0, no_of_confs, 0, 0))
+                    requests.ReqGetMembership11(pers_no, first, no_of_confs, 0, 0))
+
+    def _get_cached_memberships_with_read_ranges(self, first, no_of_confs):
+        # Return the memberships with read ranges if we know the
+        # conferences at all positions, otherwise None. Read ranges
+        # that aren't cached are fetched with one pipelined burst.
+        with self._memberships_lock:
+            conf_nos = []
+            for pos in range(first, first + no_of_confs):
+                if pos in self._memberships_by_position:
+                    conf_nos.append(self._memberships_by_position[pos].conference)
+                elif pos in self._stale_membership_positions:
+                    conf_nos.append(self._stale_membership_positions[pos])
+                else:
+                    return None
+        for pos, conf_no in enumerate(conf_nos, first):
+            m = self._memberships_with_read_ranges.peek(conf_no)
+            if m is not None and m.position != pos:
+                # Moved without us knowing
+                self._memberships_with_read_ranges.invalidate(conf_no)
+        memberships = self._get_many(
+            [ (self._memberships_with_read_ranges, conf_no,
+               lambda conf_no: requests.ReqQueryReadTexts11(self._pers_no, conf_no, 1, 0))
+              for conf_no in conf_nos ], return_exceptions=True)
+        for pos, m in enumerate(memberships, first):
+            if isinstance(m, ServerError) or m.position != pos:
+                # The memberships have changed meanwhile
+                return None
+        return memberships
 
     def get_membership(self, pers_no, conf_no, want_read_ranges=False):
         """Get a membership for a person
         """
         if want_read_ranges:
+            if pers_no == self._pers_no:
+                return self._memberships_with_read_ranges[conf_no]
             return self.request(requests.ReqQueryReadTexts(pers_no, conf_no, 1, 0))
         else:
             if pers_no == self._pers_no:
@@ -567,69 +1735,869 @@ class CachingPersonClient(CachingClient):
         """
         # We can only cache memberships for the currently logged in
         # person, because we don't receive async leave/join messages
-        # for other persons. We also only cache memberships without
-        # read ranges, because it is easier to invalidate correctly.
+        # for other persons. Memberships with read ranges are cached
+        # separately (see _memberships_with_read_ranges), because they
+        # change whenever a text is marked as read.
         return self.request(requests.ReqQueryReadTexts11(self._pers_no, conf_no, 0, 0))
+
+    def _fetch_membership_with_read_ranges(self, conf_no):
+        """Fetch the membership with read ranges for a conf for the
+        current person.
+        """
+        return self.request(requests.ReqQueryReadTexts11(self._pers_no, conf_no, 1, 0))
     
     # Handlers for asynchronous messages (internal use)
     def _cpah_leave_conf(self, msg):
         # Invalidates cached membership
         self._memberships.invalidate(msg.conf_no)
-        # We invalidate the entire memberships_by_position because you
-        # can change position of memberships.
-        self._memberships_by_position = dict()
+        self._memberships_with_read_ranges.invalidate(msg.conf_no)
+        self._unread_tracker.forget(msg.conf_no)
+        self._remove_unread_conf(msg.conf_no)
+        # The memberships after the removed one move one position up
+        self._remove_membership_position(msg.conf_no)
 
     def _cpah_new_membership(self, msg):
-        # Invalidates self._memberships_by_position
-        self._memberships_by_position = dict()
+        if (msg.person_no == self._pers_no and
+                msg.conf_no in self._own_new_memberships):
+            # Positions are updated by add_membership. Positions
+            # fetched before this message don't include the new
+            # membership, but they may be stored after the update.
+            with self._memberships_lock:
+                self._own_new_memberships.discard(msg.conf_no)
+                self._new_membership_positions_generation()
+        else:
+            # We don't know the position of the new membership
+            self._clear_membership_positions()
+        # Re-joining a conference may keep the old read ranges, so
+        # don't trust anything we had.
+        self._memberships_with_read_ranges.invalidate(msg.conf_no)
+        self._unread_tracker.forget(msg.conf_no)
         # The self.memberships cache can only cache actual
         # memberships, and because we get this async messages, we know
         # the current person was not a member before.
+        self._invalidate_unread_conf_nos()
+
+    def _cpah_new_text(self, msg):
+        if msg.text_stat.author == self._pers_no:
+            # Our own texts are marked as read by the server
+            for rcpt in msg.text_stat.misc_info.recipient_list:
+                if rcpt.loc_no is None:
+                    self._memberships_with_read_ranges.invalidate(rcpt.recpt)
+                else:
+                    self._update_cached_read_ranges(
+                        rcpt.recpt, lambda read_ranges: read_ranges.mark_read(rcpt.loc_no))
+            return
+        for rcpt in msg.text_stat.misc_info.recipient_list:
+            if rcpt.loc_no is None:
+                self._unread_tracker.forget(rcpt.recpt)
+            else:
+                self._unread_tracker.add(rcpt.recpt, rcpt.loc_no, msg.text_no)
+            self._new_text_in_conf(rcpt.recpt)
 
-    # Report cache usage
-    def report_cache_usage(self):
-        CachingClient.report_cache_usage(self)
-        self._memberships.report()
+    def _cpah_new_recipient(self, msg):
+        # We don't get the local number
+        self._unread_tracker.forget(msg.conf_no)
+        self._new_text_in_conf(msg.conf_no)
+
+    def _cpah_sub_recipient(self, msg):
+        self._unread_tracker.remove_text(msg.conf_no, msg.text_no)
+
+    def _cpah_deleted_text(self, msg):
+        for rcpt in msg.text_stat.misc_info.recipient_list:
+            if rcpt.loc_no is None:
+                self._unread_tracker.remove_text(rcpt.recpt, msg.text_no)
+            else:
+                self._unread_tracker.remove(rcpt.recpt, rcpt.loc_no)
+
+    def _new_text_in_conf(self, conf_no):
+        membership = self._memberships.peek(conf_no)
+        if membership is not None:
+            if not membership.type.passive:
+                self._add_unread_conf(conf_no)
+        elif self._pers_no != 0:
+            # We don't know if we are a member or not
+            self._invalidate_unread_conf_nos()
+
+    def _caches(self):
+        return CachingClient._caches(self) + [
+            self._memberships, self._memberships_with_read_ranges ]
+
+    def _other_caches_info(self):
+        info = CachingClient._other_caches_info(self)
+        with self._memberships_lock:
+            # The memberships are measured when they are set, the
+            # conf_no to position index is counted
+            entries = len(self._membership_positions)
+            info['MembershipPosition'] = dict(
+                entries=entries,
+                bytes=self._membership_bytes + 2 * _INT_SIZE * entries)
+        info['UnreadTexts'] = self._unread_tracker.info()
+        with self._unread_conf_nos_lock:
+            unread_conf_nos = self._unread_conf_nos or []
+            info['UnreadConf'] = dict(
+                entries=len(unread_conf_nos),
+                bytes=(sys.getsizeof(unread_conf_nos) + _INT_SIZE * len(unread_conf_nos)
+                       if unread_conf_nos else 0))
+        return info
+
+    def clear_caches(self):
+        CachingClient.clear_caches(self)
+        self._clear_membership_positions()
+        self._unread_tracker.forget_all()
+        self._invalidate_unread_conf_nos()
+
+
+def _without_read_ranges(membership):
+    return Membership11(membership.position, membership.last_time_read,
+                        membership.conference, membership.priority, None,
+                        membership.added_by, membership.added_at, membership.type)
+
+
+def estimate_size(obj):
+    """Estimate the memory used by obj and all objects it refers to,
+    in bytes. Objects that are referred to several times are only
+    counted once. None and booleans are shared, and not counted.
+    """
+    seen = set()
+    size = 0
+    pending = [obj]
+    while pending:
+        o = pending.pop()
+        if o is None or isinstance(o, bool) or id(o) in seen:
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, (six.binary_type, six.text_type) + six.integer_types + (float, array)):
+            continue
+        if isinstance(o, dict):
+            pending.extend(o.keys())
+            pending.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            pending.extend(o)
+        elif hasattr(o, '__dict__') and not isinstance(o, type):
+            pending.append(o.__dict__)
+    return size
+
+
+# Estimated size of an int in the cached structures that count their
+# entries instead of measuring them.
+_INT_SIZE = sys.getsizeof(1 << 20)
+
+
+class _SizeAccount(object):
+    """Running totals of the number of entries and the estimated
+    bytes in a cached structure that isn't a Cache, for
+    CachingClient.cache_info(). The structure adds the changes when it
+    changes, so reading the totals is cheap.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.entries = 0
+        self.bytes = 0
+
+    def add(self, entries, size):
+        with self._lock:
+            self.entries += entries
+            self.bytes += size
+
+    def info(self):
+        with self._lock:
+            return dict(entries=self.entries, bytes=self.bytes)
 
 
 # Cache class for use internally by CachingClient
 class Cache(object):
-    def __init__(self, fetcher, name = "Unknown"):
+    """Dictionary like cache that fetches missing entries.
+
+    The cache can be used from several threads. Gets of cached
+    entries don't lock, everything that changes the cache does. The
+    fetcher and refresher are always called without holding the lock,
+    so async handlers (which may run while another thread waits for a
+    response) can always invalidate entries.
+
+    The memory used by the cached (and stale) values is estimated
+    with sizeof when they are set, and reported by info() and as
+    stats. Values that are changed in place after peek() aren't
+    measured again, but changes through update() are.
+    """
+    # Max number of invalidations to remember for fetches in progress
+    MAX_INVALIDATED_AT = 1024
+
+    def __init__(self, fetcher, name = "Unknown", refresher=None,
+                 sizeof=estimate_size):
+        """
+        @param refresher Function that takes a key and a callback,
+        and fetches the value for the key in the background. When
+        given, invalidated entries are kept as stale values that are
+        returned while the refresh is in progress
+        (stale-while-revalidate). The callback should be called with
+        the value and None, or None and the error.
+
+        @param sizeof Function that returns the size of a value in
+        bytes.
+        """
         self.dict = {}
         self.fetcher = fetcher
+        self.refresher = refresher
         self.cached = 0
         self.uncached = 0
         self.name = name
+        self._lock = threading.RLock()
+        # Generation counter, increased on every invalidation. Used by
+        # store() to detect values that were fetched before an
+        # invalidation.
+        self._generation = 0
+        # Key to the generation of its last invalidation
+        self._invalidated_at = {}
+        self._all_invalidated_at = 0
+        # Stale entries are kept outside self.dict, so the hit path
+        # doesn't have to check for them.
+        self._stale = {}
+        self._refreshing = set()
+        # Entries that were invalidated again while being refreshed
+        self._refresh_again = set()
+        # The counters are looked up once, so the get path only does
+        # integer increments. Gets are the sum of hits and misses.
+        self._hits = self._counter('gets.hits')
+        self._misses = self._counter('gets.misses')
+        stats.counter_sum('clients.cache.{}.gets.last'.format(self.name),
+                          [self._hits, self._misses])
+        self._sets = self._counter('sets')
+        self._invalidations = self._counter('invalidations')
+        self._invalidate_alls = self._counter('invalidate-alls')
+        self._stale_hits = self._counter('gets.stale-hits')
+        # Size of each value, and the total. The gauges of all caches
+        # with the same name are summed in the stats.
+        self.sizeof = sizeof
+        self._sizes = {}
+        self._bytes = 0
+        self._bytes_gauge = stats.gauge('clients.cache.{}.bytes.last'.format(self.name))
+        self._entries_gauge = stats.gauge('clients.cache.{}.entries.last'.format(self.name))
+
+    def _counter(self, metric):
+        return stats.counter('clients.cache.{}.{}.last'.format(self.name, metric))
 
     def __getitem__(self, no):
-        #print('%s[%d]' % (self.name, no))
-        stats.set('clients.cache.{}.gets.last'.format(self.name), 1, agg='sum')
-        if no in self.dict:
-            #print('%s[%d] - cached' % (self.name, no))
-            self.cached = self.cached + 1
-            stats.set('clients.cache.{}.gets.hits.last'.format(self.name), 1, agg='sum')
-            return self.dict[no]
-        else:
-            #print('%s[%d] - not cached' % (self.name, no))
-            self.uncached = self.uncached + 1
-            stats.set('clients.cache.{}.gets.misses.last'.format(self.name), 1, agg='sum')
-            self[no] = self.fetcher(no)
-            return self.dict[no]
+        # The hit path doesn't take the lock; a dict lookup is atomic.
+        try:
+            val = self.dict[no]
+        except KeyError:
+            if no in self._stale:
+                with self._lock:
+                    stale = no in self._stale
+                    if stale:
+                        self._stale_hits.value += 1
+                        val = self._stale[no]
+                        refresh = self._start_refresh(no)
+                if stale:
+                    if refresh:
+                        self.refresher(no, self._refreshed_callback(no))
+                    return val
+            self.uncached += 1
+            self._misses.value += 1
+            generation = self._generation
+            val = self.fetcher(no)
+            self.store(no, val, generation)
+            return val
+        self.cached += 1
+        self._hits.value += 1
+        return val
 
     def __setitem__(self, no, val):
+        with self._lock:
+            self._set(no, val)
+
+    def _set(self, no, val):
+        # Must be called with the lock held
         self.dict[no] = val
-        stats.set('clients.cache.{}.sets.last'.format(self.name), 1, agg='sum')
+        self._sets.value += 1
+        if no in self._stale:
+            del self._stale[no]
+        self._account(no, self.sizeof(val))
+
+    def _account(self, no, size):
+        # Must be called with the lock held
+        old_size = self._sizes.get(no)
+        if old_size is None:
+            old_size = 0
+            self._entries_gauge.value += 1
+        self._sizes[no] = size
+        self._bytes += size - old_size
+        self._bytes_gauge.value += size - old_size
+
+    def _unaccount(self, no):
+        # Must be called with the lock held
+        size = self._sizes.pop(no, None)
+        if size is not None:
+            self._bytes -= size
+            self._bytes_gauge.value -= size
+            self._entries_gauge.value -= 1
+
+    def _unaccount_all(self):
+        # Must be called with the lock held
+        self._bytes_gauge.value -= self._bytes
+        self._entries_gauge.value -= len(self._sizes)
+        self._sizes = {}
+        self._bytes = 0
+
+    @property
+    def size(self):
+        """Estimated total size in bytes of all cached values."""
+        return self._bytes
+
+    def __len__(self):
+        return len(self.dict)
+
+    @property
+    def generation(self):
+        """The current generation. Take it before fetching a value
+        from the server, and pass it to store().
+        """
+        return self._generation
+
+    def store(self, no, val, generation):
+        """Cache val for no, unless no has been invalidated after
+        generation was taken. That happens when an async message
+        arrives while the value is being fetched, and then the value
+        may already be outdated.
+
+        @return True if the value was cached.
+        """
+        with self._lock:
+            if (self._invalidated_at.get(no, 0) > generation or
+                    self._all_invalidated_at > generation):
+                return False
+            self._set(no, val)
+            return True
+
+    def __contains__(self, no):
+        return no in self.dict
+
+    def peek(self, no):
+        """Return the cached value, or None if it is not cached. Never
+        fetches.
+        """
+        return self.dict.get(no)
+
+    def update(self, no, func):
+        """Update the cached value for no in place, by calling func
+        with it while holding the lock. A value that is being fetched
+        may miss the update, so it is treated as invalidated (and not
+        stored over the updated value).
+        """
+        with self._lock:
+            self._new_generation(no)
+            val = self.dict.get(no)
+            if val is None:
+                if no in self._refreshing:
+                    self._refresh_again.add(no)
+            else:
+                func(val)
+                self._account(no, self.sizeof(val))
+
+    def get_fresh(self, no):
+        """Like cache[no], but never returns a stale value.
+        """
+        with self._lock:
+            if no in self._stale:
+                del self._stale[no]
+                self._unaccount(no)
+        return self[no]
 
     def invalidate(self, no):
-        if no in self.dict:
-            del self.dict[no]
-            stats.set('clients.cache.{}.invalidations.last'.format(self.name), 1, agg='sum')
+        with self._lock:
+            self._new_generation(no)
+            if no in self.dict:
+                val = self.dict.pop(no)
+                self._invalidations.value += 1
+                if self.refresher is not None:
+                    self._stale[no] = val
+                else:
+                    self._unaccount(no)
+            if no in self._refreshing:
+                self._refresh_again.add(no)
 
     def invalidate_all(self):
-        self.dict = dict()
-        stats.set('clients.cache.{}.invalidate-alls.last'.format(self.name), 1, agg='sum')
+        with self._lock:
+            self.clear()
+            self._invalidate_alls.value += 1
+
+    def clear(self):
+        """Remove all entries, like invalidate_all(), but without
+        counting it as an invalidation. Used when the cache is no
+        longer needed.
+        """
+        with self._lock:
+            self._new_generation()
+            self.dict = dict()
+            self._stale = dict()
+            self._unaccount_all()
+
+    def _new_generation(self, no=None):
+        # Must be called with the lock held. Only the invalidations
+        # since the oldest fetch in progress matter, but we don't keep
+        # track of fetches, so when there are too many we forget them
+        # all and treat it as if everything was invalidated.
+        self._generation += 1
+        if no is None or len(self._invalidated_at) >= self.MAX_INVALIDATED_AT:
+            self._invalidated_at = {}
+            self._all_invalidated_at = self._generation
+        else:
+            self._invalidated_at[no] = self._generation
+
+    def _start_refresh(self, no):
+        # Must be called with the lock held. Returns True if the
+        # caller should call the refresher (outside the lock).
+        if no in self._refreshing:
+            return False
+        self._refreshing.add(no)
+        self._refresh_again.discard(no)
+        return True
+
+    def _refreshed_callback(self, no):
+        def refreshed(val, error):
+            with self._lock:
+                self._refreshing.discard(no)
+                if no not in self._stale:
+                    # Invalidated completely or already fetched
+                    return
+                if error is not None:
+                    # Let the next get fetch (and raise) the normal way
+                    del self._stale[no]
+                    self._unaccount(no)
+                    return
+                elif no in self._refresh_again:
+                    # The value may already be outdated
+                    self._stale[no] = val
+                    self._account(no, self.sizeof(val))
+                    refresh = self._start_refresh(no)
+                else:
+                    self._set(no, val)
+                    return
+            if refresh:
+                self.refresher(no, self._refreshed_callback(no))
+        return refreshed
+
+    def info(self):
+        """Return a dict with the number of entries, their estimated
+        size in bytes, and the number of hits and misses.
+        """
+        with self._lock:
+            return dict(entries=len(self.dict),
+                        stale_entries=len(self._stale),
+                        bytes=self._bytes,
+                        hits=self.cached,
+                        misses=self.uncached)
 
     def report(self):
-        print(("Cache %s: %d cached, %d uncached" % (self.name,
-                                                     self.cached,
-                                                     self.uncached)))
+        print(("Cache %s: %d cached, %d uncached, %d bytes" % (self.name,
+                                                               self.cached,
+                                                               self.uncached,
+                                                               self._bytes)))
+
+
+class LocalToGlobalMap(object):
+    """The known part of the mapping from local to global text numbers
+    for a conference.
+
+    The mapping is kept in two sorted arrays, and the ranges of local
+    numbers that we know the complete mapping for are kept as an
+    interval set. Local numbers in a known range that are missing from
+    the arrays don't exist (or can't be read by us).
+
+    The map is updated from async handlers, so all methods lock.
+    """
+    def __init__(self, account=None):
+        """
+        @param account _SizeAccount that the changes of the number of
+        texts and the size of the map are added to.
+        """
+        self._lock = threading.RLock()
+        self._local_nos = array('l')
+        self._text_nos = array('l')
+        # The known local numbers ("read" means known here)
+        self._known = ReadRangeSet()
+        # Increased when texts are removed, see add_fetched()
+        self.generation = 0
+        self._account = account
+        self._entries = 0
+        self._size = 0
+
+    def __len__(self):
+        return len(self._local_nos)
+
+    def size(self):
+        """Return the estimated memory used by the map, in bytes.
+        """
+        return self._size
+
+    def _resized(self):
+        # Must be called with the lock held, after every change. The
+        # arrays are measured without looking at their items.
+        entries = len(self._local_nos)
+        size = (sys.getsizeof(self._local_nos) + sys.getsizeof(self._text_nos) +
+                estimate_size(self._known))
+        if self._account is not None:
+            self._account.add(entries - self._entries, size - self._size)
+        self._entries = entries
+        self._size = size
+
+    def add(self, local_no, text_no):
+        with self._lock:
+            self._add(local_no, text_no)
+            self._known.mark_read(local_no)
+            self._resized()
+
+    def _add(self, local_no, text_no):
+        # Must be called with the lock held
+        i = bisect_left(self._local_nos, local_no)
+        if i < len(self._local_nos) and self._local_nos[i] == local_no:
+            self._text_nos[i] = text_no
+        else:
+            self._local_nos.insert(i, local_no)
+            self._text_nos.insert(i, text_no)
+
+    def add_fetched(self, items, begin, end, generation):
+        """Add (local number, global text number) items fetched from
+        the server for the range begin (inclusive) to end (exclusive),
+        and mark the range as known. Nothing is added if a text has
+        been removed after generation was taken (before the fetch),
+        because then the items may contain removed texts.
+
+        @return True if the items were added.
+        """
+        with self._lock:
+            if self.generation != generation:
+                return False
+            for local_no, text_no in items:
+                self._add(local_no, text_no)
+                self._known.mark_read(local_no)
+            if begin < end:
+                self._known.mark_read(begin, end - 1)
+            self._resized()
+            return True
+
+    def remove(self, local_no):
+        with self._lock:
+            self.generation += 1
+            i = bisect_left(self._local_nos, local_no)
+            if i < len(self._local_nos) and self._local_nos[i] == local_no:
+                del self._local_nos[i]
+                del self._text_nos[i]
+                self._resized()
+
+    def remove_text(self, text_no):
+        with self._lock:
+            self.generation += 1
+            try:
+                i = self._text_nos.index(text_no)
+            except ValueError:
+                return
+            del self._local_nos[i]
+            del self._text_nos[i]
+            self._resized()
+
+    def add_known(self, begin, end):
+        """Mark the range begin (inclusive) to end (exclusive) as
+        completely known.
+        """
+        if begin < end:
+            with self._lock:
+                self._known.mark_read(begin, end - 1)
+                self._resized()
+
+    def unknown(self, begin, end):
+        """Return a list of (begin, end) tuples for the parts of the
+        range begin (inclusive) to end (exclusive) that are not known.
+        """
+        with self._lock:
+            return [ (first, first + length)
+                     for first, length in self._known.gaps(begin, end - 1) ]
+
+    def get(self, local_no):
+        """Return the global number for local_no, or None if it is
+        unknown or doesn't exist.
+        """
+        with self._lock:
+            i = bisect_left(self._local_nos, local_no)
+            if i < len(self._local_nos) and self._local_nos[i] == local_no:
+                return self._text_nos[i]
+            return None
+
+    def text_nos(self, begin, end):
+        """Return the global numbers of the texts with local numbers
+        from begin (inclusive) to end (exclusive).
+        """
+        with self._lock:
+            i = bisect_left(self._local_nos, begin)
+            j = bisect_left(self._local_nos, end)
+            return self._text_nos[i:j].tolist()
+
+    def items(self, begin, end):
+        """Like text_nos, but returns (local number, global number)
+        tuples.
+        """
+        with self._lock:
+            i = bisect_left(self._local_nos, begin)
+            j = bisect_left(self._local_nos, end)
+            return list(zip(self._local_nos[i:j], self._text_nos[i:j]))
+
+
+# Unread texts per conference for the current person. For use
+# internally by CachingPersonClient.
+class UnreadTracker(object):
+    """The unread texts in the conferences we have computed them for,
+    as a mapping from local number to global text number per
+    conference.
+
+    The mappings are computed from the memberships (with read ranges)
+    once, and after that kept up to date by async messages and our own
+    mark-as-read/unread calls. Conferences that we can't update
+    correctly are forgotten, and computed again when asked for.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._unread = {}
+        # Increased on every change, see set_unread_texts()
+        self.generation = 0
+        self._account = _SizeAccount()
+
+    def __contains__(self, conf_no):
+        return conf_no in self._unread
+
+    @staticmethod
+    def _size(unread):
+        # The dict is measured, the ints in it are counted
+        return sys.getsizeof(unread) + 2 * _INT_SIZE * len(unread)
+
+    def _replace(self, conf_no, unread):
+        # Must be called with the lock held. Replaces (or with None,
+        # removes) the unread texts of a conference.
+        old = self._unread.pop(conf_no, None)
+        if old is not None:
+            self._account.add(-len(old), -self._size(old))
+        if unread is not None:
+            self._unread[conf_no] = unread
+            self._account.add(len(unread), self._size(unread))
+
+    def set_unread_texts(self, conf_no, local_texts, generation):
+        """
+        @param local_texts List of (local number, global text number)
+        tuples for the unread texts in the conference.
+
+        @param generation The generation when the computation of
+        local_texts started. If anything has changed since then,
+        local_texts may be outdated and is not used.
+
+        @return True if the unread texts were set.
+        """
+        with self._lock:
+            if self.generation != generation:
+                return False
+            self._replace(conf_no, dict(local_texts))
+            return True
+
+    def forget(self, conf_no):
+        with self._lock:
+            self.generation += 1
+            self._replace(conf_no, None)
+
+    def forget_all(self):
+        with self._lock:
+            self.generation += 1
+            self._unread = {}
+            self._account = _SizeAccount()
+
+    def _change(self, conf_no, func):
+        # Must be called with the lock held. Calls func with the
+        # unread texts of the conference, if it is tracked.
+        unread = self._unread.get(conf_no)
+        if unread is None:
+            return
+        entries, size = len(unread), self._size(unread)
+        func(unread)
+        self._account.add(len(unread) - entries, self._size(unread) - size)
+
+    def add(self, conf_no, local_no, text_no):
+        """Add an unread text, if the conference is tracked.
+        """
+        with self._lock:
+            self.generation += 1
+            self._change(conf_no, lambda unread: unread.__setitem__(local_no, text_no))
+
+    def remove(self, conf_no, local_no):
+        with self._lock:
+            self.generation += 1
+            self._change(conf_no, lambda unread: unread.pop(local_no, None))
+
+    def remove_text(self, conf_no, text_no):
+        def remove_text(unread):
+            for local_no, unread_text_no in list(unread.items()):
+                if unread_text_no == text_no:
+                    del unread[local_no]
+        with self._lock:
+            self.generation += 1
+            self._change(conf_no, remove_text)
+
+    def info(self):
+        """Return a dict with the number of unread texts and their
+        estimated size in bytes.
+        """
+        return self._account.info()
+
+    def no_of_unread(self, conf_no):
+        """Return the number of unread texts, or None if the
+        conference isn't tracked.
+        """
+        with self._lock:
+            unread = self._unread.get(conf_no)
+            return None if unread is None else len(unread)
+
+    def unread_texts(self, conf_no):
+        """Return the global numbers of the unread texts, in local
+        number order.
+        """
+        with self._lock:
+            unread = self._unread[conf_no]
+            return [ unread[local_no] for local_no in sorted(unread) ]
+
+
+# Cache class limited by the total size of the cached values, with
+# least recently used eviction. For use internally by CachingClient.
+class SizeBoundedCache(Cache):
+    """Cache with a budget in bytes instead of a number of entries.
+
+    Entries that are larger than large_entry_bytes are kept in a
+    separate LRU segment that may use at most large_share of the
+    budget. That way a few huge texts (images, for example) can only
+    evict other huge texts, and never flush out lots of small
+    ones. Values that don't fit in their segment at all are returned
+    but not cached.
+    """
+    def __init__(self, fetcher, name="Unknown", max_bytes=16*1024*1024,
+                 large_entry_bytes=64*1024, large_share=0.25, sizeof=len):
+        Cache.__init__(self, fetcher, name, sizeof=sizeof)
+        self._rejects = self._counter('rejects')
+        self._evictions = self._counter('evictions')
+        self.max_bytes = max_bytes
+        self.large_entry_bytes = large_entry_bytes
+        self._large_max_bytes = int(max_bytes * large_share)
+        self._small_max_bytes = max_bytes - self._large_max_bytes
+        # self.dict is the segment for small entries
+        self.dict = OrderedDict()
+        self._large = OrderedDict()
+        self._small_bytes = 0
+        self._large_bytes = 0
+
+    def __contains__(self, no):
+        return no in self.dict or no in self._large
+
+    def __len__(self):
+        return len(self.dict) + len(self._large)
+
+    def peek(self, no):
+        with self._lock:
+            segment = self._segment_for(no)
+            if segment is None:
+                return None
+            return segment[no]
+
+    def __getitem__(self, no):
+        # Unlike Cache, hits change the LRU order, so they have to
+        # take the lock.
+        with self._lock:
+            segment = self._segment_for(no)
+            if segment is not None:
+                self.cached += 1
+                self._hits.value += 1
+                # Move to most recently used position
+                val = segment.pop(no)
+                segment[no] = val
+                return val
+            generation = self._generation
+        self.uncached += 1
+        self._misses.value += 1
+        val = self.fetcher(no)
+        self.store(no, val, generation)
+        return val
+
+    def _set(self, no, val):
+        # Must be called with the lock held
+        self._discard(no)
+        size = self.sizeof(val)
+        if size > self.large_entry_bytes:
+            if size > self._large_max_bytes:
+                self._rejects.value += 1
+                return
+            self._evict(self._large, self._large_max_bytes - size)
+            self._large[no] = val
+            self._large_bytes += size
+        else:
+            self._evict(self.dict, self._small_max_bytes - size)
+            self.dict[no] = val
+            self._small_bytes += size
+        self._account(no, size)
+        self._sets.value += 1
+
+    def invalidate(self, no):
+        with self._lock:
+            self._new_generation(no)
+            if self._discard(no):
+                self._invalidations.value += 1
+
+    def clear(self):
+        with self._lock:
+            self._new_generation()
+            self.dict = OrderedDict()
+            self._large = OrderedDict()
+            self._small_bytes = 0
+            self._large_bytes = 0
+            self._unaccount_all()
+
+    def info(self):
+        with self._lock:
+            info = Cache.info(self)
+            info.update(entries=len(self),
+                        large_entries=len(self._large),
+                        large_bytes=self._large_bytes,
+                        max_bytes=self.max_bytes)
+            return info
+
+    def _discard(self, no):
+        segment = self._segment_for(no)
+        if segment is None:
+            return False
+        self._remove(segment, no)
+        return True
+
+    def _segment_for(self, no):
+        if no in self.dict:
+            return self.dict
+        elif no in self._large:
+            return self._large
+        else:
+            return None
+
+    def _segment_bytes(self, segment):
+        if segment is self._large:
+            return self._large_bytes
+        else:
+            return self._small_bytes
+
+    def _evict(self, segment, max_bytes):
+        """Evict least recently used entries from segment until it
+        uses at most max_bytes.
+        """
+        while segment and self._segment_bytes(segment) > max_bytes:
+            no = next(iter(segment))
+            self._remove(segment, no)
+            self._evictions.value += 1
+
+    def _remove(self, segment, no):
+        del segment[no]
+        size = self._sizes[no]
+        self._unaccount(no)
+        if segment is self._large:
+            self._large_bytes -= size
+        else:
+            self._small_bytes -= size
@@ -78,7 +78,10 @@ class Connection(object):
 
         @param user: See Protocol A spec.
         """
-        self._lock = threading.RLock()
+        # Sending and receiving use separate locks, so a request can be
+        # sent while another thread waits for a response.
+        self._send_lock = threading.RLock()
+        self._receive_lock = threading.RLock()
         self._socket = sock
         if user is None:
             user = ""
@@ -98,13 +101,13 @@ class Connection(object):
         stats.set('connections.opened.last', 1, agg='sum')
 
     def send_request(self, req):
-        with self._lock:
+        with self._send_lock:
             ref_no = self._send_request(req)
             stats.set('connections.requests.sent.last', 1, agg='sum')
         return ref_no
 
     def read_response(self):
-        with self._lock:
+        with self._receive_lock:
             ref_no, resp, error = self._parse_response()
         return ref_no, resp, error
 
@@ -112,7 +115,7 @@ class Connection(object):
         if self._socket is None:
             return
 
-        with self._lock:
+        with self._send_lock:
             try:
                 self._socket.close()
             except socket.error as e:
@@ -138,8 +141,14 @@ class Connection(object):
         ref_no = self._ref_no
         assert ref_no not in self._outstanding_requests
         request_string = b"%d %s" % (ref_no, req.to_string())
-        self._send_string(request_string)
+        # Added before sending, because another thread may read the
+        # response before we return.
         self._outstanding_requests[ref_no] = req
+        try:
+            self._send_string(request_string)
+        except:
+            del self._outstanding_requests[ref_no]
+            raise
         return ref_no
 
     def _parse_response(self):
@@ -5,6 +5,8 @@
 # (C) 2012-2014 Oskar Skoog. Released under GPL.
 
 from __future__ import absolute_import
+from array import array
+from bisect import bisect_left, bisect_right
 import time
 import calendar
 
@@ -950,13 +952,168 @@ class ReadRange(object):
 class ArrayReadRange(Array):
     ELEMENT_CLASS = ReadRange
 
+class ReadRangeSet(object):
+    """A set of read local text numbers, kept as sorted and merged
+    ranges in two arrays (first and last read, both inclusive).
+
+    Lookups and updates use bisect, so they are O(log n) in the number
+    of ranges (plus moving the array tail on updates). Uses the same
+    wire format as ArrayReadRange. Iterating and indexing give
+    ReadRange objects, and append() marks a ReadRange as read, so it
+    can be used where an ArrayReadRange is expected (but the ranges
+    are always kept sorted and merged).
+    """
+    def __init__(self, read_ranges=None):
+        """
+        @param read_ranges Another ReadRangeSet, or an iterable of
+        ReadRange objects or (first_read, last_read) tuples. The
+        ranges don't have to be sorted or merged.
+        """
+        self._firsts = array('l')
+        self._lasts = array('l')
+        if isinstance(read_ranges, ReadRangeSet):
+            self._firsts.extend(read_ranges._firsts)
+            self._lasts.extend(read_ranges._lasts)
+        elif read_ranges is not None:
+            for read_range in read_ranges:
+                if isinstance(read_range, ReadRange):
+                    self.mark_read(read_range.first_read, read_range.last_read)
+                else:
+                    self.mark_read(*read_range)
+
+    @classmethod
+    def parse(cls, buf):
+        return cls(ArrayReadRange.parse(buf))
+
+    def to_string(self):
+        if len(self) > 0:
+            return b"%d { %s }" % (len(self), b" ".join(
+                    [ b"%d %d" % (first, last) for first, last in zip(self._firsts, self._lasts) ]))
+        else:
+            return b"0 { }"
+
+    def __len__(self):
+        return len(self._firsts)
+
+    def __iter__(self):
+        for first, last in zip(self._firsts, self._lasts):
+            yield ReadRange(first, last)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ ReadRange(first, last)
+                     for first, last in zip(self._firsts[i], self._lasts[i]) ]
+        return ReadRange(self._firsts[i], self._lasts[i])
+
+    def append(self, read_range):
+        """Like list.append, for code that builds read ranges as an
+        ArrayReadRange. The range is merged with the others.
+        """
+        if isinstance(read_range, ReadRange):
+            self.mark_read(read_range.first_read, read_range.last_read)
+        else:
+            self.mark_read(*read_range)
+
+    def __eq__(self, other):
+        if not isinstance(other, ReadRangeSet):
+            return NotImplemented
+        return self._firsts == other._firsts and self._lasts == other._lasts
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return "ReadRangeSet({!r})".format(list(zip(self._firsts, self._lasts)))
+
+    def is_read(self, local_no):
+        i = bisect_right(self._firsts, local_no) - 1
+        return i >= 0 and local_no <= self._lasts[i]
+
+    def last_read(self):
+        """Return the highest read local number, or 0 if nothing is
+        read.
+        """
+        if len(self._lasts) == 0:
+            return 0
+        return self._lasts[-1]
+
+    def mark_read(self, first, last=None):
+        """Mark the local numbers first to last (inclusive) as read.
+        """
+        if last is None:
+            last = first
+        # Merge with all overlapping or adjacent ranges
+        i = bisect_left(self._lasts, first - 1)
+        j = bisect_right(self._firsts, last + 1)
+        if i < j:
+            first = min(first, self._firsts[i])
+            last = max(last, self._lasts[j - 1])
+        self._firsts[i:j] = array('l', [first])
+        self._lasts[i:j] = array('l', [last])
+
+    def mark_unread(self, first, last=None):
+        """Mark the local numbers first to last (inclusive) as unread.
+        """
+        if last is None:
+            last = first
+        i = bisect_left(self._lasts, first)
+        j = bisect_right(self._firsts, last)
+        if i >= j:
+            return
+        firsts = array('l')
+        lasts = array('l')
+        # Keep the parts of the outermost ranges that are outside
+        if self._firsts[i] < first:
+            firsts.append(self._firsts[i])
+            lasts.append(first - 1)
+        if self._lasts[j - 1] > last:
+            firsts.append(last + 1)
+            lasts.append(self._lasts[j - 1])
+        self._firsts[i:j] = firsts
+        self._lasts[i:j] = lasts
+
+    def gaps(self, first=1, last=None):
+        """Return the unread local numbers from first to last
+        (inclusive) as a list of (first unread, length) tuples.
+
+        @param last Defaults to the highest read local number, so the
+        unread texts after the last read range are not included.
+        """
+        if last is None:
+            last = self.last_read()
+        result = []
+        pos = first
+        i = bisect_left(self._lasts, first)
+        while pos <= last and i < len(self._firsts):
+            range_first = self._firsts[i]
+            if range_first > last:
+                break
+            if range_first > pos:
+                result.append((pos, range_first - pos))
+            pos = max(pos, self._lasts[i] + 1)
+            i += 1
+        if pos <= last:
+            result.append((pos, last - pos + 1))
+        return result
+
+    def no_of_unread(self, last, first=1):
+        """Return the number of unread local numbers from first to
+        last (inclusive).
+        """
+        return sum([ length for _, length in self.gaps(first, last) ])
+
 class Membership11(object):
     def __init__(self, position=0, last_time_read=None, conference=0, priority=0,
                  read_ranges=None, added_by=0, added_at=None, membership_type=None):
         if last_time_read is None:
             last_time_read = Time()
         if read_ranges is None:
-            read_ranges = ArrayReadRange()
+            read_ranges = ReadRangeSet()
+        elif not isinstance(read_ranges, ReadRangeSet):
+            read_ranges = ReadRangeSet(read_ranges)
         if added_at is None:
             added_at = Time()
         if membership_type is None:
@@ -991,7 +1148,7 @@ class Membership11(object):
         obj.last_time_read  = Time.parse(buf)
         obj.conference = ConfNo.parse(buf)
         obj.priority = Int8.parse(buf)
-        obj.read_ranges = ArrayReadRange.parse(buf)
+        obj.read_ranges = ReadRangeSet.parse(buf)
         obj.added_by = PersNo.parse(buf)
         obj.added_at = Time.parse(buf)
         obj.type = MembershipType.parse(buf)
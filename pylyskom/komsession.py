@@ -6,17 +6,21 @@
 
 from __future__ import absolute_import
 import base64
+from collections import OrderedDict
 import functools
 import json
 import six
+import time
 
 import errno
 import socket
+import threading
 from . import mimeparse
 
 from . import komauxitems, utils, requests
 from .connection import Connection
 from .cachedconnection import Client, CachingPersonClient
+from .errors import NoSuchText, ServerError
 from .stats import stats
 
 from .datatypes import (
@@ -50,20 +54,110 @@ MICommentTo_str_to_type = { 'comment': MIC_COMMENT,
                             'footnote': MIC_FOOTNOTE }
 
 
-def create_client(host, port, user):
+def create_client(host, port, user, **kwargs):
+    """Create a client for a KomSession. Extra keyword arguments are
+    passed on to CachingPersonClient, for example
+    stale_while_revalidate=True (use functools.partial to create a
+    client_factory).
+    """
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.connect((host, port))
     conn = Connection(s, user)
     client = Client(conn)
-    return CachingPersonClient(client)
+    return CachingPersonClient(client, **kwargs)
+
+
+class SessionStateLock(object):
+    """Lock that lets any number of threads use a session at once,
+    but gives requests that change the state of the session on the
+    server (such as the logged in person or the current conference)
+    the session to themselves. They wait for the requests in progress
+    to finish, and new requests wait for them, so no request is run
+    while the state is changing. Both kinds of locking are reentrant
+    in the same thread, but a thread that uses the session can't
+    start changing the state.
+    """
+    def __init__(self):
+        self._changed = threading.Condition(threading.Lock())
+        self._users = 0
+        self._changer = None
+        self._changers_waiting = 0
+        # Per thread stack of what each acquire did, so release knows
+        # what to undo
+        self._local = threading.local()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def acquire_shared(self):
+        stack = self._stack()
+        if self._changer == threading.current_thread().ident or 'shared' in stack:
+            stack.append(None)
+            return
+        with self._changed:
+            while self._changer is not None or self._changers_waiting > 0:
+                self._changed.wait()
+            self._users += 1
+        stack.append('shared')
+
+    def acquire_exclusive(self):
+        me = threading.current_thread().ident
+        stack = self._stack()
+        if self._changer == me:
+            stack.append(None)
+            return
+        if 'shared' in stack:
+            raise RuntimeError("Can't change the session state while using the session")
+        with self._changed:
+            self._changers_waiting += 1
+            try:
+                while self._changer is not None or self._users > 0:
+                    self._changed.wait()
+            finally:
+                self._changers_waiting -= 1
+            self._changer = me
+        stack.append('exclusive')
+
+    def release(self):
+        kind = self._stack().pop()
+        if kind is None:
+            return
+        with self._changed:
+            if kind == 'shared':
+                self._users -= 1
+            else:
+                self._changer = None
+            self._changed.notify_all()
 
 
 def check_connection(f):
+    return _check_connection(f, exclusive=False)
+
+
+def changes_session_state(f):
+    """Like check_connection, for requests that change the state of
+    the session on the server. See SessionStateLock.
+    """
+    return _check_connection(f, exclusive=True)
+
+
+def _check_connection(f, exclusive):
     @functools.wraps(f)
     def decorated(komsession, *args, **kwargs):
         if not komsession.is_connected():
             raise KomSessionNotConnected()
+        if exclusive:
+            komsession._session_state_lock.acquire_exclusive()
+        else:
+            komsession._session_state_lock.acquire_shared()
         try:
+            # Check again, the session may have been disconnected
+            # while we waited for the lock.
+            if not komsession.is_connected():
+                raise KomSessionNotConnected()
             return f(komsession, *args, **kwargs)
         except socket.error as serr:
             if serr.errno in (errno.EPIPE, errno.ECONNRESET, errno.ENOTCONN, errno.ETIMEDOUT):
@@ -73,6 +167,8 @@ def check_connection(f):
                 raise KomSessionNotConnected(serr)
             else:
                 raise KomSessionException(serr)
+        finally:
+            komsession._session_state_lock.release()
 
     return decorated
 
@@ -81,6 +177,11 @@ def check_connection(f):
 class KomSession(object):
     """ A LysKom session.
 
+    A session can be used by several threads at once. Their requests
+    are multiplexed on the same connection, except for requests that
+    change the state of the session (like login and
+    change_conference), which are run alone.
+
     Should handle either unicode strings or utf-8 encoded strings. (FIXME)
 
     TODO[Python3]: Only handle (unicode) strings, not bytes, in the
@@ -88,6 +189,12 @@ class KomSession(object):
     bytes? Seems inconvient at this level.)
 
     """
+    # Number of decoded user areas to keep
+    USER_AREA_BLOCKS_CACHE_SIZE = 16
+    # A wait for a prefetched text longer than this means that the
+    # reader is faster than the read-ahead
+    READ_AHEAD_WAITED_SECONDS = 0.005
+
     def __init__(self, client_factory=create_client):
         # TODO: We actually require the API of a
         # CachingPersonClient. We should enhance the Connection
@@ -98,6 +205,12 @@ class KomSession(object):
         self._session_no = None
         self._client_name = None
         self._client_version = None
+        # Decoded user area blocks, keyed by user area text number
+        # (LRU). A user area text is never changed (a new one is
+        # created instead), so this never has to be invalidated.
+        self._user_area_blocks = OrderedDict()
+        self._user_area_blocks_lock = threading.Lock()
+        self._session_state_lock = SessionStateLock()
 
     def connect(self, host, port, username, hostname, client_name, client_version):
         assert not self.is_connected() # todo: raise better exception
@@ -134,8 +247,34 @@ class KomSession(object):
             self._client_name = None
             self._client_version = None
             self._session_no = None
+            with self._user_area_blocks_lock:
+                self._user_area_blocks = OrderedDict()
 
-    @check_connection
+    def cache_info(self):
+        """Return the usage of the caches of the client, see
+        CachingClient.cache_info(). Empty when not connected.
+        """
+        client = self._client
+        if client is None:
+            return {}
+        return client.cache_info()
+
+    def cache_bytes(self):
+        """Return the estimated memory used by the caches, in bytes.
+        """
+        return sum(info['bytes'] for info in self.cache_info().values())
+
+    def clear_caches(self):
+        """Free the memory used by the caches. Everything is fetched
+        again when needed, so the session keeps working.
+        """
+        client = self._client
+        if client is not None:
+            client.clear_caches()
+        with self._user_area_blocks_lock:
+            self._user_area_blocks = OrderedDict()
+
+    @changes_session_state
     def disconnect(self, session_no=0):
         """Session number 0 means this session (a logged in user can
         disconnect its other sessions).
@@ -148,16 +287,22 @@ class KomSession(object):
         if session_no == 0 or session_no == self._session_no:
             self.close()
 
-    @check_connection
-    def login(self, pers_no, password):
+    @changes_session_state
+    def login(self, pers_no, password, warmup=False):
+        """Log in as a person.
+
+        If warmup is True, the memberships, their conferences and the
+        unread conferences of the person are prefetched, so that the
+        first page after login can be served from the caches.
+        """
         if isinstance(password, six.binary_type):
             password = password.decode('utf-8')
         pers_no = int(pers_no)
-        self._client.login(pers_no, password)
-        person_stat = self._client.request(requests.ReqGetPersonStat(pers_no))
+        self._client.login(pers_no, password, warmup=warmup)
+        person_stat = self._client.persons[pers_no]
         return KomPerson(pers_no, person_stat)
 
-    @check_connection
+    @changes_session_state
     def logout(self):
         self._client.logout()
 
@@ -177,7 +322,7 @@ class KomSession(object):
     def is_logged_in(self):
         return self._client.is_logged_in()
 
-    @check_connection
+    @changes_session_state
     def change_conference(self, conf_no):
         self._client.change_conference(conf_no)
         
@@ -246,7 +391,7 @@ class KomSession(object):
     @check_connection
     def add_membership(self, pers_no, conf_no, priority, where):
         mtype = MembershipType()
-        self._client.request(requests.ReqAddMember(conf_no, pers_no, priority, where, mtype))
+        self._client.add_membership(pers_no, conf_no, priority, where, mtype)
     
     @check_connection
     def delete_membership(self, pers_no, conf_no):
@@ -259,8 +404,7 @@ class KomSession(object):
 
     @check_connection
     def get_membership_unread(self, pers_no, conf_no):
-        membership = self._client.get_membership(pers_no, conf_no, want_read_ranges=True)
-        unread_texts = self._client.get_unread_texts_from_membership(membership)
+        unread_texts = self._client.get_unread_texts(pers_no, conf_no)
         return KomMembershipUnread(pers_no, conf_no, len(unread_texts), unread_texts)
 
     @check_connection
@@ -269,13 +413,14 @@ class KomSession(object):
             # RegGetUnreadConfs never returns passive memberships so
             # that combination is not valid.
             assert passive == False
-            conf_nos = self._client.request(requests.ReqGetUnreadConfs(pers_no))
+            conf_nos = self._client.get_unread_conf_nos(pers_no)
             # This may return conferences that don't have any unread
             # texts in them. We have to live with this, because we
             # don't want to get the unread texts in this case. It's
             # possible that we need to change this, which means that
             # unread=True may be a slower call.
-            memberships = [ self.get_membership(pers_no, conf_no) for conf_no in conf_nos ]
+            memberships = [ KomMembership(pers_no, membership) for membership
+                            in self._client.get_memberships_in_confs(pers_no, conf_nos) ]
             has_more = False
         else:
             ms_list = self._client.get_memberships(pers_no, first, no_of_confs,
@@ -298,11 +443,74 @@ class KomSession(object):
 
     @check_connection
     def get_membership_unreads(self, pers_no):
-        conf_nos = self._client.request(requests.ReqGetUnreadConfs(pers_no))
-        memberships = [ self.get_membership_unread(pers_no, conf_no)
-                        for conf_no in conf_nos ]
-        return [ m for m in memberships if m.no_of_unread > 0 ]
+        conf_nos = self._client.get_unread_conf_nos(pers_no)
+        unread = self._client.get_unread_texts_many(pers_no, conf_nos)
+        memberships = []
+        for conf_no in conf_nos:
+            unread_texts = unread.get(conf_no, [])
+            if len(unread_texts) > 0:
+                memberships.append(KomMembershipUnread(
+                    pers_no, conf_no, len(unread_texts), unread_texts))
+        return memberships
     
+    @check_connection
+    def iter_unread_texts(self, conf_no, min_window=1, max_window=32):
+        """Iterate over the unread texts in conference {conf_no}, in
+        reading order, as KomText objects.
+
+        The stats and bodies of the next texts are fetched in the
+        background while the caller handles the current one. The
+        number of texts fetched ahead adapts to how fast the caller
+        iterates (see ReadAheadWindow), and nothing more is fetched
+        when the caller stops iterating. The list of unread texts is
+        taken when this is called.
+        """
+        text_nos = self._client.get_unread_texts(self._client.get_person_no(), conf_no)
+        return self._iter_texts_with_read_ahead(
+            text_nos, ReadAheadWindow(min_size=min_window, max_size=max_window))
+
+    def _iter_texts_with_read_ahead(self, text_nos, window):
+        # Text number to prefetch references, for the texts that we
+        # have started to prefetch but not yet yielded.
+        pending = {}
+        next_prefetch = 0
+        # Kept so the prefetches can be cancelled even if the session
+        # has been closed (cancelling doesn't use the connection).
+        client = self._client
+        try:
+            for i, text_no in enumerate(text_nos):
+                next_prefetch = self._read_ahead(text_nos, i, pending, next_prefetch, window)
+                try:
+                    text = self.get_text(text_no)
+                except NoSuchText:
+                    # Deleted (or made unreadable) after the list of
+                    # texts was taken
+                    continue
+                yield text
+        finally:
+            # Also run when the generator is closed or garbage
+            # collected before the end
+            for refs in pending.values():
+                client.cancel_prefetch(refs)
+
+    @check_connection
+    def _read_ahead(self, text_nos, i, pending, next_prefetch, window):
+        # Prefetch the texts in the window after text_nos[i], and wait
+        # for text_nos[i] to be fetched. Done with the session lock
+        # held, since the session may be disconnected between the
+        # steps of the iteration. Returns the new next_prefetch.
+        #
+        # The window counts the texts after the current one
+        while next_prefetch < len(text_nos) and next_prefetch <= i + window.size:
+            prefetch_no = text_nos[next_prefetch]
+            pending[prefetch_no] = self._client.prefetch_text(prefetch_no)
+            next_prefetch += 1
+        refs = pending.pop(text_nos[i], [])
+        start = time.time()
+        self._client.wait_for_prefetch(refs)
+        window.update(time.time() - start > self.READ_AHEAD_WAITED_SECONDS)
+        return next_prefetch
+
     @check_connection
     def get_conf_name(self, conf_no):
         return self._client.conf_name(conf_no)
@@ -317,24 +525,96 @@ class KomSession(object):
 
     @check_connection
     def get_text(self, text_no):
-        text_stat = self.get_text_stat(text_no)
-        text = self._client.request(requests.ReqGetText(text_no))
-        return KomText(text_no=text_no, text=text, text_stat=text_stat)
+        return self.get_texts([ text_no ])[0]
 
-    # TODO: offset/start number, so we can paginate. we probably need
-    # to return the local text number for that.
     @check_connection
-    def get_last_texts(self, conf_no, no_of_texts, offset=0, full_text=False):
+    def get_texts(self, text_nos):
+        """Get several texts, with the stats and bodies that are not
+        cached fetched in one pipelined burst.
+        """
+        texts = self._client.get_texts(text_nos)
+        return [ KomText(text_no=text_no, text=text, text_stat=text_stat)
+                 for text_no, (text_stat, text) in zip(text_nos, texts) ]
+
+    @check_connection
+    def get_comment_tree(self, root_text_no, max_depth=None, max_nodes=None):
+        """Get the tree of comments to {root_text_no}, following the
+        comment-in lists of the text stats. The text stats of each
+        depth level are fetched in one pipelined burst. Comments that
+        can't be fetched (deleted or not readable) are left out.
+
+        @param max_depth Max number of levels below the root, or None
+        for no limit.
+        @param max_nodes Max number of texts in the tree, including
+        the root, or None for no limit.
+        @return A KomCommentTree.
+        """
+        tree = KomCommentTree(root_text_no)
+        tree.add(None, root_text_no, self.get_text_stat(root_text_no))
+        seen = set([ root_text_no ])
+        level = [ root_text_no ]
+        depth = 0
+        while level:
+            # (parent, text_no) for the comments on the next level.
+            # Texts that are reachable by several paths are only
+            # included under the first parent.
+            wave = []
+            for parent in level:
+                for ci in tree.text_stats[parent].misc_info.comment_in_list:
+                    if ci.text_no not in seen:
+                        seen.add(ci.text_no)
+                        wave.append((parent, ci.text_no))
+            if len(wave) == 0:
+                break
+            if max_depth is not None and depth >= max_depth:
+                tree.truncated = True
+                break
+            if max_nodes is not None and len(tree.text_stats) + len(wave) > max_nodes:
+                wave = wave[:max_nodes - len(tree.text_stats)]
+                tree.truncated = True
+            text_stats = self._client.get_text_stats(
+                [ text_no for parent, text_no in wave ], return_exceptions=True)
+            level = []
+            for (parent, text_no), text_stat in zip(wave, text_stats):
+                if isinstance(text_stat, ServerError):
+                    continue
+                tree.add(parent, text_no, text_stat)
+                level.append(text_no)
+            depth += 1
+        return tree
+
+    @check_connection
+    def get_last_texts(self, conf_no, no_of_texts, **kwargs):
         """Get the {no_of_texts} last texts in conference {conf_no},
-        starting from {offset}.
+        newest first. The text stats (and the bodies, if {full_text}
+        is True) are fetched in one pipelined burst.
+
+        cursor and full_text can only be given as keyword arguments,
+        so that old callers that pass an offset as the third argument
+        get an error instead of the wrong texts.
+
+        @param cursor None to get the last texts, or a cursor returned
+        by an earlier call to get the texts before those.
+        @return Tuple of the list of KomText objects and an opaque
+        cursor for the next (older) page, or None if there are no
+        older texts.
         """
-        #local_no_ceiling = 0 # means the higest numbered texts (i.e. the last)
-        text_mapping = self._client.request(
-            requests.ReqLocalToGlobalReverse(conf_no, 0, no_of_texts))
-        texts = [ KomText(text_no=m[1], text=None, text_stat=self.get_text_stat(m[1]))
-                  for m in text_mapping.list if m[1] != 0 ]
-        texts.reverse()
-        return texts
+        cursor = kwargs.pop('cursor', None)
+        full_text = kwargs.pop('full_text', False)
+        if kwargs:
+            raise TypeError("get_last_texts() got unexpected keyword arguments: %s" % (
+                ", ".join(sorted(kwargs)),))
+        local_no_ceiling = 0 if cursor is None else cursor
+        mapping, next_cursor = self._client.get_last_local_to_global(
+            conf_no, local_no_ceiling, no_of_texts)
+        text_nos = [ text_no for local_no, text_no in reversed(mapping) ]
+        if full_text:
+            texts = self.get_texts(text_nos)
+        else:
+            text_stats = self._client.get_text_stats(text_nos)
+            texts = [ KomText(text_no=text_no, text=None, text_stat=text_stat)
+                      for text_no, text_stat in zip(text_nos, text_stats) ]
+        return texts, next_cursor
 
     @check_connection
     def create_text(self, subject, body, content_type, content_encoding=None,
@@ -412,8 +692,34 @@ class KomSession(object):
     @check_connection
     def mark_as_read(self, text_no):
         text_stat = self.get_text_stat(text_no)
-        for mi in text_stat.misc_info.recipient_list:
-            self._client.mark_as_read_local(mi.recpt, mi.loc_no)
+        self._mark_text_stats_as_read([ text_stat ])
+
+    @check_connection
+    def mark_texts_as_read(self, text_nos):
+        """Mark texts as read in all their recipients. The text stats
+        are fetched in one pipelined burst, and then the texts are
+        marked with one request per conference. Texts that can't be
+        fetched (deleted or not readable) are skipped.
+
+        @return List of the text numbers that were skipped.
+        """
+        text_stats = []
+        skipped = []
+        for text_no, text_stat in zip(text_nos, self._client.get_text_stats(
+                text_nos, return_exceptions=True)):
+            if isinstance(text_stat, ServerError):
+                skipped.append(text_no)
+            else:
+                text_stats.append(text_stat)
+        self._mark_text_stats_as_read(text_stats)
+        return skipped
+
+    def _mark_text_stats_as_read(self, text_stats):
+        local_text_nos = {}
+        for text_stat in text_stats:
+            for mi in text_stat.misc_info.recipient_list:
+                local_text_nos.setdefault(mi.recpt, []).append(mi.loc_no)
+        self._client.mark_as_read_locals(local_text_nos)
 
     @check_connection
     def mark_as_unread(self, text_no):
@@ -423,7 +729,7 @@ class KomSession(object):
 
     @check_connection
     def set_unread(self, conf_no, no_of_unread):
-        self._client.request(requests.ReqSetUnread(conf_no, no_of_unread))
+        self._client.set_unread(conf_no, no_of_unread)
 
     @check_connection
     def get_marks(self):
@@ -450,22 +756,17 @@ class KomSession(object):
         If json_decode is False, then the block will be returned as a
         string.
         """
-        person_stat = self._client.request(requests.ReqGetPersonStat(pers_no))
+        person_stat = self._client.persons[pers_no]
 
         if person_stat.user_area == 0:
             # No user area
             return None
 
-        # TODO: don't use external get_text method here - it should decode the body,
-        # but we don't want to do that.
-        text = self.get_text(person_stat.user_area)
-        if text.content_type != 'x-kom/user-area':
-            raise KomSessionError(
-                "Unknown content type for user area text: %s" % (text.content_type,))
-
-        blocks = utils.decode_user_area(text.body.encode('latin1')) #HACK
+        blocks = self._get_user_area_blocks(person_stat.user_area)
         block = blocks.get(block_name, None)
         if block is not None and json_decode:
+            # Parsing gives the caller its own copy, so the cached
+            # blocks can't be modified.
             block = json.loads(block.decode('latin1')) #HACK
 
         return block
@@ -484,21 +785,14 @@ class KomSession(object):
         If json_encode is False, then the block should be a string
         that can be hollerith encoded.
         """
-        person_stat = self._client.request(requests.ReqGetPersonStat(pers_no))
+        person_stat = self._client.persons[pers_no]
 
         if person_stat.user_area == 0:
             # No existing user area, initiate a new dictionary of
             # blocks.
             blocks = dict()
         else:
-            # TODO: don't use external get_text method here - it
-            # should decode the body, but we don't want to do that.
-            user_area = self.get_text(person_stat.user_area)
-            if user_area.content_type != 'x-kom/user-area':
-                raise KomSessionError(
-                    "Unknown content type for user area text: %s" % (user_area.content_type,))
-
-            blocks = utils.decode_user_area(user_area.body.encode('latin1')) # HACK
+            blocks = dict(self._get_user_area_blocks(person_stat.user_area))
 
         if json_encode:
             blocks[block_name] = json.dumps(block).encode('latin1') # HACK
@@ -509,9 +803,59 @@ class KomSession(object):
             subject=None,
             body=utils.encode_user_area(blocks),
             content_type='x-kom/user-area')
-        self._client.request(requests.ReqSetUserArea(pers_no, new_user_area_text_no))
+        self._client.set_user_area(pers_no, new_user_area_text_no)
+        self._cache_user_area_blocks(new_user_area_text_no, blocks)
         # TODO: Should it remove the old user area?
 
+    def _get_user_area_blocks(self, text_no):
+        """Return the decoded blocks of a user area text. The returned
+        dict is shared with the cache and must not be modified.
+        """
+        with self._user_area_blocks_lock:
+            blocks = self._user_area_blocks.pop(text_no, None)
+        if blocks is None:
+            # TODO: don't use external get_text method here - it
+            # should decode the body, but we don't want to do that.
+            text = self.get_text(text_no)
+            if text.content_type != 'x-kom/user-area':
+                raise KomSessionError(
+                    "Unknown content type for user area text: %s" % (text.content_type,))
+            blocks = utils.decode_user_area(text.body.encode('latin1')) # HACK
+        self._cache_user_area_blocks(text_no, blocks)
+        return blocks
+
+    def _cache_user_area_blocks(self, text_no, blocks):
+        with self._user_area_blocks_lock:
+            self._user_area_blocks[text_no] = blocks
+            while len(self._user_area_blocks) > self.USER_AREA_BLOCKS_CACHE_SIZE:
+                self._user_area_blocks.popitem(last=False)
+
+
+class ReadAheadWindow(object):
+    """The number of texts to fetch ahead of a reader. It is doubled
+    when the reader had to wait for a text, and decreased by one after
+    a number of texts in a row that were there in time, so a slow
+    reader doesn't keep lots of texts in flight.
+    """
+    # Number of texts in a row without waiting before shrinking
+    SHRINK_AFTER = 4
+
+    def __init__(self, size=2, min_size=1, max_size=32):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = max(min_size, min(size, max_size))
+        self._in_time = 0
+
+    def update(self, waited):
+        if waited:
+            self.size = min(self.size * 2, self.max_size)
+            self._in_time = 0
+        else:
+            self._in_time += 1
+            if self._in_time >= self.SHRINK_AFTER:
+                self.size = max(self.size - 1, self.min_size)
+                self._in_time = 0
+
 
 class KomPerson(object):
     def __init__(self, pers_no, person_stat=None):
@@ -596,26 +940,81 @@ class KomUConference(object):
             self.nice = uconf.nice
 
 
+class KomCommentTree(object):
+    """A tree of comments, as returned by KomSession.get_comment_tree.
+    The tree is kept as a dict from text number to the text numbers of
+    its comments, so it is cheap to build and walk.
+    """
+    def __init__(self, root_text_no):
+        self.root_text_no = root_text_no
+        # Text number to list of the text numbers of its comments
+        self.children = {}
+        self.text_stats = {}
+        # True if comments were left out because of max_depth or
+        # max_nodes
+        self.truncated = False
+
+    def add(self, parent, text_no, text_stat):
+        self.text_stats[text_no] = text_stat
+        self.children[text_no] = []
+        if parent is not None:
+            self.children[parent].append(text_no)
+
+    def __len__(self):
+        return len(self.text_stats)
+
+    def walk(self):
+        """Yield (depth, text_no) for all texts in the tree, depth
+        first, in the order they were commented.
+        """
+        pending = [ (0, self.root_text_no) ]
+        while pending:
+            depth, text_no = pending.pop()
+            yield depth, text_no
+            for child in reversed(self.children[text_no]):
+                pending.append((depth + 1, child))
+
+
 class KomText(object):
+    """A text, with its stat and (optionally) its body.
+
+    The content type, subject and body are parsed and decoded on first
+    access and then remembered, so listings that only use the stat
+    (for example the author and creation time) never decode anything,
+    and the subject can be used without decoding the body. Errors from
+    parsing the content type are therefore raised when one of them is
+    first read, not by the constructor. The raw text is dropped when
+    the body has been decoded.
+    """
+    # Marks a lazy attribute that hasn't been computed yet
+    _NOT_DECODED = object()
+
     def __init__(self, text_no=None, text=None, text_stat=None):
         self.text_no = text_no
+        # The raw text, until the subject and body have been decoded
+        self._text = text
+        # (mime_type, encoding), parsed from the content type aux item
+        self._parsed_content_type = None
 
         if text_stat is None:
-            self.content_type = None
+            self._content_type = None
+            self._subject = None
+            self._body = None
             self.creation_time = None
             self.author = None
             self.no_of_marks = 0
             self.recipient_list = None
             self.comment_to_list = None
             self.comment_in_list = None
-            self.subject = None
-            self.body = None
             self.aux_items = None
         else:
-            mime_type, encoding = utils.parse_content_type(
-                KomText._get_content_type_from_text_stat(text_stat))
-            self.content_type = utils.mime_type_tuple_to_str(mime_type)
-
+            self._content_type = KomText._NOT_DECODED
+            if text is None:
+                self._subject = None
+                self._body = None
+            else:
+                self._subject = KomText._NOT_DECODED
+                self._body = KomText._NOT_DECODED
             self.creation_time = text_stat.creation_time
             self.author = text_stat.author
             self.no_of_marks = text_stat.no_of_marks
@@ -623,47 +1022,103 @@ class KomText(object):
             self.comment_to_list = text_stat.misc_info.comment_to_list
             self.comment_in_list = text_stat.misc_info.comment_in_list
             self.aux_items = text_stat.aux_items
-            self.subject, self.body = KomText._decode_text(text, mime_type, encoding)
 
-    @staticmethod
-    def _decode_text(text, mime_type, encoding):
-        if text is None:
-            return None, None
+    @property
+    def content_type(self):
+        if self._content_type is KomText._NOT_DECODED:
+            mime_type, _ = self._parse_content_type()
+            self._content_type = utils.mime_type_tuple_to_str(mime_type)
+        return self._content_type
+
+    @content_type.setter
+    def content_type(self, content_type):
+        self._content_type = content_type
+
+    @property
+    def subject(self):
+        if self._subject is KomText._NOT_DECODED:
+            text = self._text
+            if text is None:
+                # Decoded by another thread, which dropped the text
+                return self._subject
+            self._subject = self._decode_subject(text)
+        return self._subject
+
+    @subject.setter
+    def subject(self, subject):
+        self._subject = subject
+
+    @property
+    def body(self):
+        if self._body is KomText._NOT_DECODED:
+            text = self._text
+            if text is None:
+                # Decoded by another thread, which dropped the text
+                return self._body
+            body = self._decode_body(text)
+            # The subject is short, so decode it too, and we don't
+            # have to keep both the raw and the decoded body.
+            if self._subject is KomText._NOT_DECODED:
+                self._subject = self._decode_subject(text)
+            self._body = body
+            self._text = None
+        return self._body
+
+    @body.setter
+    def body(self, body):
+        self._body = body
+
+    def _parse_content_type(self):
+        # Both the content type and the decoding use the parsed
+        # content type, so it's only parsed once.
+        if self._parsed_content_type is None:
+            self._parsed_content_type = utils.parse_content_type(
+                KomText._get_content_type_from_aux_items(self.aux_items))
+        return self._parsed_content_type
+
+    def _decode_subject(self, text):
+        mime_type, encoding = self._parse_content_type()
+        # text_stat is required for this
+        if mime_type[0] == "x-kom" and mime_type[1] == "user-area":
+            return None
 
-        subject = None
-        body = None
+        # If a text has no linefeeds, it only has a body
+        newline = text.find(b'\n')
+        if newline == -1:
+            return "" # Should probably be None instead?
+        # Only the subject is sliced out, so a large body isn't copied
+        # TODO: should we always decode the subject?
+        return utils.decode_text(text[:newline], encoding)
 
+    def _decode_body(self, text):
+        mime_type, encoding = self._parse_content_type()
         # text_stat is required for this
         if mime_type[0] == "x-kom" and mime_type[1] == "user-area":
-            body = utils.decode_text(text, encoding)
+            return utils.decode_text(text, encoding)
+
+        # If a text has no linefeeds, it only has a body
+        newline = text.find(b'\n')
+        if newline == -1:
+            rawbody = text
         else:
-            # If a text has no linefeeds, it only has a body
-            if text.find(b'\n') == -1:
-                subject = "" # Should probably be None instead?
-                rawbody = text
-            else:
-                rawsubject, rawbody = text.split(b'\n', 1)
-                # TODO: should we always decode the subject?
-                subject = utils.decode_text(rawsubject, encoding)
-
-            if mime_type[0] == 'text':
-                # Only decode body if media type is text, and not
-                # an image, for example.  Also, if the subject is
-                # empty, everything becomes the subject, which
-                # will get decoded.  Figure out how to handle all
-                # this. Assume empty subject means everything in
-                # body?
-                body = utils.decode_text(rawbody, encoding)
-            else:
-                body = rawbody
+            rawbody = text[newline + 1:]
 
-        return subject, body
+        if mime_type[0] == 'text':
+            # Only decode body if media type is text, and not
+            # an image, for example.  Also, if the subject is
+            # empty, everything becomes the subject, which
+            # will get decoded.  Figure out how to handle all
+            # this. Assume empty subject means everything in
+            # body?
+            return utils.decode_text(rawbody, encoding)
+        else:
+            return rawbody
 
     @staticmethod
-    def _get_content_type_from_text_stat(text_stat):
+    def _get_content_type_from_aux_items(aux_items):
         try:
             contenttype = first_aux_items_with_tag(
-                text_stat.aux_items, komauxitems.AI_CONTENT_TYPE).data.decode('latin1')
+                aux_items, komauxitems.AI_CONTENT_TYPE).data.decode('latin1')
         except AttributeError:
             contenttype = 'text/plain'
         return contenttype
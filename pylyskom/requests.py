@@ -17,7 +17,6 @@ from .datatypes import (
     ArrayMember,
     ArrayMembership11,
     ArrayMembership10,
-    ArrayReadRange,
     ArrayStats,
     ArrayConfNo,
     ArrayConfZInfo,
@@ -42,6 +41,7 @@ from .datatypes import (
     Person,
     PersonalFlags,
     PrivBits,
+    ReadRangeSet,
     SchedulingInfo,
     SessionNo,
     StaticServerInfo,
@@ -804,7 +804,7 @@ class ReqMarkAsUnread(Request):
 class ReqSetReadRanges(Request):
     CALL_NO = Requests.SET_READ_RANGES
     ARGS = [ Argument('conference', ConfNo),
-             Argument('read_ranges', ArrayReadRange) ]
+             Argument('read_ranges', ReadRangeSet) ]
 
 # get-stats-description [111] (11) Recommended
 class ReqGetStatsDescription(Request):
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from collections import OrderedDict
+import logging
+import threading
+import time
+import uuid
+
+from .stats import stats
+
+
+logger = logging.getLogger(__name__)
+
+
+class SessionManager(object):
+    """Owns a number of KomSessions (for example one per user of a
+    web application), keyed by session id.
+
+    The manager keeps track of when each session was last used, and
+    limits the resources used by the sessions:
+
+    - Sessions that have been idle longer than max_idle_seconds are
+      evicted by evict_idle().
+
+    - When a session is added and there already are max_sessions
+      sessions, the least recently used sessions are evicted.
+
+    - When the caches of all sessions use more than max_cache_bytes,
+      shrink_caches() clears the caches of the least recently used
+      sessions first. Their sessions keep working, they just have to
+      fetch everything again.
+
+    evict_idle() and shrink_caches() are not run by themselves. Call
+    maintain() regularly, for example from a timer.
+
+    Evicted sessions are disconnected (which waits for their requests
+    in progress to finish). A thread that still uses an evicted
+    session gets KomSessionNotConnected.
+
+    The manager can be used from several threads. Sessions are never
+    disconnected while holding the lock of the manager, so a slow
+    disconnect doesn't block other threads from getting their
+    sessions.
+    """
+    def __init__(self, max_idle_seconds=30*60, max_sessions=None,
+                 max_cache_bytes=None, clock=time.time):
+        """
+        @param max_idle_seconds Sessions that haven't been used for
+        this long are evicted by evict_idle(). None means never.
+
+        @param max_sessions Max number of open sessions. None means
+        no limit.
+
+        @param max_cache_bytes Max estimated memory used by the
+        caches of all sessions. None means no limit.
+
+        @param clock Function that returns the current time in
+        seconds.
+        """
+        self.max_idle_seconds = max_idle_seconds
+        self.max_sessions = max_sessions
+        self.max_cache_bytes = max_cache_bytes
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Session id to (session, time of last use), least recently
+        # used first.
+        self._sessions = OrderedDict()
+
+        self._open_gauge = stats.gauge('sessions.open.last')
+        self._added = stats.counter('sessions.added.last')
+        self._removed = stats.counter('sessions.removed.last')
+        self._idle_evictions = stats.counter('sessions.evictions.idle.last')
+        self._limit_evictions = stats.counter('sessions.evictions.limit.last')
+        self._cache_shrinks = stats.counter('sessions.cache-shrinks.last')
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions
+
+    def add(self, session, session_id=None):
+        """Add a session, and return its session id. A new unique id
+        is created if none is given. If the manager is full, the least
+        recently used sessions are evicted to make room.
+        """
+        if session_id is None:
+            session_id = uuid.uuid4().hex
+        with self._lock:
+            if session_id in self._sessions:
+                raise ValueError("Session id already in use: %s" % (session_id,))
+            evicted = []
+            if self.max_sessions is not None:
+                while self._sessions and len(self._sessions) >= self.max_sessions:
+                    evicted.append(self._pop_least_recently_used())
+            self._sessions[session_id] = (session, self._clock())
+            self._open_gauge.value += 1
+            self._added.value += 1
+            self._limit_evictions.value += len(evicted)
+        self._disconnect_all(evicted)
+        return session_id
+
+    def get(self, session_id, default=None):
+        """Return the session with the given id, or default if there
+        is no such session, and mark it as used now.
+        """
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry is None:
+                return default
+            session = entry[0]
+            self._sessions[session_id] = (session, self._clock())
+            return session
+
+    def remove(self, session_id):
+        """Remove and disconnect the session with the given id.
+        Returns False if there was no such session.
+        """
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry is None:
+                return False
+            self._open_gauge.value -= 1
+            self._removed.value += 1
+        self._disconnect_all([ entry[0] ])
+        return True
+
+    def close_all(self):
+        """Remove and disconnect all sessions.
+        """
+        with self._lock:
+            sessions = [ session for session, _ in self._sessions.values() ]
+            self._sessions = OrderedDict()
+            self._open_gauge.value -= len(sessions)
+            self._removed.value += len(sessions)
+        self._disconnect_all(sessions)
+
+    def maintain(self):
+        """Evict idle sessions and shrink the caches if needed.
+        """
+        self.evict_idle()
+        self.shrink_caches()
+
+    def evict_idle(self):
+        """Evict the sessions that have been idle longer than
+        max_idle_seconds. Returns the number of evicted sessions.
+        """
+        if self.max_idle_seconds is None:
+            return 0
+        evicted = []
+        oldest_allowed = self._clock() - self.max_idle_seconds
+        with self._lock:
+            # The sessions are ordered by last use, so we can stop at
+            # the first one that is recent enough.
+            while self._sessions:
+                last_used = next(iter(self._sessions.values()))[1]
+                if last_used >= oldest_allowed:
+                    break
+                evicted.append(self._pop_least_recently_used())
+            self._idle_evictions.value += len(evicted)
+        self._disconnect_all(evicted)
+        return len(evicted)
+
+    def shrink_caches(self):
+        """Clear the caches of the least recently used sessions, until
+        the caches of all sessions use at most max_cache_bytes.
+        Returns the number of sessions whose caches were cleared.
+        """
+        if self.max_cache_bytes is None:
+            return 0
+        with self._lock:
+            sessions = [ session for session, _ in self._sessions.values() ]
+        # Measure the sizes without the lock, they are only estimates
+        # anyway and sessions may be used meanwhile.
+        sizes = [ session.cache_bytes() for session in sessions ]
+        total = sum(sizes)
+        shrunk = 0
+        for session, size in zip(sessions, sizes):
+            if total <= self.max_cache_bytes:
+                break
+            if size == 0:
+                continue
+            session.clear_caches()
+            total -= size
+            shrunk += 1
+        with self._lock:
+            self._cache_shrinks.value += shrunk
+        return shrunk
+
+    def info(self):
+        """Return a dict with the number of sessions and the estimated
+        memory used by their caches.
+        """
+        with self._lock:
+            sessions = [ session for session, _ in self._sessions.values() ]
+        return dict(sessions=len(sessions),
+                    cache_bytes=sum(session.cache_bytes() for session in sessions))
+
+    def _pop_least_recently_used(self):
+        # Must be called with the lock held.
+        _, (session, _) = self._sessions.popitem(last=False)
+        self._open_gauge.value -= 1
+        return session
+
+    def _disconnect_all(self, sessions):
+        for session in sessions:
+            if not session.is_connected():
+                continue
+            try:
+                session.disconnect()
+            except Exception:
+                # The connection may already be broken. We are
+                # throwing the session away anyway, so just make sure
+                # the socket is closed.
+                logger.exception("Failed to disconnect evicted session")
+                session.close()
@@ -3,17 +3,83 @@ import logging
 import socket
 import threading
 import time
+import weakref
 
 
 log = logging.getLogger('pylyskom.stats')
 
 
+class Counter(object):
+    """A counter that is cheap to increment. Get one with
+    Stats.counter() once, and then increment value directly (no
+    locking, formatting or allocation on the hot path). Increments
+    from different threads can in rare cases be lost, which is
+    acceptable for metrics.
+    """
+    # __weakref__ so gauges can be weakly referenced by Stats
+    __slots__ = ('value', '__weakref__')
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
 class Stats(object):
     def __init__(self, prefix=None):
         self._lock = threading.RLock()
         self._stats = dict()
+        self._counters = dict()
+        self._counter_sums = dict()
+        # Name to the set of gauges with that name (weakly
+        # referenced, so gauges of dropped owners are forgotten)
+        self._gauges = dict()
         self._prefix = prefix
 
+    def counter(self, name):
+        """Return the counter with the given name, creating it if
+        needed. The counter is summed into the stat with the same
+        name in dump() and reset().
+        """
+        if self._prefix:
+            name = self._prefix + name
+        with self._lock:
+            counter = self._counters.get(name)
+            if counter is None:
+                counter = self._counters[name] = Counter()
+            return counter
+
+    def gauge(self, name):
+        """Return a new gauge with the given name. A gauge is a Counter
+        for a current level (like a size) that is increased and
+        decreased by the owner. Each owner gets its own gauge, so
+        updates from owners that use different locks are never lost,
+        and all gauges with the same name are summed in dump() and
+        reset(). They are never reset. The owner must keep a reference
+        to the gauge; when it is garbage collected it no longer
+        counts.
+        """
+        if self._prefix:
+            name = self._prefix + name
+        gauge = Counter()
+        with self._lock:
+            gauges = self._gauges.get(name)
+            if gauges is None:
+                gauges = self._gauges[name] = weakref.WeakSet()
+            gauges.add(gauge)
+        return gauge
+
+    def counter_sum(self, name, counters):
+        """Register a stat that is the sum of the given counters, so
+        that hot paths don't have to increment a counter for the
+        total as well.
+        """
+        if self._prefix:
+            name = self._prefix + name
+        with self._lock:
+            self._counter_sums[name] = counters
+
     def set(self, name, value, agg=None):
         assert agg is not None
         if self._prefix:
@@ -27,14 +93,33 @@ class Stats(object):
 
     def dump(self):
         with self._lock:
-            return self._stats.copy()
+            snapshot = self._stats.copy()
+            self._add_counters(snapshot, reset=False)
+            return snapshot
 
     def reset(self):
         with self._lock:
             old = self._stats
             self._stats = dict()
+            self._add_counters(old, reset=True)
             return old
 
+    def _add_counters(self, d, reset):
+        values = dict((name, counter.value) for name, counter in self._counters.items())
+        for name, counters in self._counter_sums.items():
+            value = sum(counter.value for counter in counters)
+            if value:
+                d[name] = d.get(name, 0) + value
+        for name, value in values.items():
+            if value:
+                d[name] = d.get(name, 0) + value
+                if reset:
+                    # Subtract instead of setting to zero, to keep
+                    # increments done while we read the value.
+                    self._counters[name].value -= value
+        for name, gauges in self._gauges.items():
+            d[name] = sum(gauge.value for gauge in list(gauges))
+
     @staticmethod
     def _agg(func, val1, val2):
         if func == 'last':
@@ -1,6 +1,6 @@
-from pylyskom import requests
 from pylyskom.datatypes import CookedMiscInfo
-from pylyskom.cachedconnection import Cache
+from pylyskom.errors import ServerError
+from pylyskom.cachedconnection import CachingPersonClient
 
 
 class MockTextStat(object):
@@ -23,10 +23,9 @@ class MockPerson(object):
         self.user_area = user_area
 
 
-class MockConnection(object):
-    """Mock of connection.CachedPersonConnection.
-    
-    TODO: Make it a mock of connection.Connection by unifying the APIs.
+class MockClient(object):
+    """Mock of cachedconnection.Client that records all requests and
+    returns mocked responses.
     """
     def __init__(self):
         # Mock specifics
@@ -34,29 +33,12 @@ class MockConnection(object):
         
         # Key is request. Values are list of {'args': args, 'kwargs': kwargs} dictionaries.
         self.__request_calls = dict()
-        
-        # Connection specifics
-        self._pers_no = 0
-
-        # TODO: We should get a better API in CachedConnection/Connection.
-        self.textstats = Cache(self.fetch_textstat, "TextStat")
-
-    def fetch_textstat(self, no):
-        return self.request(requests.ReqGetTextStat(no))
 
-    def connect(self, host, port, user):
+    def close(self):
         pass
 
-    def login(self, pers_no, password):
-        self.request(requests.ReqLogin(pers_no, password, invisible=0))
-        self._pers_no = pers_no
-
-    def logout(self):
-        self.request(requests.ReqLogout())
-        self._pers_no = 0
-
-    def get_person_no(self):
-        return self._pers_no
+    def set_async_handler(self, handler_func):
+        pass
 
     def request(self, request):
         request_no = request.CALL_NO
@@ -71,6 +53,33 @@ class MockConnection(object):
             # Default is to return None
             return None
 
+    def request_many(self, reqs, return_exceptions=False):
+        responses = []
+        for req in reqs:
+            try:
+                responses.append(self.request(req))
+            except ServerError as error:
+                if not return_exceptions:
+                    raise
+                responses.append(error)
+        return responses
+
+    def request_in_background(self, request, callback):
+        # Answered at once, so there is never anything to wait for or
+        # cancel.
+        try:
+            resp = self.request(request)
+        except ServerError as error:
+            callback(None, error)
+        else:
+            callback(resp, None)
+
+    def wait_for_background(self, ref_no):
+        pass
+
+    def cancel_background(self, ref_no):
+        pass
+
     def mock_request(self, request_no, func):
         if func is None:
             raise Exception("Mocked request function is None")
@@ -83,6 +92,24 @@ class MockConnection(object):
             return self.__request_calls.get(request_no, [])
 
 
+class MockConnection(CachingPersonClient):
+    """A real CachingPersonClient on top of a MockClient, so the
+    caches are exercised in the same way as with a real connection.
+    """
+    def __init__(self, **kwargs):
+        self.mock_client = MockClient()
+        CachingPersonClient.__init__(self, self.mock_client, **kwargs)
+
+    def connect(self, host, port, user):
+        pass
+
+    def mock_request(self, request_no, func):
+        self.mock_client.mock_request(request_no, func)
+
+    def mock_get_request_calls(self, request_no=None):
+        return self.mock_client.mock_get_request_calls(request_no)
+
+
 
 class MockSocket():
     def __init__(self, recv_data=None):
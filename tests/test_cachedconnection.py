@@ -1,11 +1,42 @@
 from __future__ import print_function
 
+import threading
+import time
+
+import pytest
 from mock import Mock
+from six.moves import queue
+
+from .mocks import MockClient, MockConnection, MockSocket
 
-from pylyskom.errors import NoSuchLocalText
-from pylyskom.datatypes import TextMapping, ReadRange, Membership
-from pylyskom.requests import Requests
-from pylyskom.cachedconnection import Client, CachingClient
+from pylyskom.async import (
+    AsyncDeletedText,
+    AsyncLeaveConf,
+    AsyncNewMembership,
+    AsyncNewName,
+    AsyncNewRecipient,
+    AsyncNewText,
+    AsyncNewUserArea,
+    AsyncSubRecipient)
+from pylyskom.connection import Connection
+from pylyskom.errors import NoSuchLocalText, NoSuchText, NotMember
+from pylyskom.datatypes import (
+    MIC_COMMENT,
+    MIR_TO,
+    Conference,
+    MICommentTo,
+    MIRecipient,
+    Membership,
+    Membership11,
+    MembershipType,
+    ReadRange,
+    ReadRangeSet,
+    TextMapping,
+    TextStat,
+    UConference)
+from pylyskom.requests import Requests, ReqGetText
+from pylyskom.cachedconnection import (
+    Cache, Client, CachingClient, LocalToGlobalMap, SizeBoundedCache, estimate_size)
 
 
 def create_local_to_global_handler(highest_local):
@@ -28,7 +59,13 @@ def create_local_to_global_handler(highest_local):
     return handle_local_to_global_request
 
 
-def create_connection(request_mapping=None):
+def create_uconf_stat_handler(highest_local):
+    def handle_get_uconf_stat_request(request):
+        return UConference(b"Conf", highest_local_no=highest_local)
+    return handle_get_uconf_stat_request
+
+
+def create_connection(request_mapping=None, **kwargs):
     if request_mapping is None:
         request_mapping = dict()
         
@@ -39,10 +76,17 @@ def create_connection(request_mapping=None):
         assert request.CALL_NO in request_mapping
         return request_mapping[request.CALL_NO](request)
 
+    # Only used for its request_many, which calls mock_request
+    mock_client = MockClient()
+    mock_client.request = mock_request
+    def mock_request_many(reqs, return_exceptions=False):
+        return mock_client.request_many(reqs, return_exceptions)
+
     conn = Mock()
     client = Client(conn)
     client.request = mock_request
-    caching_client = CachingClient(client)
+    client.request_many = mock_request_many
+    caching_client = CachingClient(client, **kwargs)
     caching_client.request = mock_request
     return caching_client
 
@@ -85,7 +129,8 @@ def test_get_unread_texts_from_membership_small():
     membership.read_ranges = [
         ReadRange(1, 1), ReadRange(2, 3), ReadRange(5, 5), ReadRange(8, 10) ]
     last_text = 12
-    c = create_connection({ Requests.LOCAL_TO_GLOBAL: create_local_to_global_handler(last_text) })
+    c = create_connection({ Requests.LOCAL_TO_GLOBAL: create_local_to_global_handler(last_text),
+                            Requests.GET_UCONF_STAT: create_uconf_stat_handler(last_text) })
     
     unread_texts = c.get_unread_texts_from_membership(membership)
     
@@ -97,7 +142,8 @@ def test_get_unread_texts_from_membership_large():
     membership.read_ranges = [
         ReadRange(1, 300), ReadRange(1000, 2000), ReadRange(2100, 3000) ]
     highest_local = 4000
-    c = create_connection({ Requests.LOCAL_TO_GLOBAL: create_local_to_global_handler(highest_local) })
+    c = create_connection({ Requests.LOCAL_TO_GLOBAL: create_local_to_global_handler(highest_local),
+                            Requests.GET_UCONF_STAT: create_uconf_stat_handler(highest_local) })
     
     unread_texts = c.get_unread_texts_from_membership(membership)
     
@@ -125,7 +171,8 @@ def test_get_unread_texts_from_membership_fetches_the_correct_mappings():
     membership = Membership()
     membership.conference = 1
     membership.read_ranges = [ ReadRange(last_text, last_text) ]
-    c = create_connection({ Requests.LOCAL_TO_GLOBAL: create_local_to_global_handler(last_text) })
+    c = create_connection({ Requests.LOCAL_TO_GLOBAL: create_local_to_global_handler(last_text),
+                            Requests.GET_UCONF_STAT: create_uconf_stat_handler(last_text) })
     
     unread_texts = c.get_unread_texts_from_membership(membership)
     
@@ -133,3 +180,1066 @@ def test_get_unread_texts_from_membership_fetches_the_correct_mappings():
     assert len(unread_texts) == len(set(unread_texts))
     assert len(unread_texts) == last_text - 1
     assert unread_texts == list(range(1, last_text))
+
+def record_local_to_global_bursts(c):
+    bursts = []
+    request_many = c._client.request_many
+    def record_request_many(reqs, return_exceptions=False):
+        bursts.append([ (req.first_local_no, req.no_of_existing_texts) for req in reqs
+                        if req.CALL_NO == Requests.LOCAL_TO_GLOBAL ])
+        return request_many(reqs, return_exceptions)
+    c._client.request_many = record_request_many
+    return bursts
+
+@pytest.mark.parametrize("pipeline_local_to_global", [ True, False ])
+def test_get_unread_texts_from_membership_pipelines_all_chunks(pipeline_local_to_global):
+    membership = Membership()
+    membership.conference = 1
+    membership.read_ranges = [ ReadRange(1, 300), ReadRange(1000, 2000) ]
+    highest_local = 2200
+    c = create_connection({ Requests.LOCAL_TO_GLOBAL: create_local_to_global_handler(highest_local),
+                            Requests.GET_UCONF_STAT: create_uconf_stat_handler(highest_local) },
+                          pipeline_local_to_global=pipeline_local_to_global)
+    bursts = record_local_to_global_bursts(c)
+
+    unread_texts = c.get_unread_texts_from_membership(membership)
+
+    assert unread_texts == list(range(301, 1000)) + list(range(2001, highest_local + 1))
+    if pipeline_local_to_global:
+        assert bursts == [ [ (301, 255), (556, 255), (811, 189), (2001, 200) ] ]
+    else:
+        assert bursts == []
+
+@pytest.mark.parametrize("pipeline_local_to_global", [ True, False ])
+def test_get_unread_texts_from_membership_continues_after_outdated_highest_local_no(
+        pipeline_local_to_global):
+    membership = Membership()
+    membership.conference = 1
+    membership.read_ranges = [ ReadRange(1, 100) ]
+    c = create_connection({ Requests.LOCAL_TO_GLOBAL: create_local_to_global_handler(600),
+                            Requests.GET_UCONF_STAT: create_uconf_stat_handler(300) },
+                          pipeline_local_to_global=pipeline_local_to_global)
+
+    unread_texts = c.get_unread_texts_from_membership(membership)
+
+    assert unread_texts == list(range(101, 601))
+    assert 1 not in c.uconferences
+
+
+def test_size_bounded_cache_evicts_least_recently_used():
+    c = SizeBoundedCache(lambda no: b'x' * 10, max_bytes=40, large_entry_bytes=20,
+                         large_share=0.5)
+    c[1] = b'a' * 10
+    c[2] = b'b' * 10
+    c[1] # 1 is now more recently used than 2
+    c[3] = b'c' * 10
+
+    assert 1 in c
+    assert 2 not in c
+    assert 3 in c
+    assert c.size == 20
+
+def test_size_bounded_cache_large_entries_do_not_evict_small_entries():
+    c = SizeBoundedCache(lambda no: None, max_bytes=100, large_entry_bytes=10,
+                         large_share=0.5)
+    for i in range(10):
+        c[i] = b'x' * 5
+    c[100] = b'y' * 40
+    c[101] = b'z' * 40
+
+    assert all(i in c for i in range(10))
+    assert 100 not in c
+    assert 101 in c
+    assert c.size == 90
+
+def test_size_bounded_cache_does_not_cache_values_larger_than_segment():
+    fetched = []
+    def fetcher(no):
+        fetched.append(no)
+        return b'x' * 100
+    c = SizeBoundedCache(fetcher, max_bytes=100, large_entry_bytes=10, large_share=0.5)
+
+    assert c[1] == b'x' * 100
+    assert c[1] == b'x' * 100
+    assert fetched == [1, 1]
+    assert 1 not in c
+    assert c.size == 0
+
+def test_size_bounded_cache_invalidate():
+    c = SizeBoundedCache(lambda no: None, max_bytes=100)
+    c[1] = b'abc'
+    c.invalidate(1)
+    assert 1 not in c
+    assert c.size == 0
+
+def test_deleted_text_invalidates_text_body():
+    c = create_connection({ Requests.GET_TEXT: lambda request: b'subject\nbody' })
+    assert c.textbodies[4711] == b'subject\nbody'
+    assert 4711 in c.textbodies
+
+    msg = AsyncDeletedText()
+    msg.text_no = 4711
+    msg.text_stat = TextStat()
+    c._handle_async_message(msg)
+
+    assert 4711 not in c.textbodies
+
+
+def create_collate_table():
+    # Upper case ASCII letters are collated as lower case letters
+    return bytes(bytearray(
+        [ (i + 32 if 65 <= i <= 90 else i) for i in range(256) ]))
+
+def test_case_insensitive_regexp():
+    c = create_connection({ Requests.GET_COLLATE_TABLE: lambda request: create_collate_table() })
+
+    assert c._case_insensitive_regexp("Foo.*[Ab]") == "[Ff][Oo][Oo].*[Ab]"
+
+def test_regexp_lookup_fetches_collate_table_once():
+    collate_table_requests = []
+    def get_collate_table(request):
+        collate_table_requests.append(request)
+        return create_collate_table()
+    c = create_connection({ Requests.GET_COLLATE_TABLE: get_collate_table,
+                            Requests.RE_Z_LOOKUP: lambda request: [] })
+
+    c.regexp_lookup("foo", 1, 1)
+    c.regexp_lookup("bar", 1, 1)
+    c.regexp_lookup("foo", 1, 1)
+
+    assert len(collate_table_requests) == 1
+
+
+def create_new_text_message(text_no, recipients, comment_to=None):
+    ts = TextStat()
+    for conf_no, loc_no in recipients:
+        rcpt = MIRecipient(MIR_TO, conf_no)
+        rcpt.loc_no = loc_no
+        ts.misc_info.recipient_list.append(rcpt)
+    if comment_to is not None:
+        ts.misc_info.comment_to_list.append(MICommentTo(MIC_COMMENT, comment_to))
+    return AsyncNewText(text_no, ts)
+
+def create_deleted_text_message(text_no, recipients):
+    msg = AsyncDeletedText()
+    msg.text_no = text_no
+    msg.text_stat = create_new_text_message(text_no, recipients).text_stat
+    return msg
+
+def test_new_text_updates_cached_uconference_and_conference_in_place():
+    conf = Conference()
+    conf.name = b"Foo"
+    conf.first_local_no = 5
+    conf.no_of_texts = 10
+    c = create_connection({ Requests.GET_UCONF_STAT: lambda request: UConference(b"Foo", highest_local_no=14),
+                            Requests.GET_CONF_STAT: lambda request: conf })
+    c.uconferences[6]
+    c.conferences[6]
+
+    c._handle_async_message(create_new_text_message(4711, [ (6, 15) ]))
+
+    assert c.uconferences[6].highest_local_no == 15
+    assert c.conferences[6].no_of_texts == 11
+    assert c.uconferences.uncached == 1
+    assert c.conferences.uncached == 1
+
+def test_new_text_updates_cached_author():
+    person = Mock(no_of_created_texts=3, created_lines=10, created_bytes=100)
+    c = create_connection({ Requests.GET_PERSON_STAT: lambda request: person })
+    c.persons[17]
+    msg = create_new_text_message(4711, [ (6, 15) ])
+    msg.text_stat.author = 17
+    msg.text_stat.no_of_lines = 2
+    msg.text_stat.no_of_chars = 20
+
+    c._handle_async_message(msg)
+
+    assert c.persons.peek(17).no_of_created_texts == 4
+    assert c.persons.peek(17).created_lines == 12
+    assert c.persons.peek(17).created_bytes == 120
+
+def test_new_user_area_updates_cached_person():
+    person = Mock(user_area=12345)
+    c = create_connection({ Requests.GET_PERSON_STAT: lambda request: person })
+    c.persons[17]
+    msg = AsyncNewUserArea()
+    msg.person_no = 17
+    msg.old_user_area = 12345
+    msg.new_user_area = 67890
+
+    c._handle_async_message(msg)
+
+    assert c.persons[17].user_area == 67890
+
+def test_new_text_without_local_no_invalidates_uconference():
+    c = create_connection({ Requests.GET_UCONF_STAT: lambda request: UConference(b"Foo") })
+    c.uconferences[6]
+
+    c._handle_async_message(create_new_text_message(4711, [ (6, None) ]))
+
+    assert 6 not in c.uconferences
+
+def test_new_text_adds_comment_in_to_cached_commented_text_stat():
+    c = create_connection({ Requests.GET_TEXT_STAT: lambda request: TextStat() })
+    c.textstats[100]
+
+    c._handle_async_message(create_new_text_message(4711, [ (6, 15) ], comment_to=100))
+
+    comment_in_list = c.textstats[100].misc_info.comment_in_list
+    assert len(comment_in_list) == 1
+    assert comment_in_list[0].text_no == 4711
+    assert comment_in_list[0].type == MIC_COMMENT
+    assert c.textstats.uncached == 1
+    # The text stat for the new text comes with the message
+    assert 4711 in c.textstats
+
+def test_new_name_updates_cached_uconference_in_place():
+    c = create_connection({ Requests.GET_UCONF_STAT: lambda request: UConference(b"Foo") })
+    c.uconferences[6]
+    msg = AsyncNewName()
+    msg.conf_no = 6
+    msg.old_name = b"Foo"
+    msg.new_name = b"Bar"
+
+    c._handle_async_message(msg)
+
+    assert c.uconferences[6].name == b"Bar"
+    assert c.uconferences.uncached == 1
+
+def test_sub_recipient_removes_recipient_from_cached_text_stat():
+    ts = TextStat()
+    ts.misc_info.recipient_list.append(MIRecipient(MIR_TO, 6))
+    ts.misc_info.recipient_list.append(MIRecipient(MIR_TO, 7))
+    c = create_connection({ Requests.GET_TEXT_STAT: lambda request: ts })
+    c.textstats[4711]
+    msg = AsyncSubRecipient()
+    msg.text_no = 4711
+    msg.conf_no = 6
+    msg.type = MIR_TO
+
+    c._handle_async_message(msg)
+
+    assert [ r.recpt for r in c.textstats[4711].misc_info.recipient_list ] == [7]
+
+
+def test_get_unread_texts_from_membership_uses_cached_mapping():
+    local_to_global_requests = []
+    handler = create_local_to_global_handler(12)
+    def handle_local_to_global_request(request):
+        local_to_global_requests.append(request)
+        return handler(request)
+    membership = Membership()
+    membership.conference = 1
+    membership.read_ranges = [ ReadRange(1, 3) ]
+    c = create_connection({ Requests.LOCAL_TO_GLOBAL: handle_local_to_global_request,
+                            Requests.GET_UCONF_STAT: create_uconf_stat_handler(12) })
+
+    assert c.get_unread_texts_from_membership(membership) == list(range(4, 13))
+    membership.read_ranges = [ ReadRange(1, 5) ]
+    assert c.get_unread_texts_from_membership(membership) == list(range(6, 13))
+    assert len(local_to_global_requests) == 1
+
+    c._handle_async_message(create_new_text_message(113, [ (1, 13) ]))
+
+    assert c.get_unread_texts_from_membership(membership) == list(range(6, 13)) + [113]
+    assert len(local_to_global_requests) == 1
+
+def test_get_unread_texts_from_membership_handles_removed_texts():
+    membership = Membership()
+    membership.conference = 1
+    membership.read_ranges = [ ReadRange(1, 3) ]
+    c = create_connection({ Requests.LOCAL_TO_GLOBAL: create_local_to_global_handler(8),
+                            Requests.GET_UCONF_STAT: create_uconf_stat_handler(8) })
+    assert c.get_unread_texts_from_membership(membership) == [4, 5, 6, 7, 8]
+
+    msg = AsyncSubRecipient()
+    msg.text_no = 5
+    msg.conf_no = 1
+    msg.type = MIR_TO
+    c._handle_async_message(msg)
+    msg = AsyncDeletedText()
+    msg.text_no = 7
+    msg.text_stat = create_new_text_message(7, [ (1, 7) ]).text_stat
+    c._handle_async_message(msg)
+
+    assert c.get_unread_texts_from_membership(membership) == [4, 6, 8]
+
+def test_local_to_global_map_unknown():
+    m = LocalToGlobalMap()
+    m.add_known(5, 10)
+    m.add_known(15, 20)
+    m.add_known(20, 22)
+
+    assert m.unknown(1, 30) == [(1, 5), (10, 15), (22, 30)]
+    assert m.unknown(6, 9) == []
+    assert m.unknown(8, 17) == [(10, 15)]
+
+
+def test_client_request_many_sends_all_requests_before_reading():
+    s = MockSocket([b"LysKOM\n", b"=1 3Hfoo\n=2 3Hbar\n"])
+    client = Client(Connection(s))
+
+    responses = client.request_many([ ReqGetText(1), ReqGetText(2) ])
+
+    assert responses == [ b"foo", b"bar" ]
+    assert s.send_data == b"A0H\n1 25 1 0 2147483647\n2 25 2 0 2147483647\n"
+
+def test_client_request_many_return_exceptions():
+    s = MockSocket([b"LysKOM\n", b"%1 14 1\n=2 3Hbar\n"])
+    client = Client(Connection(s))
+
+    responses = client.request_many([ ReqGetText(1), ReqGetText(2) ], return_exceptions=True)
+
+    assert isinstance(responses[0], NoSuchText)
+    assert responses[1] == b"bar"
+
+def test_client_request_many_raises_first_error_after_reading_all_responses():
+    s = MockSocket([b"LysKOM\n", b"%1 14 1\n=2 3Hbar\n"])
+    client = Client(Connection(s))
+
+    with pytest.raises(NoSuchText):
+        client.request_many([ ReqGetText(1), ReqGetText(2) ])
+    assert s.recv_data == b""
+
+def test_login_with_warmup_fills_caches():
+    memberships = [ Membership11(position=0, conference=6),
+                    Membership11(position=1, conference=7) ]
+    c = MockConnection()
+    c.mock_request(Requests.GET_MEMBERSHIP, lambda request: memberships)
+    c.mock_request(Requests.GET_UNREAD_CONFS, lambda request: [7])
+    c.mock_request(Requests.GET_UCONF_STAT, lambda request: UConference(b"Conf"))
+
+    c.login(17, "", warmup=True)
+
+    assert c.get_memberships(17, 0, 2) == memberships
+    assert c.get_membership(17, 7) == memberships[1]
+    assert c.get_unread_conf_nos(17) == [7]
+    assert c.uconferences[6].name == b"Conf"
+    assert c.uconferences[7].name == b"Conf"
+    assert len(c.mock_get_request_calls(Requests.GET_MEMBERSHIP)) == 1
+    # Only the read ranges for the unread conference are fetched
+    assert [ (r.conference, r.want_read_ranges) for r in
+             c.mock_get_request_calls(Requests.QUERY_READ_TEXTS) ] == [ (7, 1) ]
+    assert len(c.mock_get_request_calls(Requests.GET_UNREAD_CONFS)) == 1
+    assert len(c.mock_get_request_calls(Requests.GET_UCONF_STAT)) == 2
+
+def test_new_text_adds_conf_to_cached_unread_confs():
+    memberships = [ Membership11(position=0, conference=6),
+                    Membership11(position=1, conference=7) ]
+    c = MockConnection()
+    c.mock_request(Requests.GET_MEMBERSHIP, lambda request: memberships)
+    c.mock_request(Requests.GET_UNREAD_CONFS, lambda request: [7])
+    c.login(17, "", warmup=True)
+
+    c._handle_async_message(create_new_text_message(4711, [ (6, 15) ]))
+
+    assert c.get_unread_conf_nos(17) == [7, 6]
+    assert len(c.mock_get_request_calls(Requests.GET_UNREAD_CONFS)) == 1
+
+def test_mark_as_read_removes_conf_without_unread_from_cached_unread_confs():
+    c = create_connection_with_unread_texts(7, [ (1, 8) ], 10)
+    c.mock_request(Requests.GET_UNREAD_CONFS, lambda request: [7, 8])
+    assert c.get_unread_texts(17, 7) == [9, 10]
+    c.get_unread_conf_nos(17)
+
+    c.mark_as_read_local(7, 9)
+    assert c.get_unread_conf_nos(17) == [7, 8]
+    c.mark_as_read_local(7, 10)
+    assert c.get_unread_conf_nos(17) == [8]
+    # We don't know if there are unread texts left in 8
+    c.mark_as_read_local(8, 1)
+    assert c.get_unread_conf_nos(17) == [8]
+
+    assert len(c.mock_get_request_calls(Requests.GET_UNREAD_CONFS)) == 1
+
+
+def create_logged_in_connection_with_memberships(conf_nos):
+    # conf_nos is the membership list on the server, in position order
+    def handle_get_membership_request(request):
+        return [ Membership11(position=pos, conference=conf_no)
+                 for pos, conf_no in enumerate(conf_nos) ]
+    def handle_query_read_texts_request(request):
+        return Membership11(position=conf_nos.index(request.conference),
+                            conference=request.conference)
+    c = MockConnection()
+    c.mock_request(Requests.GET_MEMBERSHIP, handle_get_membership_request)
+    c.mock_request(Requests.QUERY_READ_TEXTS, handle_query_read_texts_request)
+    c.login(17, "")
+    return c
+
+def create_leave_conf_message(conf_no):
+    msg = AsyncLeaveConf()
+    msg.conf_no = conf_no
+    return msg
+
+def create_new_membership_message(pers_no, conf_no):
+    msg = AsyncNewMembership()
+    msg.person_no = pers_no
+    msg.conf_no = conf_no
+    return msg
+
+def test_change_conference_only_refetches_previous_membership():
+    c = create_logged_in_connection_with_memberships([5, 6, 7])
+    c.get_memberships(17, 0, 3)
+    c.change_conference(6)
+    c.change_conference(7)
+
+    assert [ m.conference for m in c.get_memberships(17, 0, 3) ] == [5, 6, 7]
+    assert len(c.mock_get_request_calls(Requests.GET_MEMBERSHIP)) == 1
+    assert len(c.mock_get_request_calls(Requests.QUERY_READ_TEXTS)) == 1
+
+def test_leave_conf_moves_following_memberships_up():
+    conf_nos = [5, 6, 7]
+    c = create_logged_in_connection_with_memberships(conf_nos)
+    c.get_memberships(17, 0, 3)
+    c.change_conference(7)
+    c.change_conference(5)
+
+    conf_nos.remove(6)
+    c._handle_async_message(create_leave_conf_message(6))
+
+    memberships = c.get_memberships(17, 0, 2)
+    assert [ (m.position, m.conference) for m in memberships ] == [ (0, 5), (1, 7) ]
+    assert c.get_membership(17, 7).position == 1
+    assert len(c.mock_get_request_calls(Requests.GET_MEMBERSHIP)) == 1
+
+def test_add_membership_moves_following_memberships_down():
+    conf_nos = [5, 6, 7]
+    c = create_logged_in_connection_with_memberships(conf_nos)
+    c.get_memberships(17, 0, 3)
+
+    conf_nos.insert(1, 8)
+    # The server sends the async message before the reply
+    c.mock_request(Requests.ADD_MEMBER, lambda request: c._handle_async_message(
+        create_new_membership_message(17, 8)))
+    c.add_membership(17, 8, 100, 1, MembershipType())
+
+    memberships = c.get_memberships(17, 2, 2)
+    assert [ (m.position, m.conference) for m in memberships ] == [ (2, 6), (3, 7) ]
+    assert len(c.mock_get_request_calls(Requests.GET_MEMBERSHIP)) == 1
+
+def test_memberships_fetched_during_add_membership_are_not_moved_twice():
+    conf_nos = [5, 6, 7]
+    c = create_logged_in_connection_with_memberships(conf_nos)
+    c.mock_request(Requests.GET_MEMBERSHIP, lambda request: [
+        Membership11(position=pos, conference=conf_nos[pos])
+        for pos in range(request.first, min(request.first + request.no_of_confs,
+                                            len(conf_nos))) ])
+    def handle_add_member_request(request):
+        conf_nos.insert(1, 8)
+        c._handle_async_message(create_new_membership_message(17, 8))
+        # Another thread fetches the last memberships after the
+        # change, before the reply to add-member has been handled
+        c.get_memberships(17, 2, 2)
+    c.mock_request(Requests.ADD_MEMBER, handle_add_member_request)
+
+    c.add_membership(17, 8, 100, 1, MembershipType())
+
+    assert [ (m.position, m.conference) for m in c.get_memberships(17, 3, 1) ] == [ (3, 7) ]
+
+def test_new_membership_after_moving_membership_clears_membership_positions():
+    conf_nos = [5, 6, 7]
+    c = create_logged_in_connection_with_memberships(conf_nos)
+    c.get_memberships(17, 0, 3)
+    # Moving an existing membership gives no async message
+    c.add_membership(17, 7, 100, 0, MembershipType())
+    conf_nos[:] = [7, 5, 6]
+    c.get_memberships(17, 0, 3)
+
+    # Leave, and join again first from another session
+    conf_nos[:] = [5, 6]
+    c._handle_async_message(create_leave_conf_message(7))
+    c.get_memberships(17, 0, 2)
+    conf_nos[:] = [7, 5, 6]
+    c._handle_async_message(create_new_membership_message(17, 7))
+
+    memberships = c.get_memberships(17, 0, 2)
+    assert [ (m.position, m.conference) for m in memberships[:2] ] == [ (0, 7), (1, 5) ]
+
+def test_get_memberships_with_read_ranges_is_served_from_caches():
+    conf_nos = [5, 6, 7]
+    c = create_logged_in_connection_with_memberships(conf_nos)
+    def read_ranges(request, pos):
+        return [ ReadRange(1, pos + 1) ] if request.want_read_ranges else []
+    c.mock_request(Requests.GET_MEMBERSHIP, lambda request: [
+        Membership11(position=pos, conference=conf_no, read_ranges=read_ranges(request, pos))
+        for pos, conf_no in enumerate(conf_nos) ])
+    c.mock_request(Requests.QUERY_READ_TEXTS, lambda request: Membership11(
+        position=conf_nos.index(request.conference), conference=request.conference,
+        read_ranges=read_ranges(request, conf_nos.index(request.conference))))
+    c.get_memberships(17, 0, 3, want_read_ranges=True)
+    c.mark_as_read_local(7, 5)
+    c.change_conference(6)
+    c.change_conference(7)
+
+    memberships = c.get_memberships(17, 0, 3, want_read_ranges=True)
+
+    assert [ (m.position, m.conference, [ (rr.first_read, rr.last_read) for rr in m.read_ranges ])
+             for m in memberships ] == [ (0, 5, [ (1, 1) ]), (1, 6, [ (1, 2) ]),
+                                         (2, 7, [ (1, 3), (5, 5) ]) ]
+    assert len(c.mock_get_request_calls(Requests.GET_MEMBERSHIP)) == 1
+    # Only the membership of the previous conference is fetched again
+    assert [ (r.conference, r.want_read_ranges)
+             for r in c.mock_get_request_calls(Requests.QUERY_READ_TEXTS) ] == [ (6, 1) ]
+    # The positions are cached without read ranges
+    assert [ len(m.read_ranges) for m in c.get_memberships(17, 0, 3) ] == [ 0, 0, 0 ]
+    assert len(c.mock_get_request_calls(Requests.GET_MEMBERSHIP)) == 1
+
+@pytest.mark.parametrize("want_read_ranges", [ False, True ])
+def test_get_memberships_of_other_person_starts_at_first(want_read_ranges):
+    c = create_logged_in_connection_with_memberships([5, 6, 7])
+
+    c.get_memberships(18, 2, 1, want_read_ranges=want_read_ranges)
+
+    request = c.mock_get_request_calls(Requests.GET_MEMBERSHIP)[0]
+    assert (request.person, request.first, request.no_of_confs) == (18, 2, 1)
+
+def test_new_membership_from_elsewhere_clears_membership_positions():
+    c = create_logged_in_connection_with_memberships([5, 6, 7])
+    c.get_memberships(17, 0, 3)
+
+    c._handle_async_message(create_new_membership_message(17, 8))
+    c.get_memberships(17, 0, 3)
+
+    assert len(c.mock_get_request_calls(Requests.GET_MEMBERSHIP)) == 2
+
+def create_logged_in_connection_with_read_ranges(conf_no, read_ranges, **kwargs):
+    c = MockConnection(**kwargs)
+    c.mock_request(Requests.QUERY_READ_TEXTS, lambda request: Membership11(
+        conference=conf_no, read_ranges=[ ReadRange(f, l) for f, l in read_ranges ]))
+    c.login(17, "")
+    return c
+
+def get_read_ranges(c, conf_no):
+    membership = c.get_membership(17, conf_no, want_read_ranges=True)
+    return [ (rr.first_read, rr.last_read) for rr in membership.read_ranges ]
+
+@pytest.mark.parametrize("local_no, expected", [
+    (1, [ (1, 1), (3, 5), (7, 8) ]),
+    (2, [ (2, 5), (7, 8) ]),
+    (4, [ (3, 5), (7, 8) ]),
+    (6, [ (3, 8) ]),
+    (9, [ (3, 5), (7, 9) ]),
+    (11, [ (3, 5), (7, 8), (11, 11) ]),
+])
+def test_mark_as_read_updates_cached_read_ranges(local_no, expected):
+    c = create_logged_in_connection_with_read_ranges(6, [ (3, 5), (7, 8) ])
+    get_read_ranges(c, 6)
+
+    c.mark_as_read_local(6, local_no)
+
+    assert get_read_ranges(c, 6) == expected
+    assert len(c.mock_get_request_calls(Requests.QUERY_READ_TEXTS)) == 1
+
+def test_mark_as_read_locals_updates_cached_read_ranges():
+    c = create_logged_in_connection_with_read_ranges(6, [ (3, 5), (7, 8) ])
+    get_read_ranges(c, 6)
+
+    c.mark_as_read_locals({ 6: [ 6, 1, 2 ] })
+
+    assert get_read_ranges(c, 6) == [ (1, 8) ]
+    assert len(c.mock_get_request_calls(Requests.MARK_AS_READ)) == 1
+
+@pytest.mark.parametrize("local_no, expected", [
+    (1, [ (3, 5), (7, 7) ]),
+    (3, [ (4, 5), (7, 7) ]),
+    (4, [ (3, 3), (5, 5), (7, 7) ]),
+    (5, [ (3, 4), (7, 7) ]),
+    (7, [ (3, 5) ]),
+])
+def test_mark_as_unread_updates_cached_read_ranges(local_no, expected):
+    c = create_logged_in_connection_with_read_ranges(6, [ (3, 5), (7, 7) ])
+    get_read_ranges(c, 6)
+
+    c.mark_as_unread_local(6, local_no)
+
+    assert get_read_ranges(c, 6) == expected
+    assert len(c.mock_get_request_calls(Requests.QUERY_READ_TEXTS)) == 1
+
+def test_set_read_ranges_sends_locally_updated_read_ranges():
+    c = create_logged_in_connection_with_read_ranges(6, [ (1, 5) ])
+    membership = c.get_membership(17, 6, want_read_ranges=True)
+    read_ranges = ReadRangeSet(membership.read_ranges)
+    read_ranges.mark_read(7, 9)
+    read_ranges.mark_unread(2)
+
+    c.set_read_ranges(6, read_ranges)
+
+    set_requests = c.mock_get_request_calls(Requests.SET_READ_RANGES)
+    assert set_requests[0].to_string() == b"110 6 3 { 1 1 3 5 7 9 }\n"
+    assert get_read_ranges(c, 6) == [ (1, 1), (3, 5), (7, 9) ]
+    assert len(c.mock_get_request_calls(Requests.QUERY_READ_TEXTS)) == 1
+
+def test_leave_conf_invalidates_cached_read_ranges():
+    c = create_logged_in_connection_with_read_ranges(6, [ (1, 5) ])
+    get_read_ranges(c, 6)
+
+    c._handle_async_message(create_leave_conf_message(6))
+    get_read_ranges(c, 6)
+
+    assert len(c.mock_get_request_calls(Requests.QUERY_READ_TEXTS)) == 2
+
+def create_connection_with_unread_texts(conf_no, read_ranges, highest_local_no, **kwargs):
+    c = create_logged_in_connection_with_read_ranges(conf_no, read_ranges, **kwargs)
+    c.mock_request(Requests.GET_UCONF_STAT, create_uconf_stat_handler(highest_local_no))
+    c.mock_request(Requests.LOCAL_TO_GLOBAL, create_local_to_global_handler(highest_local_no))
+    return c
+
+def test_clear_caches_frees_all_cached_structures():
+    c = create_connection_with_unread_texts(6, [ (1, 5) ], 10)
+    c.mock_request(Requests.GET_MEMBERSHIP, lambda request: [
+        Membership11(position=0, conference=6) ])
+    c.get_memberships(17, 0, 1)
+    assert c.get_unread_texts(17, 6) == [6, 7, 8, 9, 10]
+    info = c.cache_info()
+    for name in [ 'LocalToGlobal', 'UnreadTexts', 'MembershipPosition' ]:
+        assert info[name]['entries'] > 0
+        assert info[name]['bytes'] > 0
+
+    c.clear_caches()
+
+    info = c.cache_info()
+    assert sum(i['entries'] for i in info.values()) == 0
+    assert c.get_unread_texts(17, 6) == [6, 7, 8, 9, 10]
+    assert len(c.mock_get_request_calls(Requests.LOCAL_TO_GLOBAL)) == 2
+
+def test_unread_texts_are_kept_up_to_date_locally():
+    c = create_connection_with_unread_texts(6, [ (1, 5) ], 10)
+    assert c.get_unread_texts(17, 6) == [6, 7, 8, 9, 10]
+
+    c.mark_as_read_local(6, 7)
+    c._handle_async_message(create_new_text_message(4711, [ (6, 11) ]))
+    c._handle_async_message(create_deleted_text_message(9, [ (6, 9) ]))
+
+    assert c.get_unread_texts(17, 6) == [6, 8, 10, 4711]
+    c.mark_as_unread_local(6, 7)
+    assert c.get_unread_texts(17, 6) == [6, 7, 8, 10, 4711]
+    assert len(c.mock_get_request_calls(Requests.QUERY_READ_TEXTS)) == 1
+    assert len(c.mock_get_request_calls(Requests.LOCAL_TO_GLOBAL)) == 1
+
+def test_get_unread_texts_many_fetches_in_two_bursts():
+    read_ranges = { 6: [ (1, 5) ], 7: [ (1, 590) ] }
+    def handle_query_read_texts_request(request):
+        if request.conference not in read_ranges:
+            raise NotMember(request.conference)
+        return Membership11(conference=request.conference, read_ranges=[
+            ReadRange(f, l) for f, l in read_ranges[request.conference] ])
+    c = MockConnection()
+    c.mock_request(Requests.QUERY_READ_TEXTS, handle_query_read_texts_request)
+    c.mock_request(Requests.GET_UCONF_STAT, create_uconf_stat_handler(600))
+    c.mock_request(Requests.LOCAL_TO_GLOBAL, create_local_to_global_handler(600))
+    c.login(17, "")
+    bursts = []
+    request_many = c.mock_client.request_many
+    def record_request_many(reqs, return_exceptions=False):
+        bursts.append(sorted(req.CALL_NO for req in reqs))
+        return request_many(reqs, return_exceptions)
+    c.mock_client.request_many = record_request_many
+
+    unread = c.get_unread_texts_many(17, [ 6, 7, 8 ])
+
+    assert unread == { 6: list(range(6, 601)), 7: list(range(591, 601)) }
+    assert bursts == [ sorted([ Requests.QUERY_READ_TEXTS, Requests.GET_UCONF_STAT ] * 3),
+                       [ Requests.LOCAL_TO_GLOBAL ] * 4 ]
+    # Now kept up to date locally
+    assert c.get_unread_texts_many(17, [ 6, 7 ]) == unread
+    assert len(bursts) == 2
+
+@pytest.mark.parametrize("stale_while_revalidate", [ False, True ])
+def test_unread_texts_are_computed_again_after_new_recipient(stale_while_revalidate):
+    c = create_connection_with_unread_texts(
+        6, [ (1, 5) ], 10, stale_while_revalidate=stale_while_revalidate)
+    c.get_unread_texts(17, 6)
+
+    msg = AsyncNewRecipient()
+    msg.text_no = 4711
+    msg.conf_no = 6
+    msg.type = MIR_TO
+    c._handle_async_message(msg)
+    c.mock_request(Requests.GET_UCONF_STAT, create_uconf_stat_handler(11))
+    c.mock_request(Requests.LOCAL_TO_GLOBAL, create_local_to_global_handler(11))
+
+    assert c.get_unread_texts(17, 6) == [6, 7, 8, 9, 10, 11]
+    assert len(c.mock_get_request_calls(Requests.QUERY_READ_TEXTS)) == 1
+
+def test_client_request_in_background_calls_callback_when_response_is_read():
+    s = MockSocket([b"LysKOM\n", b"=1 3Hfoo\n=2 3Hbar\n"])
+    client = Client(Connection(s))
+    results = []
+
+    client.request_in_background(ReqGetText(1), lambda resp, error: results.append((resp, error)))
+    assert results == []
+
+    assert client.request(ReqGetText(2)) == b"bar"
+    assert results == [ (b"foo", None) ]
+
+def test_client_wait_for_background_reads_until_callback_is_called():
+    s = MockSocket([b"LysKOM\n", b"=1 3Hfoo\n=2 3Hbar\n"])
+    client = Client(Connection(s))
+    results = []
+
+    client.request_in_background(ReqGetText(1), lambda resp, error: results.append(resp))
+    ref_no = client.request_in_background(ReqGetText(2), lambda resp, error: results.append(resp))
+    client.wait_for_background(ref_no)
+
+    assert results == [ b"foo", b"bar" ]
+
+def test_client_cancel_background_throws_away_response():
+    s = MockSocket([b"LysKOM\n", b"=1 3Hfoo\n=2 3Hbar\n"])
+    client = Client(Connection(s))
+    results = []
+
+    ref_no = client.request_in_background(ReqGetText(1), lambda resp, error: results.append(resp))
+    client.cancel_background(ref_no)
+    client.wait_for_background(ref_no)
+
+    assert client.request(ReqGetText(2)) == b"bar"
+    assert results == []
+
+class QueueConnection(object):
+    """Connection where the test decides when (and in which order)
+    the responses arrive.
+    """
+    def __init__(self):
+        self.sent = []
+        self.responses = queue.Queue()
+        self._lock = threading.Lock()
+
+    def send_request(self, request):
+        with self._lock:
+            self.sent.append(request)
+            return len(self.sent)
+
+    def read_response(self):
+        return self.responses.get(timeout=5)
+
+def wait_for(condition):
+    deadline = time.time() + 5
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.001)
+
+def test_client_multiplexes_requests_from_several_threads():
+    conn = QueueConnection()
+    client = Client(conn)
+    results = {}
+    def request(text_no):
+        results[text_no] = client.request(ReqGetText(text_no))
+    threads = [ threading.Thread(target=request, args=(text_no,)) for text_no in (1, 2, 3) ]
+    for t in threads:
+        t.start()
+
+    # All requests are sent while one of the threads waits for a
+    # response
+    wait_for(lambda: len(conn.sent) == 3)
+    for ref_no in (3, 2, 1):
+        text_no = conn.sent[ref_no - 1].text_no
+        conn.responses.put((ref_no, b"text %d" % (text_no,), None))
+    for t in threads:
+        t.join()
+
+    assert results == { 1: b"text 1", 2: b"text 2", 3: b"text 3" }
+
+
+def create_stale_while_revalidate_cache():
+    fetched = []
+    refreshes = []
+    def fetcher(no):
+        fetched.append(no)
+        return "fetched %d" % (no,)
+    c = Cache(fetcher, "Test", refresher=lambda no, callback: refreshes.append(callback))
+    return c, fetched, refreshes
+
+def test_cache_stale_while_revalidate_returns_stale_value_and_refreshes_once():
+    c, fetched, refreshes = create_stale_while_revalidate_cache()
+    c[1]
+    c.invalidate(1)
+
+    assert c[1] == "fetched 1"
+    assert c[1] == "fetched 1"
+    assert len(refreshes) == 1
+
+    refreshes[0]("refreshed 1", None)
+
+    assert c[1] == "refreshed 1"
+    assert fetched == [1]
+
+def test_cache_stale_while_revalidate_get_fresh_does_not_return_stale_value():
+    c, fetched, refreshes = create_stale_while_revalidate_cache()
+    c[1] = "old"
+    c.invalidate(1)
+
+    assert c.get_fresh(1) == "fetched 1"
+    assert fetched == [1]
+
+def test_cache_stale_while_revalidate_refreshes_again_if_invalidated_during_refresh():
+    c, fetched, refreshes = create_stale_while_revalidate_cache()
+    c[1] = "old"
+    c.invalidate(1)
+    c[1]
+    c.invalidate(1)
+
+    refreshes[0]("maybe outdated", None)
+
+    assert c[1] == "maybe outdated"
+    assert len(refreshes) == 2
+    refreshes[1]("new", None)
+    assert c[1] == "new"
+
+def test_cache_stale_while_revalidate_drops_stale_value_on_refresh_error():
+    c, fetched, refreshes = create_stale_while_revalidate_cache()
+    c[1] = "old"
+    c.invalidate(1)
+    c[1]
+
+    refreshes[0](None, NoSuchText())
+
+    assert c[1] == "fetched 1"
+    assert fetched == [1]
+
+def test_cache_without_refresher_does_not_keep_stale_values():
+    c = Cache(lambda no: "fetched", "Test")
+    c[1] = "old"
+    c.invalidate(1)
+
+    assert c[1] == "fetched"
+
+def test_cache_store_ignores_values_fetched_before_invalidation():
+    c = Cache(lambda no: None, "Test")
+    generation = c.generation
+    c.invalidate(1)
+
+    assert not c.store(1, "old", generation)
+    assert c.peek(1) is None
+    assert c.store(1, "new", c.generation)
+    assert c.peek(1) == "new"
+
+@pytest.mark.parametrize("make_cache", [
+    lambda fetcher: Cache(fetcher, "Test"),
+    lambda fetcher: SizeBoundedCache(fetcher, "Test", max_bytes=100, sizeof=lambda v: 10),
+])
+def test_cache_concurrent_gets_and_invalidations(make_cache):
+    # The "server" values are changed (and the cache invalidated) while
+    # other threads fetch them. In the end, no outdated value may
+    # remain in the cache.
+    server = dict((no, 0) for no in range(5))
+    def fetcher(no):
+        val = server[no]
+        time.sleep(0.0001)
+        return val
+    c = make_cache(fetcher)
+    errors = []
+
+    def reader():
+        try:
+            for i in range(500):
+                c[i % 5]
+        except Exception as e:
+            errors.append(e)
+
+    def writer():
+        for i in range(200):
+            no = i % 5
+            server[no] += 1
+            c.invalidate(no)
+
+    threads = [ threading.Thread(target=reader) for i in range(4) ]
+    threads.append(threading.Thread(target=writer))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    for no in range(5):
+        assert c.peek(no) in (None, server[no])
+
+def test_async_messages_racing_with_memberships_and_unread_texts():
+    # A "server" where conference 8 is joined and left, and new texts
+    # are written in conference 6, while other threads get the
+    # memberships and the unread texts. Like the real server, the
+    # async message is sent after each change. Fetches that were in
+    # progress during a change must not be cached, so every result
+    # must match a server state that was current during the call,
+    # or later than the last change the client had been told about.
+    lock = threading.Lock()
+    # All server states, as (membership conf_nos, highest local
+    # number in conference 6). Local text n is global text n.
+    states = [ ((5, 6, 7), 10) ]
+    delivered = [ 0 ]
+    def current_state():
+        with lock:
+            state = states[-1]
+        # Let the writer change things while the response is "sent"
+        time.sleep(0.0002)
+        return state
+    def handle_get_membership_request(request):
+        return [ Membership11(position=pos, conference=conf_no)
+                 for pos, conf_no in enumerate(current_state()[0]) ]
+    def handle_query_read_texts_request(request):
+        conf_nos = current_state()[0]
+        if request.conference not in conf_nos:
+            raise NotMember(request.conference)
+        return Membership11(position=conf_nos.index(request.conference),
+                            conference=request.conference,
+                            read_ranges=[ ReadRange(1, 5) ])
+    def handle_get_uconf_stat_request(request):
+        return UConference(b"Conf", highest_local_no=current_state()[1])
+    def handle_local_to_global_request(request):
+        return create_local_to_global_handler(current_state()[1])(request)
+    c = MockConnection()
+    c.mock_request(Requests.GET_MEMBERSHIP, handle_get_membership_request)
+    c.mock_request(Requests.QUERY_READ_TEXTS, handle_query_read_texts_request)
+    c.mock_request(Requests.GET_UCONF_STAT, handle_get_uconf_stat_request)
+    c.mock_request(Requests.LOCAL_TO_GLOBAL, handle_local_to_global_request)
+    c.login(17, "")
+    writer_done = threading.Event()
+    errors = []
+
+    def check(func, expected_from_state):
+        with lock:
+            first = delivered[0]
+        result = func()
+        with lock:
+            possible = [ expected_from_state(state) for state in states[first:] ]
+        assert result in possible, (result, possible[:2])
+
+    def reader():
+        try:
+            while not writer_done.is_set() and not errors:
+                check(lambda: [ m.conference for m in c.get_memberships(17, 0, 3)[:3] ],
+                      lambda state: list(state[0][:3]))
+                check(lambda: c.get_unread_texts(17, 6),
+                      lambda state: list(range(6, state[1] + 1)))
+        except Exception as e:
+            errors.append(e)
+
+    def change(conf_nos, highest_local_no, msg):
+        with lock:
+            states.append((tuple(conf_nos), highest_local_no))
+            version = len(states) - 1
+        c._handle_async_message(msg)
+        with lock:
+            delivered[0] = version
+
+    def writer():
+        for i in range(100):
+            conf_nos, highest_local_no = states[-1]
+            if 8 in conf_nos:
+                conf_nos = [ conf_no for conf_no in conf_nos if conf_no != 8 ]
+                change(conf_nos, highest_local_no, create_leave_conf_message(8))
+            else:
+                conf_nos = list(conf_nos)
+                conf_nos.insert(i % 4, 8)
+                change(conf_nos, highest_local_no, create_new_membership_message(17, 8))
+            time.sleep(0.001)
+            change(conf_nos, highest_local_no + 1, create_new_text_message(
+                highest_local_no + 1, [ (6, highest_local_no + 1) ]))
+            time.sleep(0.001)
+        writer_done.set()
+
+    threads = [ threading.Thread(target=reader) for i in range(4) ]
+    threads.append(threading.Thread(target=writer))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+
+def test_estimate_size_counts_shared_objects_once():
+    body = b'x' * 1000
+    one = estimate_size([body])
+    two = estimate_size([body, body])
+
+    assert one > 1000
+    assert two - one < 100
+
+def test_estimate_size_includes_attributes():
+    small = Membership11(position=0, conference=6)
+    large = Membership11(position=0, conference=6,
+                         read_ranges=ReadRangeSet((n, n) for n in range(1, 2000, 2)))
+
+    assert estimate_size(large) - estimate_size(small) > 1000 * 2 * 4
+
+def test_cache_size_is_updated_on_set_and_invalidate():
+    c = Cache(lambda no: b'x' * no, "Test", sizeof=len)
+    c[10]
+    c[20]
+    assert c.size == 30
+    c[10] = b'x' * 15
+    assert c.size == 35
+    c.invalidate(20)
+    assert c.size == 15
+    c.invalidate_all()
+    assert c.size == 0
+
+def test_cache_size_includes_stale_entries():
+    c, fetched, refreshes = create_stale_while_revalidate_cache()
+    c.sizeof = len
+    c[1] = b'x' * 10
+    c.invalidate(1)
+    assert c.size == 10
+    c.get_fresh(1)
+    assert c.size == len("fetched 1")
+
+def test_cache_update_measures_value_again():
+    c = Cache(lambda no: None, "Test", sizeof=len)
+    c[1] = [1]
+    c.update(1, lambda val: val.extend([2, 3]))
+
+    assert c.size == 3
+
+def test_size_bounded_cache_size_is_updated_on_evict():
+    c = SizeBoundedCache(lambda no: b'x' * 10, max_bytes=40, large_entry_bytes=20,
+                         large_share=0.25)
+    for no in range(5):
+        c[no]
+
+    assert c.info()['entries'] == 3
+    assert c.size == 30
+
+def test_cache_info():
+    c = create_connection({ Requests.GET_TEXT: lambda request: b'body' })
+    c.textbodies[1]
+    c.textbodies[1]
+
+    info = c.cache_info()
+    assert set(info.keys()) == set(['UConference', 'Conference', 'Person',
+                                    'TextStat', 'TextBody', 'LocalToGlobal',
+                                    'CaseInsensitiveRegexp'])
+    assert info['TextBody']['entries'] == 1
+    assert info['TextBody']['bytes'] == 4
+    assert info['TextBody']['hits'] == 1
+    assert info['TextBody']['misses'] == 1
+    assert info['TextStat']['entries'] == 0
+
+def test_cache_info_of_other_structures_follows_changes():
+    c = create_connection_with_unread_texts(6, [ (1, 5) ], 10)
+    c.mock_request(Requests.GET_MEMBERSHIP, lambda request: [
+        Membership11(position=pos, conference=conf_no)
+        for pos, conf_no in enumerate([ 5, 6 ]) ])
+    c.get_memberships(17, 0, 2)
+    c.get_unread_texts(17, 6)
+    def entries_and_bytes(name):
+        info = c.cache_info()[name]
+        return info['entries'], info['bytes']
+    unread_before = entries_and_bytes('UnreadTexts')
+    l2g_before = entries_and_bytes('LocalToGlobal')
+    assert unread_before[0] == 5
+    assert l2g_before[0] == 5
+
+    c._handle_async_message(create_new_text_message(4711, [ (6, 11) ]))
+    c.mark_as_read_local(6, 7)
+    c.mark_as_read_local(6, 8)
+
+    unread_after = entries_and_bytes('UnreadTexts')
+    assert unread_after[0] == 4
+    assert entries_and_bytes('LocalToGlobal')[0] == 6
+    assert entries_and_bytes('LocalToGlobal')[1] >= l2g_before[1]
+
+    c._handle_async_message(create_leave_conf_message(5))
+    assert entries_and_bytes('MembershipPosition')[0] == 1
+    c._handle_async_message(create_leave_conf_message(6))
+    assert entries_and_bytes('UnreadTexts') == (0, 0)
+    assert entries_and_bytes('MembershipPosition') == (0, 0)
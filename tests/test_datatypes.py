@@ -5,7 +5,8 @@ from .mocks import MockSocket
 
 from pylyskom.errors import ReceiveError
 from pylyskom.connection import ReceiveBuffer
-from pylyskom.datatypes import ArrayInt32, Int32, String, ConfType, ExtendedConfType
+from pylyskom.datatypes import (
+    ArrayInt32, Int32, String, ConfType, ExtendedConfType, ReadRange, ReadRangeSet)
 
 
 def test_Array_can_parse_empty_array_with_star_format():
@@ -232,3 +233,62 @@ def test_ArrayInt32_extend_convert_element():
     b = [4, 5, 6]
     a.extend(b)
     assert a.to_string() == b"6 { 1 2 3 4 5 6 }"
+
+
+def test_ReadRangeSet_parse():
+    s = MockSocket(b"3 { 1 3 4 4 7 9 }")
+    buf = ReceiveBuffer(s)
+    res = ReadRangeSet.parse(buf)
+    # Adjacent ranges are merged
+    assert res == ReadRangeSet([ (1, 4), (7, 9) ])
+    assert [ (rr.first_read, rr.last_read) for rr in res ] == [ (1, 4), (7, 9) ]
+
+def test_ReadRangeSet_to_string():
+    assert ReadRangeSet().to_string() == b"0 { }"
+    assert ReadRangeSet([ ReadRange(7, 9), ReadRange(1, 3) ]).to_string() == b"2 { 1 3 7 9 }"
+
+def test_ReadRangeSet_is_list_compatible():
+    rrs = ReadRangeSet([ (3, 5) ])
+    rrs.append(ReadRange(8, 8))
+    rrs.append(ReadRange(1, 1))
+    assert [ (rr.first_read, rr.last_read) for rr in rrs[1:] ] == [ (3, 5), (8, 8) ]
+    assert (rrs[-1].first_read, rrs[-1].last_read) == (8, 8)
+    with pytest.raises(IndexError):
+        rrs[3]
+
+def test_ReadRangeSet_is_read():
+    rrs = ReadRangeSet([ (3, 5), (8, 8) ])
+    assert [ n for n in range(1, 11) if rrs.is_read(n) ] == [3, 4, 5, 8]
+
+@pytest.mark.parametrize("first, last, expected", [
+    (1, 1, [ (1, 1), (3, 5), (8, 8) ]),
+    (2, 2, [ (2, 5), (8, 8) ]),
+    (6, 7, [ (3, 8) ]),
+    (4, 20, [ (3, 20) ]),
+    (10, 12, [ (3, 5), (8, 8), (10, 12) ]),
+])
+def test_ReadRangeSet_mark_read(first, last, expected):
+    rrs = ReadRangeSet([ (3, 5), (8, 8) ])
+    rrs.mark_read(first, last)
+    assert rrs == ReadRangeSet(expected)
+    assert len(rrs) == len(expected)
+
+@pytest.mark.parametrize("first, last, expected", [
+    (1, 2, [ (3, 5), (8, 8) ]),
+    (4, 4, [ (3, 3), (5, 5), (8, 8) ]),
+    (5, 8, [ (3, 4) ]),
+    (1, 20, []),
+])
+def test_ReadRangeSet_mark_unread(first, last, expected):
+    rrs = ReadRangeSet([ (3, 5), (8, 8) ])
+    rrs.mark_unread(first, last)
+    assert rrs == ReadRangeSet(expected)
+    assert len(rrs) == len(expected)
+
+def test_ReadRangeSet_gaps_and_unread_count():
+    rrs = ReadRangeSet([ (3, 5), (8, 8) ])
+    assert rrs.gaps() == [ (1, 2), (6, 2) ]
+    assert rrs.gaps(last=10) == [ (1, 2), (6, 2), (9, 2) ]
+    assert rrs.gaps(4, 7) == [ (6, 2) ]
+    assert rrs.no_of_unread(10) == 6
+    assert ReadRangeSet().gaps() == []
@@ -1,14 +1,20 @@
 # -*- coding: utf-8 -*-
 
 import base64
+import threading
+import time
 
+import pytest
 from mock import MagicMock
 
-from pylyskom import komauxitems
+from pylyskom import komauxitems, utils
 from pylyskom.requests import Requests
-from pylyskom.komsession import KomSession
+from pylyskom.komsession import (
+    KomSession, KomSessionNotConnected, KomText, ReadAheadWindow, SessionStateLock)
 from pylyskom.errors import NoSuchText
-from pylyskom.datatypes import AuxItemInput, Time
+from pylyskom.datatypes import (
+    AuxItemInput, MICommentIn, MIC_COMMENT, MIRecipient, MIR_TO, Membership11,
+    TextMapping, Time)
 from .mocks import MockConnection, MockTextStat, MockPerson
 
 
@@ -143,6 +149,35 @@ def test_set_user_area__creates_new_user_area_for_person_that_has_no_previous_us
     assert set_ua_requests[0].user_area == new_ua_text_no
 
 
+def test_set_user_area__updates_cached_person():
+    c = create_mockconnection()
+    ks = create_komsession(17, c)
+    c.mock_request(Requests.GET_PERSON_STAT, lambda request: MockPerson(user_area=12345))
+    c.mock_request(Requests.CREATE_TEXT, lambda request: 67890)
+    c.mock_request(Requests.GET_TEXT, lambda request: b'8H 5Hjskom 2H{}')
+
+    ks.set_user_area_block(42, b'jskom', { 'filtered-authors': [18] })
+    block = ks.get_user_area_block(42, b'jskom')
+
+    assert block == { 'filtered-authors': [18] }
+    assert len(c.mock_get_request_calls(Requests.GET_PERSON_STAT)) == 2 # including login
+    # The new user area is already decoded, and the old one is only
+    # decoded once.
+    assert [ r.text_no for r in c.mock_get_request_calls(Requests.GET_TEXT) ] == [12345]
+
+
+def test_get_user_area__returns_copies_of_cached_blocks():
+    c = create_mockconnection()
+    ks = create_komsession(17, c)
+    c.mock_request(Requests.GET_PERSON_STAT, lambda request: MockPerson(user_area=12345))
+    c.mock_request(Requests.GET_TEXT, lambda request: b'8H 5Hjskom 10H{"a": [1]}')
+
+    block = ks.get_user_area_block(42, b'jskom')
+    block['a'].append(2)
+
+    assert ks.get_user_area_block(42, b'jskom') == { 'a': [1] }
+
+
 def test_set_user_area__person_has_user_area_but_text_does_not_exist():
     user_area_text_no = 12345
     c = create_mockconnection()
@@ -153,6 +188,7 @@ def test_set_user_area__person_has_user_area_but_text_does_not_exist():
     def get_text_stat(request):
         raise NoSuchText(request.text_no)
     c.mock_request(Requests.GET_TEXT_STAT, get_text_stat)
+    c.mock_request(Requests.GET_TEXT, lambda request: b'')
 
     try:
         ks.set_user_area_block(42, b'jskom', {}) # should throw NoSuchText
@@ -163,7 +199,8 @@ def test_set_user_area__person_has_user_area_but_text_does_not_exist():
     except:
         assert False
 
-    assert len(c.mock_get_request_calls(Requests.GET_TEXT)) == 0
+    # The text body is requested in the same burst as the text stat,
+    # but nothing is created.
     assert len(c.mock_get_request_calls(Requests.CREATE_TEXT)) == 0
     assert len(c.mock_get_request_calls(Requests.SET_USER_AREA)) == 0
 
@@ -268,3 +305,453 @@ def test_create_text():
     assert len(create_text_requests) == 1
     r = create_text_requests[0]
     assert r.text == b'some subject\nsome body'
+
+
+def test_get_text_caches_text_body():
+    c = create_mockconnection()
+    c.mock_request(Requests.GET_TEXT, lambda request: b'8H 5Hjskom 3Hhej')
+    ks = create_komsession(17, c)
+
+    ks.get_text(12345)
+    ks.get_text(12345)
+
+    assert len(c.mock_get_request_calls(Requests.GET_TEXT)) == 1
+
+
+def test_clear_caches_frees_cache_memory():
+    c = create_mockconnection()
+    c.mock_request(Requests.GET_TEXT, lambda request: b'8H 5Hjskom 3Hhej')
+    ks = create_komsession(17, c)
+    ks.get_text(12345)
+    assert ks.cache_bytes() > 0
+
+    ks.clear_caches()
+
+    assert ks.cache_bytes() == 0
+    ks.get_text(12345)
+    assert len(c.mock_get_request_calls(Requests.GET_TEXT)) == 2
+
+
+def test_get_text_sends_text_stat_and_body_requests_in_one_burst():
+    c = create_mockconnection()
+    c.mock_request(Requests.GET_TEXT_STAT, lambda request: MockTextStat())
+    c.mock_request(Requests.GET_TEXT, lambda request: b'8H 5Hjskom 3Hhej')
+    bursts = record_bursts(c)
+    ks = create_komsession(17, c)
+
+    text = ks.get_text(12345)
+
+    assert bursts == [ [ Requests.GET_TEXT_STAT, Requests.GET_TEXT ] ]
+    assert text.text_no == 12345
+
+
+def test_get_texts_fetches_only_missing_entries_and_keeps_order():
+    c = create_mockconnection()
+    c.mock_request(Requests.GET_TEXT_STAT, lambda request: MockTextStat())
+    c.mock_request(Requests.GET_TEXT, lambda request: b'subject\nbody')
+    ks = create_komsession(17, c)
+    ks.get_text(2)
+
+    texts = ks.get_texts([ 1, 2, 3, 1 ])
+
+    assert [ t.text_no for t in texts ] == [ 1, 2, 3, 1 ]
+    assert [ r.text_no for r in c.mock_get_request_calls(Requests.GET_TEXT) ] == [ 2, 1, 3 ]
+    assert [ r.text_no for r in c.mock_get_request_calls(Requests.GET_TEXT_STAT) ] == [ 2, 1, 3 ]
+
+
+def test_get_texts_raises_first_error():
+    c = create_mockconnection()
+    def get_text_stat(request):
+        if request.text_no == 2:
+            raise NoSuchText(request.text_no)
+        return MockTextStat()
+    c.mock_request(Requests.GET_TEXT_STAT, get_text_stat)
+    c.mock_request(Requests.GET_TEXT, lambda request: b'subject\nbody')
+    ks = create_komsession(17, c)
+
+    try:
+        ks.get_texts([ 1, 2, 3 ])
+        assert False
+    except NoSuchText as e:
+        assert e.args[0] == 2
+    # The other texts were cached
+    assert 1 in c.textbodies and 3 in c.textstats
+
+
+def create_local_to_global_reverse_handler(highest_local):
+    # Local text n in the conference is global text 1000 + n
+    def handle_local_to_global_reverse_request(request):
+        ceiling = request.local_no_ceiling or highest_local + 1
+        mapping = TextMapping()
+        mapping.range_end = ceiling
+        mapping.range_begin = max(1, ceiling - request.no_of_existing_texts)
+        mapping.later_texts_exists = 1 if mapping.range_begin > 1 else 0
+        mapping.list = [ (i, 1000 + i) for i in range(mapping.range_begin, mapping.range_end) ]
+        return mapping
+    return handle_local_to_global_reverse_request
+
+
+def record_bursts(c):
+    bursts = []
+    request_many = c.mock_client.request_many
+    def record_request_many(reqs, return_exceptions=False):
+        bursts.append([ req.CALL_NO for req in reqs ])
+        return request_many(reqs, return_exceptions)
+    c.mock_client.request_many = record_request_many
+    return bursts
+
+
+def test_get_last_texts_paginates_with_cursor():
+    c = create_mockconnection()
+    c.mock_request(Requests.LOCAL_TO_GLOBAL_REVERSE, create_local_to_global_reverse_handler(5))
+    ks = create_komsession(17, c)
+
+    texts, cursor = ks.get_last_texts(7, 2)
+    assert [ t.text_no for t in texts ] == [ 1005, 1004 ]
+    texts, cursor = ks.get_last_texts(7, 2, cursor=cursor)
+    assert [ t.text_no for t in texts ] == [ 1003, 1002 ]
+    texts, cursor = ks.get_last_texts(7, 2, cursor=cursor)
+    assert [ t.text_no for t in texts ] == [ 1001 ]
+    assert cursor is None
+
+
+def test_get_last_texts_does_not_take_an_offset():
+    ks = create_komsession(17, create_mockconnection())
+
+    with pytest.raises(TypeError):
+        ks.get_last_texts(7, 2, 10)
+
+
+def test_get_last_texts_fetches_stats_and_bodies_in_one_burst():
+    c = create_mockconnection()
+    c.mock_request(Requests.LOCAL_TO_GLOBAL_REVERSE, create_local_to_global_reverse_handler(50))
+    c.mock_request(Requests.GET_TEXT, lambda request: b'subject\nbody')
+    bursts = record_bursts(c)
+    ks = create_komsession(17, c)
+
+    texts, cursor = ks.get_last_texts(7, 50, full_text=True)
+
+    assert len(texts) == 50
+    assert cursor is None
+    assert len(bursts) == 1
+    assert sorted(bursts[0]) == sorted([ Requests.GET_TEXT_STAT, Requests.GET_TEXT ] * 50)
+    assert len(c.mock_get_request_calls(Requests.LOCAL_TO_GLOBAL_REVERSE)) == 1
+
+
+
+def test_mark_texts_as_read_sends_one_request_per_conference_in_one_burst():
+    # Text n is local text n in conference 6, and texts 2 and 3 are
+    # local texts 10 + n in conference 7 as well.
+    def get_text_stat(request):
+        ts = MockTextStat()
+        recipients = [ (6, request.text_no) ]
+        if request.text_no in (2, 3):
+            recipients.append((7, 10 + request.text_no))
+        for conf_no, loc_no in recipients:
+            rcpt = MIRecipient(MIR_TO, conf_no)
+            rcpt.loc_no = loc_no
+            ts.misc_info.recipient_list.append(rcpt)
+        return ts
+    c = create_mockconnection()
+    c.mock_request(Requests.GET_TEXT_STAT, get_text_stat)
+    ks = create_komsession(17, c)
+    bursts = record_bursts(c)
+
+    ks.mark_texts_as_read([ 1, 2, 3 ])
+
+    assert bursts == [ [ Requests.GET_TEXT_STAT ] * 3, [ Requests.MARK_AS_READ ] * 2 ]
+    marked = dict((r.conf_no, r.texts) for r in c.mock_get_request_calls(Requests.MARK_AS_READ))
+    assert marked == { 6: [ 1, 2, 3 ], 7: [ 12, 13 ] }
+
+
+def test_mark_texts_as_read_skips_deleted_texts():
+    def get_text_stat(request):
+        if request.text_no == 2:
+            raise NoSuchText(2)
+        ts = MockTextStat()
+        rcpt = MIRecipient(MIR_TO, 6)
+        rcpt.loc_no = request.text_no
+        ts.misc_info.recipient_list.append(rcpt)
+        return ts
+    c = create_mockconnection()
+    c.mock_request(Requests.GET_TEXT_STAT, get_text_stat)
+    ks = create_komsession(17, c)
+
+    assert ks.mark_texts_as_read([ 1, 2, 3 ]) == [ 2 ]
+
+    marked = dict((r.conf_no, r.texts) for r in c.mock_get_request_calls(Requests.MARK_AS_READ))
+    assert marked == { 6: [ 1, 3 ] }
+
+
+def test_mark_as_read_raises_for_deleted_text():
+    def get_text_stat(request):
+        raise NoSuchText(request.text_no)
+    c = create_mockconnection()
+    c.mock_request(Requests.GET_TEXT_STAT, get_text_stat)
+    ks = create_komsession(17, c)
+
+    with pytest.raises(NoSuchText):
+        ks.mark_as_read(2)
+
+    assert c.mock_get_request_calls(Requests.MARK_AS_READ) == []
+
+
+def create_comment_tree_connection(comments):
+    # comments is a dict from text number to the numbers of its
+    # comments. Texts that are not in it don't exist.
+    def get_text_stat(request):
+        if request.text_no not in comments:
+            raise NoSuchText(request.text_no)
+        ts = MockTextStat()
+        ts.misc_info.comment_in_list = [ MICommentIn(MIC_COMMENT, text_no)
+                                         for text_no in comments[request.text_no] ]
+        return ts
+    c = create_mockconnection()
+    c.mock_request(Requests.GET_TEXT_STAT, get_text_stat)
+    return c
+
+
+def test_get_comment_tree_fetches_one_burst_per_level():
+    c = create_comment_tree_connection({ 1: [ 2, 3 ], 2: [ 4 ], 3: [ 4, 5 ], 4: [], 5: [ 6 ] })
+    ks = create_komsession(17, c)
+    bursts = record_bursts(c)
+
+    tree = ks.get_comment_tree(1)
+
+    assert [ len(b) for b in bursts ] == [ 2, 2, 1 ]
+    assert tree.children == { 1: [ 2, 3 ], 2: [ 4 ], 3: [ 5 ], 4: [], 5: [] }
+    assert list(tree.walk()) == [ (0, 1), (1, 2), (2, 4), (1, 3), (2, 5) ]
+    assert not tree.truncated
+    # The text stats are shared with the cache
+    assert ks.get_text_stat(4) is tree.text_stats[4]
+
+
+@pytest.mark.parametrize("max_depth, max_nodes, expected", [
+    (0, None, [ 1 ]),
+    (1, None, [ 1, 2, 3 ]),
+    (None, 2, [ 1, 2 ]),
+    (None, 4, [ 1, 2, 4, 3 ]),
+])
+def test_get_comment_tree_is_truncated(max_depth, max_nodes, expected):
+    c = create_comment_tree_connection({ 1: [ 2, 3 ], 2: [ 4 ], 3: [ 5 ], 4: [], 5: [] })
+    ks = create_komsession(17, c)
+
+    tree = ks.get_comment_tree(1, max_depth=max_depth, max_nodes=max_nodes)
+
+    assert [ text_no for depth, text_no in tree.walk() ] == expected
+    assert tree.truncated
+
+
+def test_read_ahead_window_grows_when_waiting_and_shrinks_when_in_time():
+    window = ReadAheadWindow(size=2, min_size=1, max_size=6)
+    window.update(True)
+    assert window.size == 4
+    window.update(True)
+    assert window.size == 6
+    for i in range(ReadAheadWindow.SHRINK_AFTER * 10):
+        window.update(False)
+    assert window.size == 1
+
+
+def test_iter_unread_texts_yields_texts_in_order_and_reads_ahead():
+    c = create_mockconnection()
+    c.mock_request(Requests.GET_TEXT, lambda request: b'subject\nbody')
+    c.get_unread_texts = lambda pers_no, conf_no: [ 11, 12, 13, 14, 15, 16 ]
+    ks = create_komsession(17, c)
+
+    texts = ks.iter_unread_texts(7, min_window=2, max_window=2)
+    first = next(texts)
+
+    assert first.text_no == 11
+    # The current text and the two after it
+    assert [ r.text_no for r in c.mock_get_request_calls(Requests.GET_TEXT) ] == [ 11, 12, 13 ]
+    assert [ t.text_no for t in texts ] == [ 12, 13, 14, 15, 16 ]
+    assert len(c.mock_get_request_calls(Requests.GET_TEXT)) == 6
+
+
+def test_iter_unread_texts_stops_prefetching_when_closed():
+    c = create_mockconnection()
+    c.mock_request(Requests.GET_TEXT, lambda request: b'subject\nbody')
+    c.get_unread_texts = lambda pers_no, conf_no: list(range(100, 200))
+    ks = create_komsession(17, c)
+
+    texts = ks.iter_unread_texts(7, min_window=1, max_window=4)
+    next(texts)
+    next(texts)
+    texts.close()
+
+    assert len(c.mock_get_request_calls(Requests.GET_TEXT)) <= 2 + 4
+
+
+def test_iter_unread_texts_skips_deleted_texts():
+    c = create_mockconnection()
+    def get_text_stat(request):
+        if request.text_no == 12:
+            raise NoSuchText(12)
+        return MockTextStat(creation_time=Time())
+    c.mock_request(Requests.GET_TEXT_STAT, get_text_stat)
+    c.mock_request(Requests.GET_TEXT, lambda request: b'subject\nbody')
+    ks = create_komsession(17, c)
+    c.get_unread_texts = lambda pers_no, conf_no: [ 11, 12, 13 ]
+
+    assert [ t.text_no for t in ks.iter_unread_texts(7) ] == [ 11, 13 ]
+
+
+def test_iter_unread_texts_raises_not_connected_after_disconnect():
+    c = create_mockconnection()
+    c.mock_request(Requests.GET_TEXT, lambda request: b'subject\nbody')
+    c.get_unread_texts = lambda pers_no, conf_no: list(range(100, 200))
+    ks = create_komsession(17, c)
+    texts = ks.iter_unread_texts(7)
+    next(texts)
+
+    ks.disconnect()
+
+    with pytest.raises(KomSessionNotConnected):
+        next(texts)
+    texts.close()
+
+
+def test_get_memberships_unread_fetches_memberships_in_one_burst():
+    c = create_mockconnection()
+    c.mock_request(Requests.GET_UNREAD_CONFS, lambda request: [ 6, 7, 8 ])
+    c.mock_request(Requests.QUERY_READ_TEXTS,
+                   lambda request: Membership11(conference=request.conference))
+    ks = create_komsession(17, c)
+    bursts = record_bursts(c)
+
+    memberships, has_more = ks.get_memberships(17, 0, 10, unread=True)
+
+    assert [ m.conference for m in memberships ] == [ 6, 7, 8 ]
+    assert bursts == [ [ Requests.QUERY_READ_TEXTS ] * 3 ]
+
+
+def test_session_state_lock_is_reentrant():
+    lock = SessionStateLock()
+    lock.acquire_exclusive()
+    lock.acquire_shared()
+    lock.acquire_exclusive()
+    lock.release()
+    lock.release()
+    lock.release()
+    lock.acquire_shared()
+    lock.acquire_shared()
+    try:
+        lock.acquire_exclusive()
+        assert False
+    except RuntimeError:
+        pass
+    lock.release()
+    lock.release()
+
+
+def test_change_conference_waits_for_requests_in_progress():
+    c = create_mockconnection()
+    in_get_text = threading.Event()
+    release_get_text = threading.Event()
+    def get_text(request):
+        in_get_text.set()
+        release_get_text.wait(5)
+        return b'subject\nbody'
+    c.mock_request(Requests.GET_TEXT, get_text)
+    ks = create_komsession(17, c)
+    threads = [ threading.Thread(target=ks.get_text, args=(1,)),
+                threading.Thread(target=ks.change_conference, args=(6,)) ]
+
+    threads[0].start()
+    in_get_text.wait(5)
+    threads[1].start()
+    time.sleep(0.05)
+    assert len(c.mock_get_request_calls(Requests.CHANGE_CONFERENCE)) == 0
+    release_get_text.set()
+    for t in threads:
+        t.join()
+
+    assert len(c.mock_get_request_calls(Requests.CHANGE_CONFERENCE)) == 1
+
+
+@pytest.mark.parametrize("method", [ 'who_am_i', 'disconnect' ])
+def test_call_waiting_behind_disconnect_raises_not_connected(method):
+    c = create_mockconnection()
+    in_disconnect = threading.Event()
+    release_disconnect = threading.Event()
+    def disconnect(request):
+        in_disconnect.set()
+        release_disconnect.wait(5)
+    c.mock_request(Requests.DISCONNECT, disconnect)
+    ks = create_komsession(17, c)
+    errors = []
+    def call():
+        try:
+            getattr(ks, method)()
+        except Exception as e:
+            errors.append(e)
+    threads = [ threading.Thread(target=ks.disconnect),
+                threading.Thread(target=call) ]
+
+    threads[0].start()
+    in_disconnect.wait(5)
+    threads[1].start()
+    time.sleep(0.05)
+    release_disconnect.set()
+    for t in threads:
+        t.join()
+
+    assert len(errors) == 1
+    assert isinstance(errors[0], KomSessionNotConnected)
+    assert len(c.mock_get_request_calls(Requests.DISCONNECT)) == 1
+
+
+def create_text_stat(content_type):
+    ts = MockTextStat(creation_time=Time())
+    ts.aux_items.append(
+        AuxItemInput(tag=komauxitems.AI_CONTENT_TYPE, data=content_type))
+    return ts
+
+def test_komtext_decodes_subject_and_body():
+    text = KomText(text_no=1, text=b'\xe5\xe4\xf6\nbody',
+                   text_stat=create_text_stat(b'text/plain;charset=iso-8859-1'))
+
+    assert text.content_type == 'text/plain'
+    assert text.subject == u'\xe5\xe4\xf6'
+    assert text.body == u'body'
+
+def test_komtext_decodes_nothing_until_used(monkeypatch):
+    decoded = []
+    def decode_text(text, encoding):
+        decoded.append(text)
+        return text.decode('latin1')
+    monkeypatch.setattr(utils, 'decode_text', decode_text)
+    text = KomText(text_no=1, text=b'subject\nbody',
+                   text_stat=create_text_stat(b'text/plain'))
+    assert decoded == []
+
+    assert text.subject == u'subject'
+    assert text.subject == u'subject'
+    assert decoded == [ b'subject' ]
+
+def test_komtext_drops_raw_text_when_body_is_decoded():
+    text = KomText(text_no=1, text=b'subject\nbody',
+                   text_stat=create_text_stat(b'text/plain'))
+
+    assert text.body == u'body'
+
+    assert text._text is None
+    assert text.subject == u'subject'
+
+def test_komtext_without_body_has_no_subject():
+    text = KomText(text_no=1, text=None, text_stat=create_text_stat(b'text/plain'))
+
+    assert text.subject is None
+    assert text.body is None
+    assert text.content_type == 'text/plain'
+
+def test_komtext_attributes_can_be_set():
+    text = KomText(text_no=1, text=b'subject\nbody',
+                   text_stat=create_text_stat(b'text/plain'))
+
+    text.subject = u'other'
+    text.body = u'other body'
+
+    assert text.subject == u'other'
+    assert text.body == u'other body'
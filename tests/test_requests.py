@@ -4,7 +4,7 @@ import pytest
 from pylyskom.protocol import MAX_TEXT_SIZE
 from pylyskom.datatypes import (
     AuxItemInput, PrivBits, ConfType, ExtendedConfType, LocalTextNo, InfoOld, CookedMiscInfo,
-    MIRecipient)
+    MIRecipient, ReadRange, ReadRangeSet)
 from pylyskom import requests, komauxitems
 
 
@@ -225,3 +225,13 @@ def test_ReqCreateAnonymousText_empty():
     aux_items = []
     r = requests.ReqCreateAnonymousText(b'hemligt', misc_info, aux_items)
     assert r.to_string() == b"87 7Hhemligt 0 { } 0 { }\n"
+
+def test_ReqSetReadRanges():
+    r = requests.ReqSetReadRanges(6, [ ReadRange(1, 3), ReadRange(5, 5) ])
+    assert r.to_string() == b"110 6 2 { 1 3 5 5 }\n"
+
+def test_ReqSetReadRanges_with_read_range_set():
+    rrs = ReadRangeSet([ (1, 3) ])
+    rrs.mark_read(4, 7)
+    r = requests.ReqSetReadRanges(6, rrs)
+    assert r.to_string() == b"110 6 1 { 1 7 }\n"
@@ -0,0 +1,140 @@
+import pytest
+
+from pylyskom.sessionmanager import SessionManager
+from pylyskom.stats import stats
+
+
+class FakeSession(object):
+    def __init__(self, cache_bytes=0, disconnect_error=None):
+        self._cache_bytes = cache_bytes
+        self._disconnect_error = disconnect_error
+        self.connected = True
+        self.disconnected = False
+
+    def is_connected(self):
+        return self.connected
+
+    def disconnect(self):
+        if self._disconnect_error is not None:
+            raise self._disconnect_error
+        self.disconnected = True
+        self.connected = False
+
+    def close(self):
+        self.connected = False
+
+    def cache_bytes(self):
+        return self._cache_bytes
+
+    def clear_caches(self):
+        self._cache_bytes = 0
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_add_and_get_session():
+    manager = SessionManager()
+    session = FakeSession()
+
+    session_id = manager.add(session)
+
+    assert session_id in manager
+    assert manager.get(session_id) is session
+    assert manager.get('unknown') is None
+    assert len(manager) == 1
+
+def test_add_with_used_session_id_raises():
+    manager = SessionManager()
+    manager.add(FakeSession(), 'a')
+
+    with pytest.raises(ValueError):
+        manager.add(FakeSession(), 'a')
+
+def test_remove_disconnects_session():
+    manager = SessionManager()
+    session = FakeSession()
+    manager.add(session, 'a')
+
+    assert manager.remove('a')
+
+    assert session.disconnected
+    assert 'a' not in manager
+    assert not manager.remove('a')
+
+def test_evict_idle_evicts_sessions_not_used_recently():
+    clock = FakeClock()
+    manager = SessionManager(max_idle_seconds=60, clock=clock)
+    a, b = FakeSession(), FakeSession()
+    manager.add(a, 'a')
+    manager.add(b, 'b')
+    clock.now += 50
+    manager.get('a')
+    clock.now += 20
+
+    assert manager.evict_idle() == 1
+
+    assert b.disconnected
+    assert not a.disconnected
+    assert 'a' in manager
+    assert 'b' not in manager
+
+def test_max_sessions_evicts_least_recently_used():
+    manager = SessionManager(max_sessions=2, clock=FakeClock())
+    a, b, c = FakeSession(), FakeSession(), FakeSession()
+    manager.add(a, 'a')
+    manager.add(b, 'b')
+    manager.get('a')
+
+    manager.add(c, 'c')
+
+    assert b.disconnected
+    assert sorted(['a', 'c']) == sorted(s for s in ['a', 'b', 'c'] if s in manager)
+
+def test_evicted_session_is_closed_if_disconnect_fails():
+    manager = SessionManager(max_sessions=1)
+    a = FakeSession(disconnect_error=IOError("broken pipe"))
+    manager.add(a, 'a')
+
+    manager.add(FakeSession(), 'b')
+
+    assert not a.is_connected()
+
+def test_shrink_caches_clears_least_recently_used_first():
+    manager = SessionManager(max_cache_bytes=250, clock=FakeClock())
+    a, b, c = FakeSession(100), FakeSession(100), FakeSession(100)
+    manager.add(a, 'a')
+    manager.add(b, 'b')
+    manager.add(c, 'c')
+    manager.get('a')
+
+    assert manager.shrink_caches() == 1
+
+    assert b.cache_bytes() == 0
+    assert a.cache_bytes() == 100
+    assert c.cache_bytes() == 100
+    assert manager.info() == dict(sessions=3, cache_bytes=200)
+
+def test_stats():
+    clock = FakeClock()
+    manager = SessionManager(max_idle_seconds=60, max_sessions=2, clock=clock)
+    before = stats.dump()
+    def diff(name):
+        name = 'pylyskom.' + name
+        return stats.dump().get(name, 0) - before.get(name, 0)
+
+    manager.add(FakeSession(), 'a')
+    manager.add(FakeSession(), 'b')
+    manager.add(FakeSession(), 'c')
+    clock.now += 61
+    manager.evict_idle()
+
+    assert diff('sessions.added.last') == 3
+    assert diff('sessions.evictions.limit.last') == 1
+    assert diff('sessions.evictions.idle.last') == 2
+    assert diff('sessions.open.last') == 0
@@ -0,0 +1,119 @@
+import gc
+import threading
+
+from pylyskom.stats import Stats, stats
+from pylyskom.cachedconnection import Cache
+
+
+def test_counter_is_included_in_dump():
+    s = Stats()
+    c = s.counter('foo.last')
+    c.value += 1
+    c.inc(2)
+
+    assert s.dump() == { 'foo.last': 3 }
+
+def test_counter_is_shared_by_name():
+    s = Stats(prefix='p.')
+    s.counter('foo.last').inc()
+    s.counter('foo.last').inc()
+
+    assert s.dump() == { 'p.foo.last': 2 }
+
+def test_unused_counter_is_not_included_in_dump():
+    s = Stats()
+    s.counter('foo.last')
+
+    assert s.dump() == {}
+
+def test_counter_is_added_to_stat_with_same_name():
+    s = Stats()
+    s.set('foo.last', 1, agg='sum')
+    s.counter('foo.last').inc()
+
+    assert s.dump() == { 'foo.last': 2 }
+
+def test_reset_returns_and_clears_counters():
+    s = Stats()
+    c = s.counter('foo.last')
+    c.inc(5)
+
+    assert s.reset() == { 'foo.last': 5 }
+    assert s.dump() == {}
+    c.inc()
+    assert s.dump() == { 'foo.last': 1 }
+
+def test_counter_sum():
+    s = Stats()
+    a = s.counter('a.last')
+    b = s.counter('b.last')
+    s.counter_sum('total.last', [a, b])
+    a.inc(2)
+    b.inc(3)
+
+    assert s.dump() == { 'a.last': 2, 'b.last': 3, 'total.last': 5 }
+    assert s.reset() == { 'a.last': 2, 'b.last': 3, 'total.last': 5 }
+    assert s.dump() == {}
+
+def test_cache_counts_hits_and_misses():
+    stats.reset()
+    c = Cache(lambda no: no, "TestStats")
+    c[1]
+    c[1]
+    c[2]
+
+    dump = stats.dump()
+    assert dump['pylyskom.clients.cache.TestStats.gets.last'] == 3
+    assert dump['pylyskom.clients.cache.TestStats.gets.hits.last'] == 1
+    assert dump['pylyskom.clients.cache.TestStats.gets.misses.last'] == 2
+    assert dump['pylyskom.clients.cache.TestStats.sets.last'] == 2
+
+def test_gauge_is_not_reset():
+    s = Stats()
+    g = s.gauge('size.last')
+    g.inc(10)
+
+    assert s.reset() == { 'size.last': 10 }
+    g.value -= 4
+    assert s.dump() == { 'size.last': 6 }
+
+def test_gauges_with_same_name_are_summed():
+    s = Stats()
+    g1 = s.gauge('size.last')
+    g2 = s.gauge('size.last')
+    g1.inc(10)
+    g2.inc(5)
+
+    assert s.dump() == { 'size.last': 15 }
+    del g2
+    gc.collect()
+    assert s.dump() == { 'size.last': 10 }
+
+def test_gauges_of_concurrent_caches_are_exact():
+    stats.reset()
+    caches = [ Cache(lambda no: b'x' * 10, "TestConcurrentSizeStats", sizeof=len)
+               for i in range(4) ]
+    def use(cache):
+        for i in range(2000):
+            cache[i]
+            cache.invalidate(i - 1)
+    threads = [ threading.Thread(target=use, args=(cache,)) for cache in caches ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    dump = stats.dump()
+    assert dump['pylyskom.clients.cache.TestConcurrentSizeStats.bytes.last'] == 4 * 10
+    assert dump['pylyskom.clients.cache.TestConcurrentSizeStats.entries.last'] == 4
+
+def test_cache_reports_size_as_gauges():
+    stats.reset()
+    c = Cache(lambda no: None, "TestSizeStats", sizeof=len)
+    c[1] = b'x' * 10
+    c[2] = b'x' * 5
+    c.invalidate(1)
+
+    dump = stats.dump()
+    assert dump['pylyskom.clients.cache.TestSizeStats.bytes.last'] == 5
+    assert dump['pylyskom.clients.cache.TestSizeStats.entries.last'] == 1